@@ -0,0 +1,292 @@
+from dataclasses import dataclass
+import re
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+# Characters of the "flat query-anchored with dots for identities" view, as uint8 codes
+DOT = ord(".")
+GAP = ord("-")
+SPACE = ord(" ")
+
+# Query line of a query range: label, first coordinate, aligned bases, last coordinate
+QUERY_LINE_REGEX = re.compile(r"^(\S+)\s+(\d+)\s+([A-Za-z\-]+)\s+(\d+)")
+
+
+def merge_segments(first: bytes, second: bytes) -> bytes:
+    """
+    Merge two segments of the same hit in a query range: columns where "first" is not aligned
+    (spaces) are taken from "second".
+    """
+    first_codes = np.frombuffer(first, dtype=np.uint8)
+    second_codes = np.frombuffer(second, dtype=np.uint8)
+
+    return np.where(first_codes == SPACE, second_codes, first_codes).astype(np.uint8).tobytes()
+
+
+@dataclass
+class AlignmentMatrix:
+    """
+    Flat query-anchored alignment stored as a uint8 matrix of rows x columns (ASCII codes). Row 0
+    is the query and the other rows are the hits, where identities are dots, mismatches the hit
+    base, gaps "-" and columns outside the hit alignment spaces. Column "n" corresponds to the
+    query coordinate "query_positions()[n]" (1-based).
+    """
+
+    labels: List[str]
+    matrix: np.ndarray
+    query_start: int
+    query_end: int
+
+    @classmethod
+    def from_text_rows(
+        cls,
+        rows: List[str],
+        labels: Optional[List[str]] = None,
+        query_start: int = 1,
+        query_end: Optional[int] = None,
+    ) -> "AlignmentMatrix":
+        """
+        Build the matrix from one text row per sequence (query first). Shorter rows are padded
+        with spaces.
+        """
+        num_columns = max((len(row) for row in rows), default=0)
+        matrix = np.full((len(rows), num_columns), SPACE, dtype=np.uint8)
+        for row_num, row in enumerate(rows):
+            matrix[row_num, : len(row)] = np.frombuffer(row.encode("ascii"), dtype=np.uint8)
+
+        if labels is None:
+            labels = ["Query"] + [f"Hit_{hit_num}" for hit_num in range(1, len(rows))]
+        if query_end is None:
+            query_end = query_start + (int(np.count_nonzero(matrix[0] != GAP)) if rows else 0) - 1
+
+        return cls(labels=labels, matrix=matrix, query_start=query_start, query_end=query_end)
+
+    @classmethod
+    def from_query_ranges(cls, query_ranges: List[str]) -> "AlignmentMatrix":
+        """
+        Build the matrix from the text of the query ranges ("qarow_{n}") shown by MEGABLAST in
+        the flat query-anchored view. Every range has a query line ("Query_1  1  ACGT...  60")
+        followed by one line per hit aligned in that range, matched to its row by label. Lines of
+        the same hit in one range (several HSPs) are merged, and empty ranges are skipped.
+        """
+        labels: List[str] = list()
+        segments: Dict[str, List[bytes]] = dict()
+        query_start = query_end = 0
+        num_columns = 0
+
+        for range_num, query_range in enumerate(query_ranges):
+            lines = [line for line in query_range.split("\n") if line.strip()]
+            if not lines:
+                continue
+
+            query_match = QUERY_LINE_REGEX.match(lines[0])
+            if query_match is None:
+                raise ValueError(f"No query line found in query range {range_num + 1}")
+
+            query_label, start, bases, end = query_match.groups()
+            offset = query_match.start(3)
+            width = len(bases)
+            if not labels:
+                query_start = int(start)
+            query_end = int(end)
+
+            range_segments = {query_label: bases.encode("ascii")}
+            for line in lines[1:]:
+                label_text = line[:offset].split()
+                label = label_text[0] if label_text else f"Hit_{len(range_segments)}"
+                segment = line[offset : offset + width].ljust(width).encode("ascii")
+                if label in range_segments:
+                    segment = merge_segments(range_segments[label], segment)
+                range_segments[label] = segment
+
+            for label, segment in range_segments.items():
+                if label not in segments:
+                    labels.append(label)
+                    # Hits first aligned in a later range start with spaces
+                    segments[label] = [b" " * num_columns]
+                segments[label].append(segment)
+
+            # Hits not aligned in this range are filled with spaces
+            for label in labels:
+                if label not in range_segments:
+                    segments[label].append(b" " * width)
+
+            num_columns += width
+
+        matrix = np.full((len(labels), num_columns), SPACE, dtype=np.uint8)
+        for row_num, label in enumerate(labels):
+            row = b"".join(segments[label])
+            matrix[row_num, : len(row)] = np.frombuffer(row, dtype=np.uint8)
+
+        return cls(labels=labels, matrix=matrix, query_start=query_start, query_end=query_end)
+
+    def ordered_by(self, hit_labels: List[str]) -> Optional["AlignmentMatrix"]:
+        """
+        Alignment with the hit rows in the order of "hit_labels" (e.g. the accessions of the
+        species, by rank), or None if any of them has no row. Rows of the query ranges follow the
+        order in which hits first appear, not their rank.
+        """
+        rows = {label: row_num for row_num, label in enumerate(self.labels[1:], start=1)}
+        if any(label not in rows for label in hit_labels):
+            return None
+
+        order = [0] + [rows[label] for label in hit_labels]
+        return AlignmentMatrix(
+            labels=[self.labels[0]] + list(hit_labels),
+            matrix=self.matrix[order],
+            query_start=self.query_start,
+            query_end=self.query_end,
+        )
+
+    @classmethod
+    def from_json(cls, data: dict) -> "AlignmentMatrix":
+        return cls.from_text_rows(
+            rows=data["rows"],
+            labels=data["labels"],
+            query_start=data["query_start"],
+            query_end=data["query_end"],
+        )
+
+    def to_json(self) -> dict:
+        return {
+            "labels": self.labels,
+            "rows": self.text_rows(),
+            "query_start": self.query_start,
+            "query_end": self.query_end,
+        }
+
+    @property
+    def num_hits(self) -> int:
+        return max(self.matrix.shape[0] - 1, 0)
+
+    @property
+    def query(self) -> np.ndarray:
+        return self.matrix[0]
+
+    @property
+    def hits(self) -> np.ndarray:
+        return self.matrix[1:]
+
+    def query_positions(self) -> np.ndarray:
+        """
+        Query coordinate (1-based) of every column. Columns with a gap in the query (insertions in
+        a hit) get the coordinate of the previous query base.
+        """
+        return self.query_start + np.cumsum(self.query != GAP) - 1
+
+    def aligned(self) -> np.ndarray:
+        """
+        Boolean hits x columns matrix, True where the hit is aligned to the query.
+        """
+        return self.hits != SPACE
+
+    def matches(self) -> np.ndarray:
+        return self.hits == DOT
+
+    def gaps(self) -> np.ndarray:
+        """
+        Boolean hits x columns matrix, True where either the hit or the query has a gap.
+        """
+        return self.aligned() & ((self.hits == GAP) | ((self.query == GAP) & (self.hits != DOT)))
+
+    def mismatches(self) -> np.ndarray:
+        return self.aligned() & ~self.matches() & ~self.gaps()
+
+    def identity(self) -> np.ndarray:
+        """
+        Percentage of identities over the aligned columns of every hit.
+        """
+        num_aligned = self.aligned().sum(axis=1)
+        return np.divide(
+            self.matches().sum(axis=1) * 100,
+            num_aligned,
+            out=np.zeros(self.num_hits),
+            where=num_aligned > 0,
+        )
+
+    def num_mismatches(self) -> np.ndarray:
+        return self.mismatches().sum(axis=1)
+
+    def num_gaps(self) -> np.ndarray:
+        return self.gaps().sum(axis=1)
+
+    def coverage(self) -> np.ndarray:
+        """
+        Percentage of query bases covered by the alignment of every hit.
+        """
+        query_bases = self.query != GAP
+        num_query_bases = int(np.count_nonzero(query_bases))
+        if num_query_bases == 0:
+            return np.zeros(self.num_hits)
+
+        return (self.aligned() & query_bases).sum(axis=1) * 100 / num_query_bases
+
+    def conservation(self) -> np.ndarray:
+        """
+        Fraction of the hits aligned at every column that are identical to the query there.
+        """
+        num_aligned = self.aligned().sum(axis=0)
+        return np.divide(
+            self.matches().sum(axis=0),
+            num_aligned,
+            out=np.zeros(self.matrix.shape[1]),
+            where=num_aligned > 0,
+        )
+
+    def text_rows(self) -> List[str]:
+        """
+        Alignment of every sequence as text (query first), without labels or coordinates.
+        """
+        return [row.tobytes().decode("ascii").rstrip() for row in self.matrix]
+
+    def hit_sequences(self) -> List[str]:
+        """
+        Aligned part of every hit sequence, rebuilt from the query bases at its identities.
+        """
+        sequences: List[str] = list()
+        for hit in self.hits:
+            bases = np.where(hit == DOT, self.query, hit)
+            bases = bases[(hit != SPACE) & (bases != GAP)]
+            sequences.append(bases.tobytes().decode("ascii").upper())
+
+        return sequences
+
+    def render(self) -> List[str]:
+        """
+        Render the FlatQueryAnchored dot text, one line per sequence with its label and the query
+        coordinates of its first and last aligned columns.
+        """
+        label_width = max((len(label) for label in self.labels), default=0)
+        positions = self.query_positions()
+
+        lines: List[str] = list()
+        for label, row in zip(self.labels, self.matrix):
+            aligned_columns = np.flatnonzero(row != SPACE)
+            if len(aligned_columns) == 0:
+                lines.append(label)
+                continue
+
+            first, last = aligned_columns[0], aligned_columns[-1]
+            text = row.tobytes().decode("ascii")
+            lines.append(
+                f"{label:<{label_width}}  {positions[first]:<5} {text}  {positions[last]}"
+            )
+
+        return lines
+
+    def crop(self, window: Tuple[int, int]) -> "AlignmentMatrix":
+        """
+        Alignment restricted to the columns of a query window, given as a slice of the query
+        sequence ("sequence[start:end]", i.e. 1-based coordinates start + 1 to end).
+        """
+        start, end = window
+        positions = self.query_positions()
+        in_window = (positions >= start + 1) & (positions <= end)
+
+        return AlignmentMatrix(
+            labels=list(self.labels),
+            matrix=self.matrix[:, in_window],
+            query_start=max(start + 1, self.query_start),
+            query_end=min(end, self.query_end),
+        )
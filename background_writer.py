@@ -0,0 +1,122 @@
+from dataclasses import dataclass, field
+import queue
+import threading
+from typing import Any, Callable, List, Optional, Tuple
+
+from loguru import logger
+
+# Queue item that tells a writer thread to stop
+_STOP = None
+
+
+class BackgroundWriterError(Exception):
+    pass
+
+
+@dataclass
+class BackgroundWriter:
+    """
+    Runs write tasks (saving reports, alignments, journal records...) in background threads, so
+    the next remote query starts as soon as the results are extracted.
+
+    At most "max_pending" tasks wait in the queue: when it is full, "submit" blocks until a
+    writer catches up, so results can't pile up in memory. Tasks are run in submission order by
+    each of the "num_threads" threads. A failed task doesn't stop the writer, its error is raised
+    by the next "submit" or "check" call, or by "close", which waits for every pending task.
+    """
+
+    max_pending: int = 8
+    num_threads: int = 1
+    _tasks: "queue.Queue[Optional[Tuple[str, Callable[..., Any], tuple, dict]]]" = field(
+        init=False
+    )
+    _threads: List[threading.Thread] = field(init=False, default_factory=list)
+    _errors: List[Tuple[str, BaseException]] = field(init=False, default_factory=list)
+    _lock: threading.Lock = field(init=False, default_factory=threading.Lock)
+    _closed: bool = field(init=False, default=False)
+
+    def __post_init__(self) -> None:
+        self._tasks = queue.Queue(maxsize=self.max_pending)
+
+        for thread_num in range(self.num_threads):
+            thread = threading.Thread(
+                target=self._worker, name=f"background_writer_{thread_num}", daemon=True
+            )
+            thread.start()
+            self._threads.append(thread)
+
+    def __enter__(self) -> "BackgroundWriter":
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        # Don't hide the error that interrupted the main loop with a write error
+        self.close(raise_errors=exc_type is None)
+
+    @property
+    def num_pending(self) -> int:
+        return self._tasks.qsize()
+
+    def submit(self, name: str, function: Callable[..., Any], *args, **kwargs) -> None:
+        """
+        Queue "function(*args, **kwargs)" to be run in the background. "name" identifies the task
+        in the logs and errors.
+        """
+        if self._closed:
+            raise BackgroundWriterError(f"Writer closed, can't write {name}")
+
+        self.check()
+        self._tasks.put((name, function, args, kwargs))
+
+    def check(self) -> None:
+        """
+        Raise the first error of the tasks that failed since the last check.
+        """
+        with self._lock:
+            if not self._errors:
+                return
+            errors, self._errors = self._errors, list()
+
+        name, error = errors[0]
+        raise BackgroundWriterError(
+            f"{len(errors)} background writes failed, first failure writing {name}"
+        ) from error
+
+    def flush(self) -> None:
+        """
+        Wait until every queued task has been run, then raise any write error.
+        """
+        self._tasks.join()
+        self.check()
+
+    def close(self, raise_errors: bool = True) -> None:
+        """
+        Run the pending tasks and stop the writer threads. With "raise_errors", any write error
+        is raised once every task has been run.
+        """
+        if not self._closed:
+            self._closed = True
+            for _ in self._threads:
+                self._tasks.put(_STOP)
+            for thread in self._threads:
+                thread.join()
+            logger.debug("Background writer flushed and stopped")
+
+        if raise_errors:
+            self.check()
+
+    def _worker(self) -> None:
+        while True:
+            task = self._tasks.get()
+            try:
+                if task is _STOP:
+                    return
+
+                name, function, args, kwargs = task
+                try:
+                    function(*args, **kwargs)
+                except Exception as error:
+                    logger.exception(f"Background write of {name} failed")
+                    with self._lock:
+                        self._errors.append((name, error))
+            finally:
+                self._tasks.task_done()
@@ -0,0 +1,222 @@
+from dataclasses import asdict, dataclass
+from functools import partial
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+from loguru import logger
+
+from blast_ncbi import BlastNCBI
+from blast_ncbi_api import BlastNCBIApi
+from data_saver import PlateReport, save_alignments_to_notes
+from metrics import METRICS
+from sequence_matcher import SequenceMatcher, modify_rdp_file
+from sequence_reader import CorrectedSequence
+from session_pool import SessionPool
+from stand_in_server import StandInServer, random_sequence
+
+
+@dataclass
+class BenchmarkResult:
+    backend: str
+    num_sequences: int
+    concurrency: int
+    elapsed: float
+    sequences_per_hour: float
+    stages: Dict[str, Dict[str, float]]
+
+
+def benchmark_sequences(num_sequences: int, length: int = 1200, seed: int = 0) -> List[str]:
+    """
+    Random sequences used as queries, always the same for the same arguments.
+    """
+    rng = random.Random(seed)
+    return [random_sequence(rng, length) for _ in range(num_sequences)]
+
+
+def create_benchmark_session(
+    download_path: str,
+    backend: str,
+    server: StandInServer,
+    driver_path: Optional[str] = None,
+) -> Any:
+    """
+    Open a session of "backend" querying the stand-in "server".
+    """
+    if backend == "api":
+        session = BlastNCBIApi(base_url=server.blast_url, poll_interval=1)
+    elif backend == "selenium":
+        session = BlastNCBI(megablast_page=server.megablast_page)
+        session.configure_browser(download_path=download_path, driver_path=driver_path)
+    else:
+        session = SequenceMatcher(
+            web_page=server.seqmatch_page, headless=True, block_resources=True
+        )
+        session.configure_browser(download_path=download_path, driver_path=driver_path)
+
+    return session
+
+
+def blast_job(session: Any, job: Tuple[int, str], output_dir: str, report: PlateReport) -> None:
+    """
+    Query a sequence to MEGABLAST and save its results, like "main.save_query_results".
+    """
+    num, sequence = job
+    species_results, alignments, _ = session.query_sequence(sequence)
+
+    save_alignments_to_notes(path=output_dir, file_name=f"sequence_{num}", alignments=alignments)
+    report.add_results(f"sequence_{num}", species_results)
+
+
+def seqmatch_job(session: SequenceMatcher, job: Tuple[int, str], output_dir: str) -> None:
+    """
+    Query a sequence to SeqMatch and write its output file, like "match_sequence".
+    """
+    num, sequence = job
+    file_name = session.query_sequence(sequence)
+
+    download_file = os.path.join(session.download_path, file_name)
+    modify_rdp_file(
+        file_path=download_file,
+        output_file=os.path.join(output_dir, f"sequence_{num}"),
+        main_sequence=CorrectedSequence(
+            id=f"sequence_{num}", specie_name="benchmark", sequence=sequence, num_seq=num
+        ),
+    )
+    os.remove(download_file)
+
+
+def run_benchmark(
+    server: StandInServer,
+    backend: str,
+    num_sequences: int,
+    concurrency: int,
+    work_dir: str,
+    driver_path: Optional[str] = None,
+) -> BenchmarkResult:
+    """
+    Query "num_sequences" sequences to the stand-in "server" with "concurrency" sessions of
+    "backend" ("api", "selenium" or "seqmatch") and save their results. Returns the total time,
+    the throughput and the latency of every stage, from the spans recorded in "METRICS".
+    """
+    METRICS.reset()
+    output_dir = os.path.join(work_dir, f"{backend}_{num_sequences}_{concurrency}")
+    os.makedirs(output_dir, exist_ok=True)
+
+    jobs = list(enumerate(benchmark_sequences(num_sequences), start=1))
+    report = PlateReport(path=output_dir, file_name="plate_report")
+    if backend == "seqmatch":
+        job_function = partial(seqmatch_job, output_dir=output_dir)
+    else:
+        job_function = partial(blast_job, output_dir=output_dir, report=report)
+
+    pool = SessionPool(
+        session_factory=partial(
+            create_benchmark_session,
+            backend=backend,
+            server=server,
+            driver_path=driver_path,
+        ),
+        download_root=os.path.join(output_dir, "workers"),
+        max_workers=concurrency,
+    )
+
+    start = time.monotonic()
+    pool.map(job_function, jobs)
+    if backend != "seqmatch":
+        report.save()
+    elapsed = time.monotonic() - start
+
+    return BenchmarkResult(
+        backend=backend,
+        num_sequences=num_sequences,
+        concurrency=concurrency,
+        elapsed=elapsed,
+        sequences_per_hour=num_sequences / elapsed * 3600,
+        stages=METRICS.summary(),
+    )
+
+
+def format_result(result: BenchmarkResult) -> str:
+    lines = [
+        f"{result.backend}: {result.num_sequences} sequences, concurrency {result.concurrency}: "
+        f"{result.elapsed:.2f} s, {result.sequences_per_hour:.0f} sequences/hour",
+        f"    {'Stage':<40}{'Count':>7}{'Mean (s)':>10}{'p50 (s)':>10}{'p90 (s)':>10}"
+        f"{'Max (s)':>10}",
+    ]
+    for stage, summary in result.stages.items():
+        lines.append(
+            f"    {stage:<40}{summary['count']:>7}{summary['mean']:>10.3f}{summary['p50']:>10.3f}"
+            f"{summary['p90']:>10.3f}{summary['max']:>10.3f}"
+        )
+
+    return "\n".join(lines)
+
+
+def run_benchmarks(
+    backends: List[str] = ["api"],
+    sizes: List[int] = [1, 10, 100],
+    concurrency_levels: List[int] = [1, 4, 8],
+    queue_delay: float = 2.0,
+    num_hits: int = 100,
+    num_matches: int = 20,
+    driver_path: Optional[str] = None,
+    results_path: Optional[str] = None,
+) -> List[BenchmarkResult]:
+    """
+    Benchmark every backend with every number of sequences and concurrency level against a
+    stand-in server whose jobs take "queue_delay" seconds. The "selenium" and "seqmatch"
+    backends need the ChromeDriver at "driver_path".
+
+    With "results_path", every result is appended to that JSONL file with the settings used, to
+    compare the performance of different versions of the code.
+    """
+    results: List[BenchmarkResult] = list()
+
+    with StandInServer(
+        queue_delay=queue_delay, num_hits=num_hits, num_matches=num_matches
+    ) as server, tempfile.TemporaryDirectory() as work_dir:
+        for backend in backends:
+            for num_sequences in sizes:
+                for concurrency in concurrency_levels:
+                    result = run_benchmark(
+                        server, backend, num_sequences, concurrency, work_dir, driver_path
+                    )
+                    logger.info(f"Benchmark result:\n{format_result(result)}")
+                    results.append(result)
+
+                    if results_path is not None:
+                        with open(results_path, "a") as file:
+                            record = dict(
+                                asdict(result),
+                                time=time.time(),
+                                queue_delay=queue_delay,
+                                num_hits=num_hits,
+                                num_matches=num_matches,
+                            )
+                            file.write(json.dumps(record) + "\n")
+
+    return results
+
+
+if __name__ == "__main__":
+    PATH_CHROME_DRIVER = "C:/Program Files (x86)/chromedriver.exe"
+
+    # Only the benchmark results, not the logs of every query
+    logger.remove()
+    logger.add(
+        sys.stderr, level="INFO", filter=lambda record: record["function"] == "run_benchmarks"
+    )
+
+    run_benchmarks(
+        backends=["api", "selenium", "seqmatch"],
+        sizes=[1, 10, 100],
+        concurrency_levels=[1, 4, 8],
+        queue_delay=2.0,
+        driver_path=PATH_CHROME_DRIVER,
+        results_path="benchmark_results.jsonl",
+    )
@@ -1,52 +1,331 @@
-from dataclasses import dataclass, field
-import time
-import subprocess
-from typing import Dict, List, Tuple
+from dataclasses import asdict, dataclass, field
+import re
+from typing import Any, Callable, Dict, List, Optional, Tuple, Union
 from loguru import logger
 
 import selenium
 from selenium.webdriver.chrome.webdriver import WebDriver
 from selenium.webdriver.common.by import By
-from selenium.webdriver.support.ui import WebDriverWait
+from selenium.webdriver.support.ui import Select
 from selenium.webdriver.support import expected_conditions as EC
 from selenium import webdriver
 
-TIMING_FACTOR = 1
+from alignment import AlignmentMatrix
+from browser_processes import BrowserProcessTree, close_browser, track_browser
+from browser_waits import StepTimer, any_element_located, network_idle
+from job_queue import QueueRateLimiter
+from metrics import span, timed
+from result_cache import ResultCache
+from token_bucket import TokenBucket
+
+RESULTS_LOCATOR = (By.XPATH, "//div[@class='usa-alert-body']")
+WAITING_LOCATOR = (By.XPATH, "//p[@class='WAITING']")
+
+
+# Fields of "BlastNCBIResults" kept as text, the others are numbers
+TEXT_FIELDS = [
+    "description",
+    "description_url",
+    "scientific_name",
+    "scientific_name_url",
+    "accession",
+    "accession_url",
+]
+
+
+def parse_number(value: Union[str, float]) -> float:
+    """
+    Parse a number as MEGABLAST shows it ("96.44%", "1,470", "2e-150"). Numbers are returned as
+    they are.
+    """
+    if isinstance(value, str):
+        return float(value.strip().rstrip("%").replace(",", ""))
+
+    return float(value)
+
+
+def format_e_value(e_value: float) -> str:
+    """
+    Format an e-value the way the MEGABLAST results page shows it (e.g. 0.0, 0.003, 4e-04,
+    2e-150).
+    """
+    if e_value == 0:
+        return "0.0"
+    if e_value >= 0.001:
+        return f"{e_value:.2g}"
+
+    return f"{e_value:.0e}"
 
 
 @dataclass
 class BlastNCBIResults:
+    """
+    A hit of the MEGABLAST results table. Scores and lengths are integers, while the query cover
+    and identity (percentages) and the e-value are floats. "from_record" parses them from the
+    text shown by MEGABLAST, and "display_value" formats them back the same way.
+    """
+
+    __slots__ = (
+        "description",
+        "description_url",
+        "scientific_name",
+        "scientific_name_url",
+        "max_score",
+        "total_score",
+        "query_cover",
+        "e_value",
+        "per_indentity",
+        "accession_len",
+        "accession",
+        "accession_url",
+    )
+
     description: str
     description_url: str
     scientific_name: str
     scientific_name_url: str
     max_score: int
     total_score: int
-    query_cover: int
-    e_value: int
+    query_cover: float
+    e_value: float
     per_indentity: float
     accession_len: int
     accession: str
     accession_url: str
 
+    @classmethod
+    def from_record(cls, record: Dict[str, Any]) -> "BlastNCBIResults":
+        """
+        Build the results from a dict with every field, either as text (scraped from the results
+        page, or stored by older versions) or already parsed. Raises ValueError when a number is
+        missing (an empty cell) or can't be read.
+        """
+        return cls(
+            **{name: record[name] for name in TEXT_FIELDS},
+            max_score=round(parse_number(record["max_score"])),
+            total_score=round(parse_number(record["total_score"])),
+            query_cover=parse_number(record["query_cover"]),
+            e_value=parse_number(record["e_value"]),
+            per_indentity=parse_number(record["per_indentity"]),
+            accession_len=round(parse_number(record["accession_len"])),
+        )
+
+    def display_value(self, name: str) -> str:
+        """
+        Value of a field as text, formatted the way the MEGABLAST results page shows it.
+        """
+        value = getattr(self, name)
+        if name == "e_value":
+            return format_e_value(value)
+        if name == "per_indentity":
+            return f"{value:.2f}%"
+        if name == "query_cover":
+            return f"{value:.0f}%"
+
+        return str(value)
+
+
+def parse_species(records: List[Dict[str, Any]]) -> List[BlastNCBIResults]:
+    """
+    Build the results of every hit row with "BlastNCBIResults.from_record". Rows with a missing
+    or unreadable number (e.g. an empty cell) are skipped with a warning, instead of failing the
+    whole query.
+    """
+    species_results: List[BlastNCBIResults] = list()
+    for record in records:
+        try:
+            species_results.append(BlastNCBIResults.from_record(record))
+        except (KeyError, ValueError) as error:
+            logger.warning(f"Hit {record.get('accession', '')} skipped, can't be read: {error!r}")
+
+    return species_results
+
+
+QueryResults = Tuple[List[BlastNCBIResults], AlignmentMatrix, bool]
+
+# Leaves only the first "top_n" hits selected and returns the data of their rows. Done in the
+# browser so that the whole table is read in a single WebDriver call, whatever "top_n" is
+EXTRACT_HITS_SCRIPT = """
+const topN = arguments[0];
+
+for (const checkbox of document.querySelectorAll("input[id^='chk_']")) {
+    const num = parseInt(checkbox.id.slice(4));
+    if (isNaN(num)) {
+        continue;
+    }
+    if (checkbox.checked !== num <= topN) {
+        checkbox.click();
+    }
+}
+
+const cellText = (row, selector) => {
+    const cell = row.querySelector(selector);
+    return cell ? cell.innerText.trim() : "";
+};
+const cellLink = (row, selector) => {
+    const link = row.querySelector(selector + " a");
+    return link ? [link.innerText.trim(), link.href] : ["", ""];
+};
+
+const hits = [];
+for (let num = 1; num <= topN; num++) {
+    const row = document.querySelector(`tbody tr[ind='${num}']`);
+    if (row === null) {
+        break;
+    }
+
+    const [description, descriptionUrl] = cellLink(row, "td.c2");
+    const [scientificName, scientificNameUrl] = cellLink(row, "td.c3");
+    const [accession, accessionUrl] = cellLink(row, "td.c12");
+
+    hits.push({
+        description: description,
+        description_url: descriptionUrl,
+        scientific_name: scientificName,
+        scientific_name_url: scientificNameUrl,
+        max_score: cellText(row, "td.c6"),
+        total_score: cellText(row, "td.c7"),
+        query_cover: cellText(row, "td.c8"),
+        e_value: cellText(row, "td.c9"),
+        per_indentity: cellText(row, "td.c10"),
+        accession_len: cellText(row, "td.c11"),
+        accession: accession,
+        accession_url: accessionUrl,
+    });
+}
+
+return hits;
+"""
+
+# Returns the text of every query range ("qarow_{n}") of the query-anchored alignments, in order
+EXTRACT_ALIGNMENTS_SCRIPT = """
+return Array.from(document.querySelectorAll("[id^='qarow_']"))
+    .sort((a, b) => parseInt(a.id.slice(6)) - parseInt(b.id.slice(6)))
+    .map((queryRange) => queryRange.innerText);
+"""
+
+
+def encode_query_results(results: QueryResults) -> dict:
+    """
+    Convert the (species, alignments, error) results of a query into a JSON-serializable dict.
+    """
+    species_results, alignments, error = results
+
+    return {
+        "species": [asdict(specie) for specie in species_results],
+        "alignments": alignments.to_json(),
+        "error": error,
+    }
+
+
+def decode_query_results(data: dict) -> QueryResults:
+    """
+    Rebuild the (species, alignments, error) results of a query from "encode_query_results".
+    """
+    return (
+        parse_species(data["species"]),
+        AlignmentMatrix.from_json(data["alignments"]),
+        data["error"],
+    )
+
+
+def is_cached(
+    cache: Optional[ResultCache],
+    cache_parameters: dict,
+    sequence: str,
+    crop: Optional[Tuple[int, int]] = None,
+) -> bool:
+    """
+    Whether the results of a sequence (cropped to "crop" if given) are in "cache".
+    """
+    if cache is None:
+        return False
+
+    return cache.contains(cache.make_key(crop_sequence(sequence, crop), **cache_parameters))
+
+
+def crop_sequence(sequence: str, crop: Optional[Tuple[int, int]]) -> str:
+    """
+    The part of "sequence" in the "crop" window that is queried, or the whole sequence.
+    """
+    return sequence[crop[0] : crop[1]] if crop is not None else sequence
+
+
+def query_with_cache(
+    cache: Optional[ResultCache],
+    cache_parameters: dict,
+    sequences: List[str],
+    crop: Optional[Tuple[int, int]],
+    query_function: Callable[[List[str]], List[QueryResults]],
+) -> List[QueryResults]:
+    """
+    Return the results of every sequence (cropped to "crop" if given), taking them from "cache"
+    when possible. Only the sequences missing from the cache are sent to "query_function", and
+    their results are stored afterwards.
+
+    Entries are keyed by the sequence actually submitted, so a crop shares its entry with any
+    other query of the same cropped sequence. The window is only stored along with the results.
+    """
+    cropped_sequences = [crop_sequence(sequence, crop) for sequence in sequences]
+
+    if cache is None:
+        return query_function(cropped_sequences)
+
+    cache_keys = [cache.make_key(sequence, **cache_parameters) for sequence in cropped_sequences]
+    batch_results: List[Optional[QueryResults]] = list()
+    for cache_key in cache_keys:
+        cached = cache.get(cache_key)
+        batch_results.append(decode_query_results(cached) if cached is not None else None)
+
+    pending = [num for num, results in enumerate(batch_results) if results is None]
+    logger.info(f"{len(sequences) - len(pending)}/{len(sequences)} query results found in cache")
+
+    if pending:
+        new_results = query_function([cropped_sequences[num] for num in pending])
+        for num, results in zip(pending, new_results):
+            cache.put(cache_keys[num], {**encode_query_results(results), "crop": crop})
+            batch_results[num] = results
+
+    return batch_results
+
 
 @dataclass
 class BlastNCBI:
     megablast_page: str = field(
         default="https://blast.ncbi.nlm.nih.gov/Blast.cgi??DATABASE=nr&PAGE=MegaBlast"
     )
+    exclude_uncultured: bool = True
+    top_n: int = 5
+    cache: Optional[ResultCache] = None
+    step_timer: StepTimer = field(default_factory=StepTimer)
+    # Shared by the sessions of a run (or the workers of a queue) to limit how often jobs are
+    # submitted to NCBI
+    submit_limiter: Optional[Union[TokenBucket, QueueRateLimiter]] = None
     web_driver: WebDriver = field(init=False)
     download_path: str = field(init=False)
+    processes: BrowserProcessTree = field(init=False)
+
+    @property
+    def cache_parameters(self) -> dict:
+        """
+        Query parameters that change the results, used in the result cache key.
+        """
+        database = re.search(r"DATABASE=(\w+)", self.megablast_page)
+
+        return {
+            "backend": "megablast",
+            "database": database.group(1) if database else self.megablast_page,
+            "exclude_uncultured": self.exclude_uncultured,
+            "top_n": self.top_n,
+        }
 
     def quit(self) -> None:
         """
-        Removes webdriver and kills all Google Chrome and ChromeDriver processes.
+        Removes webdriver and terminates the Google Chrome and ChromeDriver processes of this
+        session, leaving other browsers of the machine running.
         """
-        self.web_driver.quit()
-        time.sleep(1 * TIMING_FACTOR)
-        subprocess.call("TASKKILL /f  /IM  CHROME.EXE")
-        subprocess.call("TASKKILL /f  /IM  CHROMEDRIVER.EXE")
-        time.sleep(1 * TIMING_FACTOR)
+        self.step_timer.log_report()
+        close_browser(self.web_driver, self.processes)
 
     def configure_browser(self, download_path: str, driver_path: str) -> WebDriver:
         """
@@ -73,164 +352,271 @@ class BlastNCBI:
         options.add_argument("--mute-audio")
 
         self.web_driver = webdriver.Chrome(executable_path=driver_path, options=options)
+        self.processes = track_browser(self.web_driver)
         self.web_driver.maximize_window()
 
-    def query_sequence(self, sequence: str) -> Tuple[BlastNCBIResults, Dict[str, str]]:
+    def is_cached(self, sequence: str, crop: Optional[Tuple[int, int]] = None) -> bool:
+        """
+        Whether the results of a sequence, or of its "crop" window, are in the result cache.
+        """
+        return is_cached(self.cache, self.cache_parameters, sequence, crop)
+
+    def query_sequence(
+        self, sequence: str, crop: Optional[Tuple[int, int]] = None
+    ) -> QueryResults:
+        """
+        Query one sequence, or its "crop" window, to MEGABLAST. Returns the top species found,
+        their alignments and whether an error occurred finding similar species.
+        """
+        return self.query_batch(sequences=[sequence], crop=crop)[0]
+
+    @timed("megablast.query_batch")
+    def query_batch(
+        self, sequences: List[str], crop: Optional[Tuple[int, int]] = None
+    ) -> List[QueryResults]:
+        """
+        Query several sequences, or their "crop" window, to MEGABLAST in a single job. The
+        sequences are submitted as one multi-FASTA query and the multi-query result page is split
+        back into one (species, alignments, error) tuple per sequence, in the same order as
+        "sequences". Sequences found in the result cache are not submitted.
+        """
+        return query_with_cache(
+            cache=self.cache,
+            cache_parameters=self.cache_parameters,
+            sequences=sequences,
+            crop=crop,
+            query_function=self._query_remote,
+        )
+
+    def _query_remote(self, sequences: List[str]) -> List[QueryResults]:
+        """
+        Submit the sequences in one MEGABLAST job and extract the results of each of them.
+        """
+        if len(sequences) == 1:
+            self._submit_query(query=sequences[0])
+            self._wait_for_results()
+
+            return [self._extract_results()]
+
+        fasta_query = "\n".join(
+            f">query_{num}\n{sequence}" for num, sequence in enumerate(sequences, start=1)
+        )
+
+        logger.info(f"Submitting a batch of {len(sequences)} sequences in one MEGABLAST job")
+        self._submit_query(query=fasta_query)
+        self._wait_for_results()
+
+        batch_results: List[QueryResults] = list()
+
+        for query_index in range(len(sequences)):
+            # The first query is shown by default, the rest are chosen from the "Results for" list
+            if query_index > 0:
+                self._select_query_result(query_index=query_index)
+
+            logger.info(f"Extracting results of query {query_index + 1}/{len(sequences)}")
+            batch_results.append(self._extract_results())
+
+        return batch_results
+
+    def _submit_query(self, query: str) -> None:
+        """
+        Open the MEGABLAST page, paste the query (a single sequence or a multi-FASTA text) and
+        submit the job, once "submit_limiter" allows it.
+        """
+        if self.submit_limiter is not None:
+            with span("megablast.rate_limit_wait"):
+                self.submit_limiter.acquire()
+
         # Open URL
         logger.info("Accessing URL, please wait...")
-        self.web_driver.get(self.megablast_page)
+        with span("megablast.page_load"):
+            self.web_driver.get(self.megablast_page)
         logger.info("URL loaded!")
 
+        with span("megablast.submit"):
+            self._fill_and_submit_form(query=query)
+
+    def _fill_and_submit_form(self, query: str) -> None:
+        """
+        Fill the MEGABLAST form with the query and options and submit it.
+        """
         # Copy the sequence to the text area
-        textarea = self.web_driver.find_element(By.XPATH, "//textarea[@name='QUERY']")
+        textarea = self.step_timer.wait(
+            self.web_driver,
+            "query text area",
+            EC.element_to_be_clickable((By.XPATH, "//textarea[@name='QUERY']")),
+        )
         textarea.click()
         textarea.clear()
-        textarea.send_keys(sequence)
-
-        time.sleep(0.5 * TIMING_FACTOR)
+        textarea.send_keys(query)
+
+        # Wait until the whole query has been typed (line breaks may be normalized)
+        query_length = len(query.replace("\n", ""))
+        self.step_timer.wait(
+            self.web_driver,
+            "query typed",
+            lambda _: len(textarea.get_attribute("value").replace("\n", "")) >= query_length,
+            replaced_sleep=0.5,
+        )
 
         # Check the "Uncultured/enviromental sample sequences"
-        WebDriverWait(self.web_driver, 20).until(
-            EC.element_to_be_clickable((By.XPATH, "//label[@for='exclSeqUncult']"))
-        ).click()
-        time.sleep(0.5 * TIMING_FACTOR)
+        if self.exclude_uncultured:
+            self.step_timer.wait(
+                self.web_driver,
+                "exclude uncultured label",
+                EC.element_to_be_clickable((By.XPATH, "//label[@for='exclSeqUncult']")),
+            ).click()
+            self.step_timer.wait(
+                self.web_driver,
+                "exclude uncultured checked",
+                EC.element_located_to_be_selected((By.XPATH, "//input[@id='exclSeqUncult']")),
+                replaced_sleep=0.5,
+            )
 
         # Click on the BLAST button
-        WebDriverWait(self.web_driver, 20).until(
-            EC.element_to_be_clickable((By.XPATH, "//div[@id='blastButton1']/input"))
-        ).click()
+        blast_button = self.step_timer.wait(
+            self.web_driver,
+            "BLAST button",
+            EC.element_to_be_clickable((By.XPATH, "//div[@id='blastButton1']/input")),
+        )
+        blast_button.click()
+
+        # The form page is replaced by the "waiting" (or results) page
+        self.step_timer.wait(
+            self.web_driver,
+            "BLAST submitted",
+            EC.staleness_of(blast_button),
+            timeout=60,
+            replaced_sleep=5,
+        )
 
-        time.sleep(5 * TIMING_FACTOR)
+    @timed("megablast.queue_wait")
+    def _wait_for_results(self) -> None:
+        """
+        Wait until NCBI has finished the submitted job and shows the results page.
+        """
+        while True:
+
+            # Once loaded, the page shows either the results or the time left to get them
+            page_element = self.step_timer.wait(
+                self.web_driver,
+                "results or waiting page",
+                any_element_located([RESULTS_LOCATOR, WAITING_LOCATOR]),
+                timeout=60,
+            )
 
-        # Wait until results appear
-        obtained_result = False
+            # Check if the results have been provided
+            if "usa-alert-body" in page_element.get_attribute("class"):
+                return
 
-        while not obtained_result:
+            # Get the amount of seconds to wait
+            try:
+                wait_seconds = int(page_element.text.split(" ")[7])
+            except (selenium.common.exceptions.StaleElementReferenceException, ValueError):
+                continue
+            logger.debug(f"Waiting up to {wait_seconds} seconds until receiving results from NCBI...")
 
-            # Check if the results have been provided
+            # NCBI reloads the page by itself, so the results are used as soon as they appear
             try:
-                self.web_driver.find_element(By.XPATH, "//div[@class='usa-alert-body']")
-                obtained_result = True
-            except selenium.common.exceptions.NoSuchElementException:
-                # Get the amount of seconds to wait
-                wait_seconds = int(
-                    self.web_driver.find_element(By.XPATH, "//p[@class='WAITING']").text.split(" ")[
-                        7
-                    ]
+                self.step_timer.wait(
+                    self.web_driver,
+                    "NCBI queue",
+                    EC.presence_of_element_located(RESULTS_LOCATOR),
+                    timeout=wait_seconds + 30,
+                    replaced_sleep=wait_seconds,
                 )
-                logger.debug(f"Waiting {wait_seconds} seconds until receiving results from NCBI...")
-                time.sleep(wait_seconds)
+                return
+            except selenium.common.exceptions.TimeoutException:
+                continue
 
-        # * Once the results have been retrieved by the database, get the data
+    @timed("megablast.select_query")
+    def _select_query_result(self, query_index: int) -> None:
+        """
+        In a multi-query results page, show the results of the query at "query_index" (0-based).
+        """
+        results_alert = self.web_driver.find_element(*RESULTS_LOCATOR)
+
+        # Choose the query in the "Results for" drop-down list, which reloads the results page
+        Select(
+            self.step_timer.wait(
+                self.web_driver,
+                "results for list",
+                EC.element_to_be_clickable((By.XPATH, "//select[@id='queryList']")),
+            )
+        ).select_by_index(query_index)
 
-        # Unselect all data
-        WebDriverWait(self.web_driver, 20).until(
-            EC.element_to_be_clickable((By.XPATH, "//label[@for='select-all']"))
-        ).click()
+        self.step_timer.wait(
+            self.web_driver, "query results reload", EC.staleness_of(results_alert)
+        )
+        self._wait_for_results()
 
-        time.sleep(0.5 * TIMING_FACTOR)
+    def _extract_results(self) -> QueryResults:
+        """
+        Extract the top species and their alignments from the results page currently shown.
+        """
+        # * Once the results have been retrieved by the database, get the data
 
-        # Then select the first 5
-        species_results: List[BlastNCBIResults] = list()
+        # Select only the first "top_n" hits and read their rows, all in a single script call
+        with span("megablast.extract_hits"):
+            hit_rows = self.web_driver.execute_script(EXTRACT_HITS_SCRIPT, self.top_n)
 
-        sequence_error: bool = False
+        species_results: List[BlastNCBIResults] = parse_species(hit_rows)
 
-        for num in range(1, 6):
-            try:
-                WebDriverWait(self.web_driver, 10).until(
-                    EC.element_to_be_clickable((By.XPATH, f"//label[@for='chk_{num}']"))
-                ).click()
-                time.sleep(0.5 * TIMING_FACTOR)
-            except selenium.common.exceptions.TimeoutException:
-                logger.warning(
-                    f"Only found {num-1} species for current sequence. Saving all possible results..."
-                )
-                sequence_error = True
-                break
-
-            # Store the data for the selected species
-            specie_record = self.web_driver.find_element(By.XPATH, f"//tbody/tr[@ind='{num}']")
-
-            specie_description = specie_record.find_element(By.XPATH, "./td[@class='ellipsis c2']")
-            scientific_name = specie_record.find_element(By.XPATH, "./td[@class='ellipsis c3']")
-            max_score = specie_record.find_element(By.XPATH, "./td[@class='c6']").text
-            total_score = specie_record.find_element(By.XPATH, "./td[@class='c7']").text
-            query_cover = specie_record.find_element(By.XPATH, "./td[@class='c8']").text
-            e_value = specie_record.find_element(By.XPATH, "./td[@class='c9']").text
-            per_indentity = specie_record.find_element(By.XPATH, "./td[@class='c10']").text
-            accession_len = specie_record.find_element(By.XPATH, "./td[@class='c11 acclen']").text
-            accession = specie_record.find_element(By.XPATH, "./td[@class='c12 l lim']")
-
-            species_results.append(
-                BlastNCBIResults(
-                    description=specie_description.find_element(By.XPATH, "./span/a").text,
-                    description_url=specie_description.find_element(
-                        By.XPATH, "./span/a"
-                    ).get_attribute("href"),
-                    scientific_name=scientific_name.find_element(By.XPATH, "./span/a").text,
-                    scientific_name_url=scientific_name.find_element(
-                        By.XPATH, "./span/a"
-                    ).get_attribute("href"),
-                    max_score=max_score,
-                    total_score=total_score,
-                    query_cover=query_cover,
-                    e_value=e_value,
-                    per_indentity=per_indentity,
-                    accession_len=accession_len,
-                    accession=accession.find_element(By.XPATH, "./a").text,
-                    accession_url=accession.find_element(By.XPATH, "./a").get_attribute("href"),
-                )
+        sequence_error: bool = len(species_results) < self.top_n
+        if sequence_error:
+            logger.warning(
+                f"Only found {len(species_results)} species for current sequence. Saving all possible results..."
             )
 
+        # Hit rows must follow the ranking of the species, they are paired by position
+        alignments = self._extract_alignments()
+        ranked_alignments = alignments.ordered_by([specie.accession for specie in species_results])
+        if ranked_alignments is None:
+            logger.warning("Some species have no alignment row, alignments kept as shown")
+        else:
+            alignments = ranked_alignments
+
+        return species_results, alignments, sequence_error
+
+    @timed("megablast.extract_alignments")
+    def _extract_alignments(self) -> AlignmentMatrix:
+        """
+        Show the alignments in the "flat query-anchored with dots for identities" view and read
+        them.
+        """
         # Select the "Aligments" tab to extract the information of the sequences
-        WebDriverWait(self.web_driver, 20).until(
-            EC.element_to_be_clickable((By.XPATH, f"//button[contains(@class,'alignments')]"))
+        self.step_timer.wait(
+            self.web_driver,
+            "alignments tab",
+            EC.element_to_be_clickable((By.XPATH, f"//button[contains(@class,'alignments')]")),
         ).click()
-        time.sleep(0.5 * TIMING_FACTOR)
 
         # In the alignment view, select the "flat query-anchored with dots for identities" option
-        WebDriverWait(self.web_driver, 20).until(
+        self.step_timer.wait(
+            self.web_driver,
+            "alignment view option",
             EC.element_to_be_clickable(
                 (
                     By.XPATH,
                     f"//select[@name='ALIGNMENT_VIEW' and @id='alignViewSelect']/option[@value='FlatQueryAnchored']",
                 )
-            )
+            ),
+            replaced_sleep=0.5,
         ).click()
-        time.sleep(1.5 * TIMING_FACTOR)
 
-        # Get the characters of all aligments for the 5 species
-        num_query_ranges = len(self.web_driver.find_elements(By.XPATH, "//span[@class='alnRn']"))
-
-        logger.debug(f"{num_query_ranges = }")
-
-        species_align_dict: Dict[int, str] = dict()
-
-        for q_range in range(1, num_query_ranges + 1):
+        # The alignments are loaded in the background, wait for them and for the network to settle
+        self.step_timer.wait(
+            self.web_driver,
+            "query-anchored alignments",
+            EC.presence_of_element_located((By.XPATH, "//*[@id='qarow_1']")),
+            timeout=60,
+        )
+        self.step_timer.wait(
+            self.web_driver, "alignments network idle", network_idle(), replaced_sleep=1.5
+        )
 
-            # This is just the alignment of one of the query ranges for all 5 species
-            q_alignment = self.web_driver.find_element(
-                By.XPATH, f"//*[@id='qarow_{q_range}']"
-            ).text.split("\n")
+        # Get the characters of all aligments for the selected species in a single script call
+        alignment_rows = self.web_driver.execute_script(EXTRACT_ALIGNMENTS_SCRIPT)
+        logger.debug(f"num_query_ranges = {len(alignment_rows)}")
 
-            # Only get the offset from the queried unidentified specie (the sequence queried)
-            nucleotide_offset = min(
-                [
-                    q_alignment[0].find("A"),
-                    q_alignment[0].find("C"),
-                    q_alignment[0].find("G"),
-                    q_alignment[0].find("T"),
-                ]
-            )
-            logger.debug(f"{nucleotide_offset = }")
-
-            # For each alignment in the range, only get the sequence without the numbers or extra information
-            for specie_num, q_al in enumerate(q_alignment):
-                if q_range == 1:
-                    species_align_dict.update({specie_num: q_al[0 : nucleotide_offset + 60]})
-                else:
-                    species_align_dict[specie_num] += q_al[
-                        nucleotide_offset : nucleotide_offset + 60
-                    ]
-
-        return species_results, species_align_dict, sequence_error
+        return AlignmentMatrix.from_query_ranges(alignment_rows)
@@ -0,0 +1,320 @@
+from dataclasses import dataclass, field
+import json
+import re
+import time
+from typing import List, Optional, Tuple
+from urllib.parse import urlencode
+from urllib.request import Request, urlopen
+
+from loguru import logger
+import numpy as np
+
+from alignment import DOT, GAP, SPACE, AlignmentMatrix
+from blast_ncbi import BlastNCBIResults, QueryResults, is_cached, query_with_cache
+from metrics import timed
+from result_cache import ResultCache
+
+
+# Entrez query applied by the web form when "Uncultured/environmental sample sequences" is excluded
+EXCLUDE_UNCULTURED_QUERY = "all [filter] NOT(environmental samples[organism] OR metagenomes[orgn])"
+
+
+class BlastNCBIApiError(Exception):
+    pass
+
+
+@dataclass
+class BlastNCBIApi:
+    """
+    MEGABLAST backend that talks to the NCBI BLAST URL API over HTTP instead of driving a browser
+    (Put -> RID -> poll Get -> JSON2 results). It returns the same results as "BlastNCBI", so
+    both backends can be used interchangeably.
+
+    "base_url" can point to a local stand-in server that serves recorded responses.
+    """
+
+    base_url: str = field(default="https://blast.ncbi.nlm.nih.gov/Blast.cgi")
+    database: str = "nr"
+    exclude_uncultured: bool = True
+    top_n: int = 5
+    poll_interval: float = 60
+    max_wait: float = 3600
+    timeout: float = 60
+    tool: str = "Sequence_Analyzer_automations"
+    email: str = ""
+    cache: Optional[ResultCache] = None
+
+    @property
+    def cache_parameters(self) -> dict:
+        """
+        Query parameters that change the results, used in the result cache key. They match
+        those of "BlastNCBI", so both backends share cached results.
+        """
+        return {
+            "backend": "megablast",
+            "database": self.database,
+            "exclude_uncultured": self.exclude_uncultured,
+            "top_n": self.top_n,
+        }
+
+    def configure_browser(self, download_path: str, driver_path: str = "") -> None:
+        """
+        Nothing to configure, kept so the backend can replace "BlastNCBI" directly.
+        """
+
+    def quit(self) -> None:
+        """
+        Nothing to close, kept so the backend can replace "BlastNCBI" directly.
+        """
+
+    def is_cached(self, sequence: str, crop: Optional[Tuple[int, int]] = None) -> bool:
+        """
+        Whether the results of a sequence, or of its "crop" window, are in the result cache.
+        """
+        return is_cached(self.cache, self.cache_parameters, sequence, crop)
+
+    def query_sequence(
+        self, sequence: str, crop: Optional[Tuple[int, int]] = None
+    ) -> QueryResults:
+        """
+        Query one sequence, or its "crop" window, to MEGABLAST. Returns the top species found,
+        their alignments and whether an error occurred finding similar species.
+        """
+        return self.query_batch(sequences=[sequence], crop=crop)[0]
+
+    @timed("megablast_api.query_batch")
+    def query_batch(
+        self, sequences: List[str], crop: Optional[Tuple[int, int]] = None
+    ) -> List[QueryResults]:
+        """
+        Query several sequences, or their "crop" window, to MEGABLAST in a single job. Returns
+        one (species, alignments, error) tuple per sequence, in the same order as "sequences".
+        Sequences found in the result cache are not submitted.
+        """
+        return query_with_cache(
+            cache=self.cache,
+            cache_parameters=self.cache_parameters,
+            sequences=sequences,
+            crop=crop,
+            query_function=self._query_remote,
+        )
+
+    def _query_remote(self, sequences: List[str]) -> List[QueryResults]:
+        """
+        Submit the sequences in one MEGABLAST job and parse the results of each of them.
+        """
+        fasta_query = "\n".join(
+            f">query_{num}\n{sequence}" for num, sequence in enumerate(sequences, start=1)
+        )
+
+        rid, rtoe = self.submit(query=fasta_query)
+        self.wait_for_results(rid=rid, rtoe=rtoe)
+        reports = self.fetch_reports(rid=rid)
+
+        if len(reports) != len(sequences):
+            raise BlastNCBIApiError(
+                f"Expected {len(sequences)} query reports for RID {rid} and got {len(reports)}"
+            )
+
+        return [
+            self.parse_report(report=report, query=sequence, rid=rid)
+            for report, sequence in zip(reports, sequences)
+        ]
+
+    @timed("megablast_api.submit")
+    def submit(self, query: str) -> Tuple[str, int]:
+        """
+        Submit a MEGABLAST job. Returns the request ID (RID) and the estimated time in seconds
+        until the results are ready (RTOE).
+        """
+        parameters = {
+            "CMD": "Put",
+            "PROGRAM": "blastn",
+            "MEGABLAST": "on",
+            "DATABASE": self.database,
+            "QUERY": query,
+            "HITLIST_SIZE": self.top_n,
+        }
+        if self.exclude_uncultured:
+            parameters["ENTREZ_QUERY"] = EXCLUDE_UNCULTURED_QUERY
+
+        logger.info("Submitting query to the BLAST URL API...")
+        response = self._request(parameters, method="POST")
+
+        rid = re.search(r"^\s*RID = (\S+)", response, re.MULTILINE)
+        rtoe = re.search(r"^\s*RTOE = (\d+)", response, re.MULTILINE)
+        if rid is None:
+            raise BlastNCBIApiError("No RID found in the BLAST URL API response")
+
+        logger.info(f"Query submitted with RID {rid.group(1)}")
+        return rid.group(1), int(rtoe.group(1)) if rtoe else 0
+
+    def get_status(self, rid: str) -> str:
+        """
+        Return the status of a submitted job: WAITING, READY, FAILED or UNKNOWN.
+        """
+        response = self._request({"CMD": "Get", "FORMAT_OBJECT": "SearchInfo", "RID": rid})
+
+        status = re.search(r"Status=(\w+)", response)
+        return status.group(1) if status else "UNKNOWN"
+
+    @timed("megablast_api.queue_wait")
+    def wait_for_results(self, rid: str, rtoe: int = 0) -> None:
+        """
+        Poll the status of a job until its results are ready.
+        """
+        start = time.monotonic()
+
+        # NCBI does not have the results before the estimated time, no need to ask sooner
+        time.sleep(min(rtoe, self.max_wait))
+
+        while True:
+            status = self.get_status(rid=rid)
+
+            if status == "READY":
+                return
+            if status in ("FAILED", "UNKNOWN"):
+                raise BlastNCBIApiError(f"BLAST job {rid} finished with status {status}")
+            if time.monotonic() - start > self.max_wait:
+                raise BlastNCBIApiError(f"BLAST job {rid} not ready after {self.max_wait} seconds")
+
+            logger.debug(f"Waiting {self.poll_interval} seconds until receiving results from NCBI...")
+            time.sleep(self.poll_interval)
+
+    @timed("megablast_api.fetch_reports")
+    def fetch_reports(self, rid: str) -> List[dict]:
+        """
+        Download the results of a finished job, one JSON2 report per query.
+        """
+        response = self._request(
+            {
+                "CMD": "Get",
+                "RID": rid,
+                "FORMAT_TYPE": "JSON2_S",
+                "DESCRIPTIONS": self.top_n,
+                "ALIGNMENTS": self.top_n,
+            }
+        )
+
+        return [output["report"] for output in json.loads(response)["BlastOutput2"]]
+
+    @timed("megablast_api.parse_report")
+    def parse_report(self, report: dict, query: str, rid: str) -> QueryResults:
+        """
+        Convert a JSON2 report into the top species, their alignments and the error flag, with
+        the same format as the values scraped by "BlastNCBI".
+        """
+        search = report["results"]["search"]
+        query_len = search.get("query_len", len(query))
+        hits = search.get("hits", [])[: self.top_n]
+
+        species_results: List[BlastNCBIResults] = list()
+        for hit in hits:
+            description = hit["description"][0]
+            hsps = hit["hsps"]
+            best_hsp = max(hsps, key=lambda hsp: hsp["bit_score"])
+
+            accession = _versioned_accession(description)
+            query_cover = _covered_positions(hsps) / query_len * 100
+            per_identity = best_hsp["identity"] / best_hsp["align_len"] * 100
+
+            species_results.append(
+                BlastNCBIResults(
+                    description=description["title"],
+                    description_url=f"{self.base_url}?CMD=Get&RID={rid}#alnHdr_{accession}",
+                    scientific_name=description.get("sciname", ""),
+                    scientific_name_url=(
+                        "https://www.ncbi.nlm.nih.gov/Taxonomy/Browser/wwwtax.cgi"
+                        f"?id={description.get('taxid', '')}"
+                    ),
+                    max_score=round(best_hsp["bit_score"]),
+                    total_score=round(sum(hsp["bit_score"] for hsp in hsps)),
+                    query_cover=query_cover,
+                    e_value=best_hsp["evalue"],
+                    per_indentity=per_identity,
+                    accession_len=hit["len"],
+                    accession=accession,
+                    accession_url=(
+                        f"https://www.ncbi.nlm.nih.gov/nucleotide/{accession}"
+                        f"?report=genbank&log$=nucltop&blast_rank={hit['num']}&RID={rid}"
+                    ),
+                )
+            )
+
+        if len(hits) < self.top_n:
+            logger.warning(
+                f"Only found {len(hits)} species for current sequence. Saving all possible results..."
+            )
+
+        return species_results, render_flat_query_anchored(query, hits), len(hits) < self.top_n
+
+    def _request(self, parameters: dict, method: str = "GET") -> str:
+        """
+        Send a request to the BLAST URL API and return the body of the response.
+        """
+        parameters = dict(parameters, tool=self.tool)
+        if self.email:
+            parameters["email"] = self.email
+
+        data = urlencode(parameters)
+        if method == "POST":
+            request = Request(self.base_url, data=data.encode(), method="POST")
+        else:
+            request = Request(f"{self.base_url}?{data}")
+
+        with urlopen(request, timeout=self.timeout) as response:
+            return response.read().decode()
+
+
+def render_flat_query_anchored(query: str, hits: List[dict]) -> AlignmentMatrix:
+    """
+    Build the alignments of the hits in the "flat query-anchored with dots for identities" view:
+    row 0 is the query and every other row a hit, where identities are shown as dots, and
+    positions not aligned to the hit as spaces. Insertions in the hit are not shown.
+    """
+    query = query.upper()
+    matrix = np.full((len(hits) + 1, len(query)), SPACE, dtype=np.uint8)
+    matrix[0] = np.frombuffer(query.encode("ascii"), dtype=np.uint8)
+
+    for hit_num, hit in enumerate(hits, start=1):
+        for hsp in hit["hsps"]:
+            query_bases = np.frombuffer(hsp["qseq"].encode("ascii"), dtype=np.uint8)
+            hit_bases = np.frombuffer(hsp["hseq"].encode("ascii"), dtype=np.uint8)
+
+            # Insertions in the hit have no query position to anchor them to
+            anchored = query_bases != GAP
+            query_bases, hit_bases = query_bases[anchored], hit_bases[anchored]
+
+            start = hsp["query_from"] - 1
+            matrix[hit_num, start : start + len(query_bases)] = np.where(
+                hit_bases == query_bases, DOT, hit_bases
+            )
+
+    labels = ["Query"] + [_versioned_accession(hit["description"][0]) for hit in hits]
+    return AlignmentMatrix(labels=labels, matrix=matrix, query_start=1, query_end=len(query))
+
+
+def _versioned_accession(description: dict) -> str:
+    """
+    Return the accession with its version (e.g. MK312485.1) from a JSON2 hit description.
+    """
+    accession = description.get("accession", "")
+    for id_part in description.get("id", "").split("|"):
+        if id_part.startswith(f"{accession}."):
+            return id_part
+
+    return accession
+
+
+def _covered_positions(hsps: List[dict]) -> int:
+    """
+    Number of query positions covered by at least one HSP.
+    """
+    covered = 0
+    last_end = 0
+    for start, end in sorted((hsp["query_from"], hsp["query_to"]) for hsp in hsps):
+        if end > last_end:
+            covered += end - max(start - 1, last_end)
+            last_end = end
+
+    return covered
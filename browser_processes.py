@@ -0,0 +1,368 @@
+from dataclasses import dataclass, field
+import atexit
+import json
+import os
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+from loguru import logger
+from selenium.webdriver.remote.webdriver import WebDriver
+
+# Processes of every live browser session, so those of a crashed run can be found by the next one
+REGISTRY_DIR = os.path.join(tempfile.gettempdir(), "sequence_analyzer_browsers")
+
+# Process table: PID -> (parent PID, start time). The start time tells a process apart from a
+# later one that reused its PID
+ProcessTable = Dict[int, Tuple[int, str]]
+
+
+def process_table() -> ProcessTable:
+    """
+    Parent and start time of every running process, read from /proc on Linux, from CIM on
+    Windows and from "ps" on other systems.
+    """
+    if sys.platform.startswith("linux"):
+        return _linux_process_table()
+    if sys.platform == "win32":
+        return _windows_process_table()
+
+    return _ps_process_table()
+
+
+def _linux_process_table() -> ProcessTable:
+    table: ProcessTable = dict()
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+
+        try:
+            with open(f"/proc/{entry}/stat") as file:
+                stat = file.read()
+        except OSError:
+            # The process finished while listing them
+            continue
+
+        # The command name (2nd field) may contain spaces, fields are counted after it
+        fields = stat[stat.rindex(")") + 2 :].split()
+        # Zombies already exited, they are only waiting for their parent to reap them
+        if fields[0] != "Z":
+            table[int(entry)] = (int(fields[1]), fields[19])
+
+    return table
+
+
+def _windows_process_table() -> ProcessTable:
+    output = subprocess.run(
+        [
+            "powershell",
+            "-NoProfile",
+            "-Command",
+            "Get-CimInstance Win32_Process | ForEach-Object "
+            '{ "$($_.ProcessId) $($_.ParentProcessId) $($_.CreationDate.Ticks)" }',
+        ],
+        capture_output=True,
+        text=True,
+        check=True,
+    ).stdout
+
+    table: ProcessTable = dict()
+    for line in output.splitlines():
+        values = line.split()
+        if len(values) == 3:
+            table[int(values[0])] = (int(values[1]), values[2])
+
+    return table
+
+
+def _ps_process_table() -> ProcessTable:
+    output = subprocess.run(
+        ["ps", "-A", "-o", "pid=", "-o", "ppid=", "-o", "lstart="],
+        capture_output=True,
+        text=True,
+        check=True,
+    ).stdout
+
+    table: ProcessTable = dict()
+    for line in output.splitlines():
+        values = line.split(maxsplit=2)
+        if len(values) == 3:
+            table[int(values[0])] = (int(values[1]), values[2].strip())
+
+    return table
+
+
+def descendants(pid: int, table: ProcessTable) -> List[int]:
+    """
+    PIDs of all the processes started by "pid", directly or not.
+    """
+    children: Dict[int, List[int]] = dict()
+    for child, (parent, _) in table.items():
+        children.setdefault(parent, []).append(child)
+
+    found: List[int] = list()
+    pending = list(children.get(pid, []))
+    while pending:
+        child = pending.pop()
+        if child not in found:
+            found.append(child)
+            pending.extend(children.get(child, []))
+
+    return found
+
+
+def terminate_processes(processes: Dict[int, str], timeout: float = 5) -> List[int]:
+    """
+    Terminate the processes (PID -> start time) that are still running, asking them to exit
+    first and killing them if they don't within "timeout" seconds. Processes whose PID is now
+    used by another process are left alone. Returns the PIDs terminated.
+    """
+
+    def running() -> List[int]:
+        table = process_table()
+        return [pid for pid, start in processes.items() if pid in table and table[pid][1] == start]
+
+    pids = running()
+    if not pids:
+        return []
+
+    if sys.platform == "win32":
+        for pid in pids:
+            subprocess.run(["TASKKILL", "/F", "/PID", str(pid)], capture_output=True)
+        return pids
+
+    for pid in pids:
+        _send_signal(pid, signal.SIGTERM)
+
+    deadline = time.monotonic() + timeout
+    remaining = running()
+    while remaining and time.monotonic() < deadline:
+        time.sleep(0.1)
+        remaining = running()
+
+    for pid in remaining:
+        _send_signal(pid, signal.SIGKILL)
+
+    return pids
+
+
+def _send_signal(pid: int, signal_number: int) -> None:
+    try:
+        os.kill(pid, signal_number)
+    except (ProcessLookupError, PermissionError):
+        pass
+
+
+@dataclass
+class BrowserProcessTree:
+    """
+    Processes of one browser session: the driver process started by Selenium ("root_pid") and
+    every process it started (the browser and its renderers, GPU and utility processes).
+
+    Known processes are kept even after the driver exits and they are reparented, so "terminate"
+    only ends what belongs to this session, never other browsers of the machine. They are also
+    recorded in a registry file, so the processes left by a run that crashed are found later.
+    """
+
+    root_pid: int
+    processes: Dict[int, str] = field(default_factory=dict)
+    registry_file: str = field(init=False)
+    _lock: threading.Lock = field(init=False, default_factory=threading.Lock)
+
+    def __post_init__(self) -> None:
+        os.makedirs(REGISTRY_DIR, exist_ok=True)
+        self.registry_file = os.path.join(REGISTRY_DIR, f"{os.getpid()}_{self.root_pid}.json")
+        self.refresh()
+
+    @classmethod
+    def from_web_driver(cls, web_driver: WebDriver) -> "BrowserProcessTree":
+        return cls(root_pid=web_driver.service.process.pid)
+
+    @property
+    def root_alive(self) -> bool:
+        table = process_table()
+        return self.root_pid in table and table[self.root_pid][1] == self.processes.get(
+            self.root_pid
+        )
+
+    def refresh(self) -> None:
+        """
+        Add the processes started since the last refresh and save them in the registry.
+        """
+        table = process_table()
+        with self._lock:
+            if not self.processes and self.root_pid in table:
+                self.processes[self.root_pid] = table[self.root_pid][1]
+
+            for pid in list(self.processes):
+                if pid not in table or table[pid][1] != self.processes[pid]:
+                    continue
+                for child in descendants(pid, table):
+                    self.processes.setdefault(child, table[child][1])
+
+            registry = {
+                "owner_pid": os.getpid(),
+                "owner_start": table.get(os.getpid(), (0, ""))[1],
+                "processes": {str(pid): start for pid, start in self.processes.items()},
+            }
+
+        with open(self.registry_file, "w") as file:
+            json.dump(registry, file)
+
+    def terminate(self, timeout: float = 5) -> List[int]:
+        """
+        Terminate the processes of the session still running and remove it from the registry.
+        Returns the PIDs terminated.
+        """
+        with self._lock:
+            processes = dict(self.processes)
+
+        terminated = terminate_processes(processes, timeout=timeout)
+        if terminated:
+            logger.info(f"Terminated {len(terminated)} leftover browser processes {terminated}")
+
+        try:
+            os.remove(self.registry_file)
+        except FileNotFoundError:
+            pass
+
+        return terminated
+
+
+@dataclass
+class ProcessWatchdog:
+    """
+    Watches the browser process trees of the sessions of this run. Every "interval" seconds it
+    records the new processes of every tree and, when the driver of a tree died without its
+    session being closed, terminates the browser processes it left behind. Trees still open
+    when the interpreter exits are terminated too.
+
+    When it starts, it terminates the processes registered by runs that are no longer alive.
+    """
+
+    interval: float = 30
+    _trees: List[BrowserProcessTree] = field(init=False, default_factory=list)
+    _lock: threading.Lock = field(init=False, default_factory=threading.Lock)
+    _thread: Optional[threading.Thread] = field(init=False, default=None)
+
+    def track(self, tree: BrowserProcessTree) -> None:
+        with self._lock:
+            self._trees.append(tree)
+            start = self._thread is None
+            if start:
+                self._thread = threading.Thread(
+                    target=self._run, name="process_watchdog", daemon=True
+                )
+
+        if start:
+            self.reap_orphans()
+            atexit.register(self.terminate_all)
+            self._thread.start()
+
+    def untrack(self, tree: BrowserProcessTree) -> None:
+        with self._lock:
+            if tree in self._trees:
+                self._trees.remove(tree)
+
+    def terminate_all(self) -> None:
+        with self._lock:
+            trees, self._trees = self._trees, list()
+
+        for tree in trees:
+            tree.terminate()
+
+    def check(self) -> None:
+        """
+        Refresh every tree and terminate those whose driver is no longer running.
+        """
+        with self._lock:
+            trees = list(self._trees)
+
+        for tree in trees:
+            if tree.root_alive:
+                tree.refresh()
+                continue
+
+            logger.warning(f"Driver process {tree.root_pid} died, terminating its browser")
+            self.untrack(tree)
+            tree.terminate()
+
+    def reap_orphans(self) -> int:
+        """
+        Terminate the processes registered by sessions of runs that are no longer alive (e.g.
+        they crashed or were killed). Returns the number of processes terminated.
+        """
+        if not os.path.isdir(REGISTRY_DIR):
+            return 0
+
+        table = process_table()
+        num_terminated = 0
+        for file_name in os.listdir(REGISTRY_DIR):
+            registry_file = os.path.join(REGISTRY_DIR, file_name)
+            try:
+                with open(registry_file) as file:
+                    registry = json.load(file)
+            except (OSError, ValueError):
+                continue
+
+            owner = table.get(registry["owner_pid"])
+            if owner is not None and owner[1] == registry["owner_start"]:
+                continue
+
+            processes = {int(pid): start for pid, start in registry["processes"].items()}
+            terminated = terminate_processes(processes)
+            if terminated:
+                logger.warning(
+                    f"Terminated {len(terminated)} orphaned browser processes of run "
+                    f"{registry['owner_pid']}"
+                )
+            num_terminated += len(terminated)
+
+            try:
+                os.remove(registry_file)
+            except FileNotFoundError:
+                pass
+
+        return num_terminated
+
+    def _run(self) -> None:
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.check()
+            except Exception:
+                logger.exception("Process watchdog check failed")
+
+
+# Watchdog of every browser session of the run
+WATCHDOG = ProcessWatchdog()
+
+
+def track_browser(web_driver: WebDriver) -> BrowserProcessTree:
+    """
+    Start tracking the process tree of a new browser session with the run watchdog.
+    """
+    tree = BrowserProcessTree.from_web_driver(web_driver)
+    WATCHDOG.track(tree)
+
+    return tree
+
+
+def close_browser(web_driver: WebDriver, tree: BrowserProcessTree) -> None:
+    """
+    Quit a browser session and terminate whatever is left of its process tree, without touching
+    other browsers of the machine.
+    """
+    # Record the processes started since the last check, they are reparented once the driver exits
+    tree.refresh()
+    WATCHDOG.untrack(tree)
+
+    try:
+        # Quitting the webdriver already waits until the browser has been closed
+        web_driver.quit()
+    finally:
+        tree.terminate()
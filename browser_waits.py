@@ -0,0 +1,138 @@
+from dataclasses import dataclass, field
+import time
+from typing import Any, Callable, Dict, List, Tuple
+
+from loguru import logger
+from selenium.webdriver.chrome.webdriver import WebDriver
+from selenium.webdriver.support.ui import WebDriverWait
+
+# Scales every step timeout, increase it on slow connections
+TIMING_FACTOR = 1
+
+# How often the readiness conditions are checked, in seconds
+POLL_FREQUENCY = 0.1
+
+
+def document_ready(web_driver: WebDriver) -> bool:
+    """
+    Condition satisfied once the current page has finished loading.
+    """
+    return web_driver.execute_script("return document.readyState") == "complete"
+
+
+@dataclass
+class network_idle:
+    """
+    Condition satisfied once the page has finished loading and no new network request has been
+    made for "idle_time" seconds (XHR/fetch requests included).
+    """
+
+    idle_time: float = 0.5
+    _num_requests: int = field(init=False, default=-1)
+    _idle_since: float = field(init=False, default=0.0)
+
+    def __call__(self, web_driver: WebDriver) -> bool:
+        num_requests = web_driver.execute_script(
+            "return document.readyState === 'complete' ? "
+            "performance.getEntriesByType('resource').length : -1"
+        )
+
+        now = time.monotonic()
+        if num_requests < 0 or num_requests != self._num_requests:
+            self._num_requests = num_requests
+            self._idle_since = now
+            return False
+
+        return now - self._idle_since >= self.idle_time
+
+
+@dataclass
+class StepTotals:
+    """
+    Number of waits of a step, their total time and the total fixed sleep they replaced.
+    "removed" only counts the waits that replaced a sleep.
+    """
+
+    num_waits: int = 0
+    elapsed: float = 0.0
+    replaced_sleep: float = 0.0
+    removed: float = 0.0
+
+    def add(self, elapsed: float, replaced_sleep: float) -> None:
+        self.num_waits += 1
+        self.elapsed += elapsed
+        self.replaced_sleep += replaced_sleep
+        if replaced_sleep > 0:
+            self.removed += replaced_sleep - elapsed
+
+
+@dataclass
+class StepTimer:
+    """
+    Waits for the readiness condition of every step of a browser flow, recording how long each
+    wait took. The fixed sleep that each wait replaced is kept to report how much latency was
+    removed. Waits are added up per step, so a long session keeps one entry per step.
+    """
+
+    steps: Dict[str, StepTotals] = field(default_factory=dict)
+
+    def wait(
+        self,
+        web_driver: WebDriver,
+        step: str,
+        condition: Callable[[WebDriver], Any],
+        timeout: float = 20,
+        replaced_sleep: float = 0.0,
+    ) -> Any:
+        """
+        Wait until "condition" is satisfied (at most "timeout" seconds, scaled by
+        "TIMING_FACTOR") and return its value. Raises a TimeoutException naming the step
+        otherwise.
+        """
+        timeout = timeout * TIMING_FACTOR
+        start = time.monotonic()
+        try:
+            return WebDriverWait(web_driver, timeout, poll_frequency=POLL_FREQUENCY).until(
+                condition, message=f"Step '{step}' not ready after {timeout} seconds"
+            )
+        finally:
+            self.steps.setdefault(step, StepTotals()).add(
+                elapsed=time.monotonic() - start, replaced_sleep=replaced_sleep
+            )
+
+    def report(self) -> str:
+        """
+        Table with the number of waits, the mean wait and the mean fixed sleep replaced per step,
+        followed by the total latency removed.
+        """
+        lines = [f"{'Step':<40}{'Waits':>7}{'Mean wait (s)':>15}{'Fixed sleep (s)':>17}"]
+        for step, totals in self.steps.items():
+            mean_elapsed = totals.elapsed / totals.num_waits
+            mean_sleep = totals.replaced_sleep / totals.num_waits
+            lines.append(f"{step:<40}{totals.num_waits:>7}{mean_elapsed:>15.2f}{mean_sleep:>17.2f}")
+
+        removed = sum(totals.removed for totals in self.steps.values())
+        lines.append(f"Latency removed compared to fixed sleeps: {removed:.2f} s")
+
+        return "\n".join(lines)
+
+    def log_report(self) -> None:
+        if self.steps:
+            logger.info(f"Browser step timings:\n{self.report()}")
+
+
+@dataclass
+class any_element_located:
+    """
+    Condition satisfied once any of the "locators" finds an element, returning the first one.
+    """
+
+    locators: List[Tuple[str, str]]
+
+    def __call__(self, web_driver: WebDriver) -> Any:
+        for locator in self.locators:
+            elements = web_driver.find_elements(*locator)
+            if elements:
+                return elements[0]
+
+        return False
@@ -0,0 +1,101 @@
+from dataclasses import replace
+import math
+from typing import Optional, Tuple
+
+import numpy as np
+from loguru import logger
+
+from blast_ncbi import QueryResults
+
+# MEGABLAST default scoring: reward 1, penalty -2 and linear gap costs of 2.5 per column
+MATCH_REWARD = 1
+MISMATCH_PENALTY = -2
+GAP_COST = 2.5
+
+# Karlin-Altschul parameters of that scoring system, to convert raw scores to bit scores
+KARLIN_LAMBDA = 1.28
+KARLIN_K = 0.46
+
+
+def bit_score(raw_score: np.ndarray) -> np.ndarray:
+    return (KARLIN_LAMBDA * raw_score - math.log(KARLIN_K)) / math.log(2)
+
+
+def derive_crop_results(
+    full_results: QueryResults,
+    window: Tuple[int, int],
+    query_length: int,
+    tolerance_bits: float = 2.0,
+) -> Optional[QueryResults]:
+    """
+    Recompute the results of a crop window ("sequence[start:end]") from the flat query-anchored
+    alignment of the full sequence, instead of querying the crop to MEGABLAST again. Returns the
+    (species, alignments, error) of the crop, or None when the local derivation can't be trusted
+    and the crop must be queried remotely:
+
+    - Not every hit has a single HSP that covers the whole window.
+    - The recomputed scores would reorder the hits.
+    - The last hit lost more score than the others (by more than "tolerance_bits"), so hits
+      outside the top N of the full query could overtake it in the crop query.
+    """
+    species_results, alignments, error = full_results
+
+    alignments = alignments.ordered_by([specie.accession for specie in species_results])
+    if not species_results or alignments is None:
+        logger.debug("Crop not derived locally: alignments don't match the hits")
+        return None
+
+    # A hit with several HSPs may be aligned differently when the query is cropped
+    if any(specie.max_score != specie.total_score for specie in species_results):
+        logger.debug("Crop not derived locally: some hits have several HSPs")
+        return None
+
+    crop_alignments = alignments.crop(window)
+    crop_length = crop_alignments.query_end - crop_alignments.query_start + 1
+    if crop_length != window[1] - window[0]:
+        logger.debug("Crop not derived locally: window outside of the aligned query")
+        return None
+
+    aligned = crop_alignments.aligned()
+    if not aligned.all():
+        logger.debug("Crop not derived locally: some hits don't cover the whole window")
+        return None
+
+    matches = crop_alignments.matches().sum(axis=1)
+    mismatches = crop_alignments.mismatches().sum(axis=1)
+    gaps = crop_alignments.gaps().sum(axis=1)
+
+    crop_bits = bit_score(matches * MATCH_REWARD + mismatches * MISMATCH_PENALTY - gaps * GAP_COST)
+    full_bits = np.array([specie.max_score for specie in species_results], dtype=float)
+
+    # Hits must keep their ranking (ties allowed)
+    if np.any(np.diff(crop_bits) > 0):
+        logger.debug("Crop not derived locally: the hit ranking would change")
+        return None
+
+    # Hits below the top N lose at least as much as the hits shown, unless the last one lost more
+    lost_bits = full_bits - crop_bits
+    if not error and lost_bits[-1] > lost_bits.min() + tolerance_bits:
+        logger.debug("Crop not derived locally: hits outside the top N could overtake the last one")
+        return None
+
+    identity = crop_alignments.identity()
+    crop_species = list()
+    for specie, bits, lost, per_identity in zip(species_results, crop_bits, lost_bits, identity):
+        # E-values scale with the query length and exponentially with the bit score. MEGABLAST
+        # shows 0.0 for e-values too small to represent, they are kept as they are
+        e_value = specie.e_value * 2 ** lost * crop_length / query_length if specie.e_value else 0.0
+
+        crop_species.append(
+            replace(
+                specie,
+                max_score=round(bits),
+                total_score=round(bits),
+                query_cover=100.0,
+                e_value=float(e_value),
+                per_indentity=float(per_identity),
+            )
+        )
+
+    logger.info(f"Crop {window[0]}-{window[1]} derived locally from the full alignment")
+    return crop_species, crop_alignments, error
@@ -1,84 +1,106 @@
+from copy import deepcopy
+import csv
+from dataclasses import dataclass, field
+from functools import lru_cache
+from html import escape
 import os
-from typing import List, Dict
+import threading
+from typing import Any, List, Tuple
 from loguru import logger
+from alignment import AlignmentMatrix
 from blast_ncbi import BlastNCBIResults
+from hit_table import HitTable
+from metrics import timed
 
 import docx
-from docx.enum.dml import MSO_THEME_COLOR_INDEX
 
+# Attributes shown as table columns (their "_url" counterparts become hyperlinks) and the names
+# of those columns, computed once
+COLUMN_ATTRIBUTES = [name for name in BlastNCBIResults.__annotations__.keys() if "url" not in name]
+COLUMN_NAMES = [name.replace("_", " ").capitalize() for name in COLUMN_ATTRIBUTES]
 
-def add_hyperlink(paragraph, url, text):
 
-    # This gets access to the document.xml.rels file and gets a new relation id value
-    part = paragraph.part
-    r_id = part.relate_to(url, docx.opc.constants.RELATIONSHIP_TYPE.HYPERLINK, is_external=True)
-
-    # Create the w:hyperlink tag and add needed values
+@lru_cache(maxsize=None)
+def hyperlink_template():
+    """
+    Build (only once) the w:hyperlink element copied for every link: a run styled as a hyperlink
+    (the theme hyperlink color, underlined) with an empty w:t element for the text.
+    """
     hyperlink = docx.oxml.shared.OxmlElement("w:hyperlink")
-    hyperlink.set(
-        docx.oxml.shared.qn("r:id"),
-        r_id,
-    )
 
-    # Create a w:r element
+    # Create a w:r element with the hyperlink style
     new_run = docx.oxml.shared.OxmlElement("w:r")
     rPr = docx.oxml.shared.OxmlElement("w:rPr")
 
-    # Join all the xml elements together add add the required text to the w:r element
+    # A workaround for the lack of a hyperlink style (doesn't go purple after using the link)
+    color = docx.oxml.shared.OxmlElement("w:color")
+    color.set(docx.oxml.shared.qn("w:val"), "0563C1")
+    color.set(docx.oxml.shared.qn("w:themeColor"), "hyperlink")
+    underline = docx.oxml.shared.OxmlElement("w:u")
+    underline.set(docx.oxml.shared.qn("w:val"), "single")
+    rPr.append(color)
+    rPr.append(underline)
+
+    text = docx.oxml.shared.OxmlElement("w:t")
+    text.set(docx.oxml.shared.qn("xml:space"), "preserve")
+
+    # Join all the xml elements together
     new_run.append(rPr)
-    new_run.text = text
+    new_run.append(text)
     hyperlink.append(new_run)
 
-    # Create a new Run object and add the hyperlink into it
-    r = paragraph.add_run()
-    r._r.append(hyperlink)
+    return hyperlink
 
-    # A workaround for the lack of a hyperlink style (doesn't go purple after using the link)
-    # Delete this if using a template that has the hyperlink style in it
-    r.font.color.theme_color = MSO_THEME_COLOR_INDEX.HYPERLINK
-    r.font.underline = True
 
-    return hyperlink
+def add_hyperlink(paragraph, url, text):
 
+    # This gets access to the document.xml.rels file and gets a new relation id value
+    part = paragraph.part
+    r_id = part.relate_to(url, docx.opc.constants.RELATIONSHIP_TYPE.HYPERLINK, is_external=True)
 
-def save_results_in_word(path: str, file_name: str, species: List[BlastNCBIResults]):
-    # Extract names to be added to the Word document table columns
-    column_names = [
-        name.replace("_", " ").capitalize()
-        for name in species[0].__annotations__.keys()
-        if "url" not in name
-    ]
+    # Copy the w:hyperlink template and add needed values
+    hyperlink = deepcopy(hyperlink_template())
+    hyperlink.set(docx.oxml.shared.qn("r:id"), r_id)
+    hyperlink[0][-1].text = text
 
-    # Create an instance of a word document
-    doc = docx.Document()
+    paragraph._p.append(hyperlink)
+
+    return hyperlink
 
-    # Add a Title to the document
-    doc.add_heading("Sequences producing significant alignments", 0)
 
+def add_species_table(doc, species: List[BlastNCBIResults]):
+    """
+    Add to "doc" a table with a row per specie. Attributes with an "_url" counterpart are added as
+    hyperlinks.
+    """
     # Creating a table object
-    table = doc.add_table(rows=1, cols=len(column_names), style="Table Grid")
+    table = doc.add_table(rows=1, cols=len(COLUMN_NAMES), style="Table Grid")
 
     # Adding heading in the 1st row of the table
-    for cell, column_name in zip(table.rows[0].cells, column_names):
+    for cell, column_name in zip(table.rows[0].cells, COLUMN_NAMES):
         cell.text = column_name
 
-    attr_names = [name for name in species[0].__annotations__.keys() if "url" not in name]
     for specie in species:
+        for attribute, cell in zip(COLUMN_ATTRIBUTES, table.add_row().cells):
+            href = getattr(specie, f"{attribute}_url", None)
+            if href:
+                add_hyperlink(cell.paragraphs[0], href, specie.display_value(attribute))
+            else:
+                # If the attribute has no _url, then simply add the text to the table cell
+                cell.text = specie.display_value(attribute)
 
-        for attribute, cell in zip(attr_names, table.add_row().cells):
+    return table
 
-            # Try to add hyperlink
-            try:
-                href = getattr(specie, f"{attribute}_url")
-                p_table = cell.add_paragraph()
-                add_hyperlink(p_table, href, getattr(specie, attribute))
-                exist_link = True
-            except AttributeError:
-                exist_link = False
 
-            # If the attribute has no _url, then simply add the text to the table cell
-            if not exist_link:
-                cell.text = getattr(specie, attribute)
+@timed("data_saver.save_results_in_word")
+def save_results_in_word(path: str, file_name: str, species: List[BlastNCBIResults]):
+    # Create an instance of a word document
+    doc = docx.Document()
+
+    # Add a Title to the document
+    doc.add_heading("Sequences producing significant alignments", 0)
+
+    add_species_table(doc, species)
 
     # Create directories in disk memory
     if not os.path.exists(path):
@@ -88,15 +110,130 @@ def save_results_in_word(path: str, file_name: str, species: List[BlastNCBIResul
     doc.save(f"{path}/{file_name}.docx")
 
 
-def save_alignments_to_notes(path: str, file_name: str, alignments: Dict[str, str]):
+@dataclass
+class PlateReport:
+    """
+    Single report of a plate, with a section (heading and species table) per sequence and crop.
+    Sections are added to the document in memory as results arrive, from any thread, and the
+    files are written once by "save": the .docx and, optionally, an HTML page and a CSV table.
+    """
+
+    path: str
+    file_name: str
+    html: bool = False
+    csv: bool = False
+    _document: Any = field(init=False)
+    _sections: List[Tuple[str, List[BlastNCBIResults]]] = field(init=False, default_factory=list)
+    _lock: threading.Lock = field(init=False, default_factory=threading.Lock)
+
+    def __post_init__(self) -> None:
+        self._document = docx.Document()
+        self._document.add_heading("Sequences producing significant alignments", 0)
+
+    @property
+    def num_sections(self) -> int:
+        return len(self._sections)
+
+    def hit_table(self) -> HitTable:
+        """
+        Hits of every section added so far, as a table to sort, filter and aggregate.
+        """
+        with self._lock:
+            return HitTable.from_results(self._sections)
+
+    @timed("data_saver.report_add_results")
+    def add_results(self, section: str, species: List[BlastNCBIResults]) -> None:
+        """
+        Append a section titled "section" with the species table of a query.
+        """
+        with self._lock:
+            self._sections.append((section, list(species)))
+
+            self._document.add_heading(section, level=1)
+            if species:
+                add_species_table(self._document, species)
+            else:
+                self._document.add_paragraph("No significant similarity found")
+
+    @timed("data_saver.report_save")
+    def save(self) -> List[str]:
+        """
+        Write the report files. Returns their paths.
+        """
+        # Create directories in disk memory
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+
+        paths = [f"{self.path}/{self.file_name}.docx"]
+        with self._lock:
+            self._document.save(paths[0])
+
+            if self.html:
+                paths.append(f"{self.path}/{self.file_name}.html")
+                self._save_html(paths[-1])
+
+            if self.csv:
+                paths.append(f"{self.path}/{self.file_name}.csv")
+                self._save_csv(paths[-1])
+
+        logger.info(f"Plate report with {len(self._sections)} sections saved to {paths}")
+        return paths
+
+    def _save_html(self, file_path: str) -> None:
+        lines = [
+            "<!DOCTYPE html>",
+            "<html>",
+            f"<head><meta charset=\"utf-8\"><title>{escape(self.file_name)}</title></head>",
+            "<body>",
+            "<h1>Sequences producing significant alignments</h1>",
+        ]
+        for section, species in self._sections:
+            lines.append(f"<h2>{escape(section)}</h2>")
+            if not species:
+                lines.append("<p>No significant similarity found</p>")
+                continue
+
+            lines.append("<table border=\"1\">")
+            lines.append(
+                "<tr>" + "".join(f"<th>{escape(name)}</th>" for name in COLUMN_NAMES) + "</tr>"
+            )
+            for specie in species:
+                cells = list()
+                for attribute in COLUMN_ATTRIBUTES:
+                    text = escape(specie.display_value(attribute))
+                    href = getattr(specie, f"{attribute}_url", None)
+                    if href:
+                        text = f"<a href=\"{escape(href)}\">{text}</a>"
+                    cells.append(f"<td>{text}</td>")
+                lines.append("<tr>" + "".join(cells) + "</tr>")
+            lines.append("</table>")
+        lines.extend(["</body>", "</html>"])
+
+        with open(file_path, "w", encoding="utf-8") as file:
+            file.write("\n".join(lines) + "\n")
+
+    def _save_csv(self, file_path: str) -> None:
+        field_names = list(BlastNCBIResults.__annotations__.keys())
+
+        with open(file_path, "w", newline="", encoding="utf-8") as file:
+            writer = csv.writer(file)
+            writer.writerow(["section"] + field_names)
+            for section, species in self._sections:
+                for specie in species:
+                    writer.writerow([section] + [getattr(specie, name) for name in field_names])
+
+
+@timed("data_saver.save_alignments_to_notes")
+def save_alignments_to_notes(path: str, file_name: str, alignments: AlignmentMatrix):
 
     # Create directories in disk memory
     if not os.path.exists(path):
         os.makedirs(path)
 
+    # Write the FlatQueryAnchored dot text, one line per sequence
     with open(f"{path}/{file_name}.txt", "w") as file:
-        for id, sequence in alignments.items():
-            file.write(f"{sequence}\n")
+        file.write("\n".join(alignments.render()))
+        file.write("\n")
 
 
 if __name__ == "__main__":
@@ -114,12 +251,12 @@ if __name__ == "__main__":
             description_url="https://blast.ncbi.nlm.nih.gov/Blast.cgi#alnHdr_1538993297",
             scientific_name="Bacillus toyonensis",
             scientific_name_url="https://www.ncbi.nlm.nih.gov/Taxonomy/Browser/wwwtax.cgi?id=155322",
-            max_score="1842",
-            total_score="1842",
-            query_cover="80%",
-            e_value="0.0",
-            per_indentity="96.44%",
-            accession_len="1470",
+            max_score=1842,
+            total_score=1842,
+            query_cover=80.0,
+            e_value=0.0,
+            per_indentity=96.44,
+            accession_len=1470,
             accession="MK312485.1",
             accession_url="https://www.ncbi.nlm.nih.gov/nucleotide/MK312485.1?report=genbank&log$=nucltop&blast_rank=4&RID=PYMEHZGA013",
         ),
@@ -128,12 +265,12 @@ if __name__ == "__main__":
             description_url="https://blast.ncbi.nlm.nih.gov/Blast.cgi#alnHdr_1362598029",
             scientific_name="Bacillus toyonensis",
             scientific_name_url="https://www.ncbi.nlm.nih.gov/Taxonomy/Browser/wwwtax.cgi?id=155322",
-            max_score="1842",
-            total_score="1842",
-            query_cover="80%",
-            e_value="0.0",
-            per_indentity="96.44%",
-            accession_len="1470",
+            max_score=1842,
+            total_score=1842,
+            query_cover=80.0,
+            e_value=0.0,
+            per_indentity=96.44,
+            accession_len=1470,
             accession="MH071323.1",
             accession_url="https://www.ncbi.nlm.nih.gov/nucleotide/MH071323.1?report=genbank&log$=nucltop&blast_rank=5&RID=PYMEHZGA013",
         ),
@@ -143,5 +280,5 @@ if __name__ == "__main__":
     save_alignments_to_notes(
         r"C:\Users\alber\Desktop\Automatización_secuencias_TFG_Clau/Ali/",
         "test",
-        alignments,
+        AlignmentMatrix.from_text_rows(list(alignments.values())),
     )
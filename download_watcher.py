@@ -0,0 +1,185 @@
+from ctypes.util import find_library
+from dataclasses import dataclass, field
+import ctypes
+import os
+import select
+import sys
+import time
+from typing import Dict, Optional, Set, Tuple
+
+from loguru import logger
+
+# Suffixes of the files browsers write while a download is in progress
+PARTIAL_SUFFIXES = (".crdownload", ".part", ".tmp", ".download")
+
+# inotify events that may mean a download started, grew or finished
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+WATCH_EVENTS = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_DELETE
+
+
+class DownloadTimeoutError(TimeoutError):
+    pass
+
+
+@dataclass
+class Download:
+    path: str
+    size: int
+    duration: float
+
+
+class _Inotify:
+    """
+    Minimal inotify binding (through ctypes) notifying the changes of a single directory.
+    """
+
+    def __init__(self, directory: str) -> None:
+        self._libc = ctypes.CDLL(find_library("c") or "libc.so.6", use_errno=True)
+
+        self.fd = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+
+        watch = self._libc.inotify_add_watch(self.fd, os.fsencode(directory), WATCH_EVENTS)
+        if watch < 0:
+            os.close(self.fd)
+            raise OSError(ctypes.get_errno(), f"inotify_add_watch failed for {directory}")
+
+    def wait(self, timeout: float) -> bool:
+        """
+        Wait up to "timeout" seconds for changes in the directory. Returns whether any happened.
+        """
+        readable, _, _ = select.select([self.fd], [], [], max(timeout, 0))
+        if not readable:
+            return False
+
+        # The events are only used to wake up, the directory is scanned afterwards
+        try:
+            while os.read(self.fd, 64 * 1024):
+                pass
+        except BlockingIOError:
+            pass
+
+        return True
+
+    def close(self) -> None:
+        os.close(self.fd)
+
+
+@dataclass
+class DownloadWatcher:
+    """
+    Detects the file downloaded to "directory" after the watcher was started. Changes are
+    notified by inotify on Linux, elsewhere (or if inotify can't be used) the directory is
+    polled every "poll_interval" seconds.
+
+    A download is finished once a new file without a partial suffix (".crdownload"...) exists and
+    its size has not changed for "stable_time" seconds. "wait" raises a DownloadTimeoutError if
+    that doesn't happen within "timeout" seconds (e.g. the browser aborted the download).
+
+        with DownloadWatcher(download_path) as watcher:
+            download_button.click()
+            download = watcher.wait()
+    """
+
+    directory: str
+    timeout: float = 120
+    stable_time: float = 0.5
+    poll_interval: float = 0.2
+    _known_files: Set[str] = field(init=False, default_factory=set)
+    _inotify: Optional[_Inotify] = field(init=False, default=None)
+    _start: float = field(init=False, default=0.0)
+
+    def __enter__(self) -> "DownloadWatcher":
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        self.close()
+
+    def start(self) -> None:
+        """
+        Start watching: files already in the directory are not taken as the download.
+        """
+        # Watch before listing, so no change is missed in between
+        if sys.platform.startswith("linux"):
+            try:
+                self._inotify = _Inotify(self.directory)
+            except (OSError, AttributeError):
+                logger.debug("inotify not available, polling the download directory")
+                self._inotify = None
+
+        self._known_files = set(os.listdir(self.directory))
+        self._start = time.monotonic()
+
+    def close(self) -> None:
+        if self._inotify is not None:
+            self._inotify.close()
+            self._inotify = None
+
+    def wait(self) -> Download:
+        """
+        Wait for the download to finish. Returns its path, size and how long it took since the
+        watcher was started.
+        """
+        deadline = self._start + self.timeout
+
+        # Size of every new file and when it last changed
+        sizes: Dict[str, Tuple[int, float]] = dict()
+
+        while True:
+            now = time.monotonic()
+            for file_name in self._new_files():
+                try:
+                    size = os.path.getsize(os.path.join(self.directory, file_name))
+                except FileNotFoundError:
+                    continue
+
+                if sizes.get(file_name, (None,))[0] != size:
+                    sizes[file_name] = (size, now)
+                    continue
+
+                if now - sizes[file_name][1] >= self.stable_time:
+                    return self._finished(file_name, size, now)
+
+            if now >= deadline:
+                raise DownloadTimeoutError(
+                    f"No download finished in {self.directory} after {self.timeout} seconds"
+                )
+
+            # Check again once a new file may be stable, or as soon as anything changes
+            remaining = deadline - now
+            if self._inotify is not None:
+                self._inotify.wait(min(self.stable_time, remaining) if sizes else remaining)
+            else:
+                time.sleep(min(self.stable_time if sizes else self.poll_interval, remaining))
+
+    def _new_files(self) -> Set[str]:
+        """
+        Complete files added to the directory since the watcher was started. Hidden files are
+        browser temporary files.
+        """
+        return {
+            file_name
+            for file_name in os.listdir(self.directory)
+            if file_name not in self._known_files
+            and not file_name.startswith(".")
+            and not file_name.endswith(PARTIAL_SUFFIXES)
+        }
+
+    def _finished(self, file_name: str, size: int, now: float) -> Download:
+        download = Download(
+            path=os.path.join(self.directory, file_name), size=size, duration=now - self._start
+        )
+        logger.info(
+            f"Downloaded {file_name} ({download.size / 1024:.1f} KiB) "
+            f"in {download.duration:.2f} s"
+        )
+
+        return download
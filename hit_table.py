@@ -0,0 +1,174 @@
+from dataclasses import dataclass, fields
+from typing import Callable, Dict, Iterable, List, Tuple
+
+import numpy as np
+
+from blast_ncbi import TEXT_FIELDS, BlastNCBIResults
+
+# Columns of a hit table: the section (query) of the hit, its rank in that section and every
+# field of "BlastNCBIResults". Text is kept as Python strings, numbers in native columns
+HIT_DTYPE = np.dtype(
+    [
+        ("section", object),
+        ("rank", np.int32),
+        ("description", object),
+        ("description_url", object),
+        ("scientific_name", object),
+        ("scientific_name_url", object),
+        ("max_score", np.int32),
+        ("total_score", np.int32),
+        ("query_cover", np.float64),
+        ("e_value", np.float64),
+        ("per_indentity", np.float64),
+        ("accession_len", np.int32),
+        ("accession", object),
+        ("accession_url", object),
+    ]
+)
+
+# Fields of "BlastNCBIResults", in order
+RESULT_FIELDS = [result_field.name for result_field in fields(BlastNCBIResults)]
+
+
+@dataclass
+class HitTable:
+    """
+    Hits of many queries (e.g. a whole plate) as a NumPy structured array with one row per hit,
+    so they can be sorted, filtered and aggregated with vectorized operations instead of looping
+    over "BlastNCBIResults". Operations return new tables and leave this one unchanged.
+    """
+
+    rows: np.ndarray
+
+    @classmethod
+    def empty(cls) -> "HitTable":
+        return cls(rows=np.empty(0, dtype=HIT_DTYPE))
+
+    @classmethod
+    def from_species(cls, section: str, species: List[BlastNCBIResults]) -> "HitTable":
+        """
+        Table of the hits of one query, ranked in the order they were found.
+        """
+        rows = np.empty(len(species), dtype=HIT_DTYPE)
+        rows["section"] = section
+        rows["rank"] = np.arange(1, len(species) + 1)
+        for name in RESULT_FIELDS:
+            rows[name] = [getattr(specie, name) for specie in species]
+
+        return cls(rows=rows)
+
+    @classmethod
+    def from_results(cls, results: Iterable[Tuple[str, List[BlastNCBIResults]]]) -> "HitTable":
+        """
+        Table of the hits of many queries, given as (section, species) pairs.
+        """
+        return cls.concatenate(
+            [cls.from_species(section, species) for section, species in results]
+        )
+
+    @classmethod
+    def concatenate(cls, tables: List["HitTable"]) -> "HitTable":
+        if not tables:
+            return cls.empty()
+
+        return cls(rows=np.concatenate([table.rows for table in tables]))
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    def __getitem__(self, column: str) -> np.ndarray:
+        return self.rows[column]
+
+    def filter(self, mask: np.ndarray) -> "HitTable":
+        """
+        Rows where the boolean "mask" is True, e.g. "table.filter(table['per_indentity'] >= 99)".
+        """
+        return HitTable(rows=self.rows[mask])
+
+    def significant(
+        self, min_identity: float = 0, min_query_cover: float = 0, max_e_value: float = np.inf
+    ) -> "HitTable":
+        """
+        Hits with at least "min_identity" and "min_query_cover" (percentages) and an e-value no
+        greater than "max_e_value".
+        """
+        return self.filter(
+            (self.rows["per_indentity"] >= min_identity)
+            & (self.rows["query_cover"] >= min_query_cover)
+            & (self.rows["e_value"] <= max_e_value)
+        )
+
+    def sort(self, by: str, descending: bool = False) -> "HitTable":
+        """
+        Rows sorted by the column "by". The sort is stable, rows with equal values keep their
+        order.
+        """
+        values = self.rows[by]
+        if descending and values.dtype != object:
+            order = np.argsort(-values, kind="stable")
+        elif descending:
+            # Strings can't be negated: reverse the order of the distinct values instead
+            distinct, inverse = np.unique(values, return_inverse=True)
+            order = np.argsort(len(distinct) - inverse, kind="stable")
+        else:
+            order = np.argsort(values, kind="stable")
+
+        return HitTable(rows=self.rows[order])
+
+    def best_per_section(self, by: str = "max_score") -> "HitTable":
+        """
+        Hit with the highest "by" value of every section, in the order of the sections. The first
+        hit found wins ties.
+        """
+        if not len(self):
+            return self
+
+        ranked = self.sort(by, descending=True).rows
+        _, first = np.unique(ranked["section"], return_index=True)
+        best = ranked[first]
+
+        # Keep the sections in the order they were added
+        _, section_order = np.unique(self.rows["section"], return_index=True)
+        return HitTable(rows=best[np.argsort(section_order, kind="stable")])
+
+    def counts(self, by: str = "scientific_name") -> Dict[str, int]:
+        """
+        Number of hits of every value of the column "by", from the most frequent.
+        """
+        values, counts = np.unique(self.rows[by], return_counts=True)
+        order = np.argsort(-counts, kind="stable")
+
+        return {values[index]: int(counts[index]) for index in order}
+
+    def aggregate(
+        self,
+        by: str,
+        column: str,
+        function: Callable[[np.ndarray], float] = np.mean,
+    ) -> Dict[str, float]:
+        """
+        Apply "function" to the values of "column" of every group of rows with the same "by"
+        value, e.g. the mean identity of every species.
+        """
+        values, inverse = np.unique(self.rows[by], return_inverse=True)
+        order = np.argsort(inverse, kind="stable")
+        groups = np.split(self.rows[column][order], np.cumsum(np.bincount(inverse))[:-1])
+
+        return {value: float(function(group)) for value, group in zip(values, groups)}
+
+    def to_results(self) -> List[Tuple[str, BlastNCBIResults]]:
+        """
+        Convert the rows back into (section, results) pairs.
+        """
+        return [
+            (
+                row["section"],
+                BlastNCBIResults(
+                    **{
+                        name: row[name] if name in TEXT_FIELDS else row[name].item()
+                        for name in RESULT_FIELDS
+                    }
+                ),
+            )
+            for row in self.rows
+        ]
@@ -0,0 +1,475 @@
+from dataclasses import dataclass, field
+import json
+import sqlite3
+import threading
+import time
+from typing import Dict, List, Optional
+
+from loguru import logger
+
+# Kinds of job: MEGABLAST query of a full sequence or of a crop window, and RDP SeqMatch query
+BLAST_FULL = "blast_full"
+BLAST_CROP = "blast_crop"
+SEQMATCH = "seqmatch"
+JOB_KINDS = [BLAST_FULL, BLAST_CROP, SEQMATCH]
+
+# Job status: waiting to be leased, leased by a worker, finished or failed for good
+PENDING = "pending"
+LEASED = "leased"
+DONE = "done"
+FAILED = "failed"
+
+# Columns read into a "Job", in order
+JOB_COLUMNS = (
+    "id, kind, plate, sequence_id, task, payload, priority, attempts, depends_on, lease_owner"
+)
+
+
+@dataclass
+class Job:
+    id: int
+    kind: str
+    plate: str
+    sequence_id: str
+    task: str
+    payload: dict
+    priority: int
+    attempts: int
+    depends_on: Optional[int]
+    lease_owner: Optional[str]
+
+
+@dataclass
+class JobQueue:
+    """
+    Durable SQLite queue of the queries of many plates, shared by worker processes on one or
+    more machines. Every job (plate, sequence, task) is enqueued once. Workers lease jobs for
+    "lease_timeout" seconds and must heartbeat to keep them: leases of crashed or stuck workers
+    expire and their jobs are requeued, until they have been tried "max_attempts" times.
+
+    Jobs with "depends_on" (crops of a full sequence) are only leased once that job is done.
+    The database must be on a disk shared by all the workers. Use "wal=False" on network shares,
+    where the write-ahead log can't be shared between machines.
+    """
+
+    db_path: str
+    lease_timeout: float = 600
+    max_attempts: int = 3
+    wal: bool = True
+    _connection: sqlite3.Connection = field(init=False, repr=False)
+    _lock: threading.Lock = field(init=False, repr=False, default_factory=threading.Lock)
+
+    def __post_init__(self) -> None:
+        # Transactions are explicit, so leasing can lock the database before reading
+        self._connection = sqlite3.connect(
+            self.db_path, timeout=60, isolation_level=None, check_same_thread=False
+        )
+        if self.wal:
+            self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS jobs (
+                id INTEGER PRIMARY KEY,
+                kind TEXT NOT NULL,
+                plate TEXT NOT NULL,
+                sequence_id TEXT NOT NULL,
+                task TEXT NOT NULL,
+                payload TEXT NOT NULL,
+                priority INTEGER NOT NULL DEFAULT 0,
+                depends_on INTEGER REFERENCES jobs (id),
+                status TEXT NOT NULL DEFAULT 'pending',
+                attempts INTEGER NOT NULL DEFAULT 0,
+                lease_owner TEXT,
+                lease_expires REAL,
+                result TEXT,
+                error TEXT,
+                created_at REAL NOT NULL,
+                updated_at REAL NOT NULL,
+                UNIQUE (plate, sequence_id, task)
+            );
+            CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, priority, id);
+            CREATE INDEX IF NOT EXISTS jobs_plate ON jobs (plate, status);
+            CREATE TABLE IF NOT EXISTS rate_limits (
+                name TEXT PRIMARY KEY,
+                next_request REAL NOT NULL DEFAULT 0,
+                paused_until REAL NOT NULL DEFAULT 0
+            );
+            """
+        )
+
+    def enqueue(
+        self,
+        kind: str,
+        plate: str,
+        sequence_id: str,
+        task: str,
+        payload: dict,
+        priority: int = 0,
+        depends_on: Optional[int] = None,
+    ) -> int:
+        """
+        Add a job, unless the task of that plate and sequence is already in the queue. Returns the
+        ID of the job. Lower "priority" values are leased first.
+        """
+        if kind not in JOB_KINDS:
+            raise ValueError(f"Unknown job kind {kind}, expected one of {JOB_KINDS}")
+
+        now = time.time()
+        with self._lock:
+            self._connection.execute(
+                """
+                INSERT OR IGNORE INTO jobs (
+                    kind, plate, sequence_id, task, payload, priority, depends_on, created_at,
+                    updated_at
+                )
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                """,
+                (
+                    kind,
+                    plate,
+                    sequence_id,
+                    task,
+                    json.dumps(payload),
+                    priority,
+                    depends_on,
+                    now,
+                    now,
+                ),
+            )
+            return self._connection.execute(
+                "SELECT id FROM jobs WHERE plate = ? AND sequence_id = ? AND task = ?",
+                (plate, sequence_id, task),
+            ).fetchone()[0]
+
+    def lease(
+        self, owner: str, kinds: Optional[List[str]] = None, max_jobs: int = 1
+    ) -> List[Job]:
+        """
+        Lease up to "max_jobs" pending jobs of "kinds" (all by default) to "owner", by priority
+        and then in the order they were enqueued. Expired leases are requeued first.
+        """
+        kinds = kinds or JOB_KINDS
+        now = time.time()
+
+        with self._lock:
+            # Take the write lock before reading, so two workers never lease the same job
+            self._connection.execute("BEGIN IMMEDIATE")
+            try:
+                self._requeue_expired(now)
+
+                rows = self._connection.execute(
+                    f"""
+                    SELECT {JOB_COLUMNS} FROM jobs
+                    WHERE status = 'pending'
+                        AND kind IN ({", ".join("?" for _ in kinds)})
+                        AND (depends_on IS NULL
+                            OR depends_on IN (SELECT id FROM jobs WHERE status = 'done'))
+                    ORDER BY priority, id
+                    LIMIT ?
+                    """,
+                    (*kinds, max_jobs),
+                ).fetchall()
+
+                self._connection.executemany(
+                    """
+                    UPDATE jobs
+                    SET status = 'leased', attempts = attempts + 1, lease_owner = ?,
+                        lease_expires = ?, updated_at = ?
+                    WHERE id = ?
+                    """,
+                    [(owner, now + self.lease_timeout, now, row[0]) for row in rows],
+                )
+                self._connection.execute("COMMIT")
+            except BaseException:
+                self._connection.execute("ROLLBACK")
+                raise
+
+        jobs = [self._job(row) for row in rows]
+        for job in jobs:
+            job.attempts += 1
+            job.lease_owner = owner
+
+        return jobs
+
+    def heartbeat(self, job_id: int, owner: str) -> bool:
+        """
+        Extend the lease of a job. Returns False if "owner" lost it (it expired and the job was
+        requeued), in which case the work should be abandoned.
+        """
+        now = time.time()
+        with self._lock:
+            cursor = self._connection.execute(
+                """
+                UPDATE jobs SET lease_expires = ?, updated_at = ?
+                WHERE id = ? AND status = 'leased' AND lease_owner = ?
+                """,
+                (now + self.lease_timeout, now, job_id, owner),
+            )
+
+        return cursor.rowcount > 0
+
+    def complete(self, job_id: int, owner: str, result: dict) -> bool:
+        """
+        Mark a leased job as done with its "result". Returns False if "owner" lost the lease.
+        """
+        with self._lock:
+            cursor = self._connection.execute(
+                """
+                UPDATE jobs
+                SET status = 'done', result = ?, error = NULL, lease_owner = NULL,
+                    lease_expires = NULL, updated_at = ?
+                WHERE id = ? AND status = 'leased' AND lease_owner = ?
+                """,
+                (json.dumps(result), time.time(), job_id, owner),
+            )
+
+        return cursor.rowcount > 0
+
+    def fail(self, job_id: int, owner: str, error: str) -> bool:
+        """
+        Record the error of a leased job. It is requeued while it has been tried fewer than
+        "max_attempts" times, otherwise it fails for good together with the jobs depending on it.
+        Returns False if "owner" lost the lease.
+        """
+        now = time.time()
+        with self._lock:
+            self._connection.execute("BEGIN IMMEDIATE")
+            try:
+                cursor = self._connection.execute(
+                    """
+                    UPDATE jobs
+                    SET status = CASE WHEN attempts < ? THEN 'pending' ELSE 'failed' END,
+                        error = ?, lease_owner = NULL, lease_expires = NULL, updated_at = ?
+                    WHERE id = ? AND status = 'leased' AND lease_owner = ?
+                    """,
+                    (self.max_attempts, error, now, job_id, owner),
+                )
+                self._fail_dependents(now)
+                self._connection.execute("COMMIT")
+            except BaseException:
+                self._connection.execute("ROLLBACK")
+                raise
+
+        return cursor.rowcount > 0
+
+    def result(self, job_id: int) -> Optional[dict]:
+        """
+        Result of a job, or None if it is not done.
+        """
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT result FROM jobs WHERE id = ? AND status = 'done'", (job_id,)
+            ).fetchone()
+
+        return json.loads(row[0]) if row is not None else None
+
+    def requeue_expired(self) -> int:
+        """
+        Requeue the jobs whose lease expired. Returns the number of jobs requeued or failed.
+        """
+        with self._lock:
+            self._connection.execute("BEGIN IMMEDIATE")
+            try:
+                num_expired = self._requeue_expired(time.time())
+                self._connection.execute("COMMIT")
+            except BaseException:
+                self._connection.execute("ROLLBACK")
+                raise
+
+        return num_expired
+
+    def counts(
+        self, plate: Optional[str] = None, kinds: Optional[List[str]] = None
+    ) -> Dict[str, int]:
+        """
+        Number of jobs of every status, of one plate or of the whole queue, and of "kinds" (all
+        by default).
+        """
+        kinds = kinds or JOB_KINDS
+        query = f"SELECT status, COUNT(*) FROM jobs WHERE kind IN ({', '.join('?' for _ in kinds)})"
+        parameters: tuple = tuple(kinds)
+        if plate is not None:
+            query += " AND plate = ?"
+            parameters += (plate,)
+
+        with self._lock:
+            counts = dict(
+                self._connection.execute(f"{query} GROUP BY status", parameters).fetchall()
+            )
+
+        return {status: counts.get(status, 0) for status in (PENDING, LEASED, DONE, FAILED)}
+
+    def done_jobs(self, plate: str, kinds: Optional[List[str]] = None) -> List[Job]:
+        """
+        Jobs of a plate that are done, in the order they were enqueued. Their results are read
+        with "result".
+        """
+        kinds = kinds or JOB_KINDS
+        with self._lock:
+            rows = self._connection.execute(
+                f"""
+                SELECT {JOB_COLUMNS} FROM jobs
+                WHERE plate = ? AND status = 'done' AND kind IN ({", ".join("?" for _ in kinds)})
+                ORDER BY id
+                """,
+                (plate, *kinds),
+            ).fetchall()
+
+        return [self._job(row) for row in rows]
+
+    def reserve_request(self, name: str, interval: float) -> float:
+        """
+        Take the next request slot of the rate limit "name", shared by every worker of the
+        queue, which allows one request every "interval" seconds. Returns 0 if the slot was
+        taken, otherwise the seconds until it is free.
+        """
+        now = time.time()
+        with self._lock:
+            self._connection.execute("BEGIN IMMEDIATE")
+            try:
+                wait_time = self._request_wait_time(name, now)
+                if wait_time == 0:
+                    self._connection.execute(
+                        "UPDATE rate_limits SET next_request = ? WHERE name = ?",
+                        (now + interval, name),
+                    )
+                self._connection.execute("COMMIT")
+            except BaseException:
+                self._connection.execute("ROLLBACK")
+                raise
+
+        return wait_time
+
+    def request_wait_time(self, name: str) -> float:
+        """
+        Seconds until the next request slot of the rate limit "name" is free.
+        """
+        with self._lock:
+            self._connection.execute("BEGIN IMMEDIATE")
+            try:
+                wait_time = self._request_wait_time(name, time.time())
+                self._connection.execute("COMMIT")
+            except BaseException:
+                self._connection.execute("ROLLBACK")
+                raise
+
+        return wait_time
+
+    def pause_requests(self, name: str, seconds: float) -> None:
+        """
+        Give no request slot of the rate limit "name" to any worker for "seconds".
+        """
+        with self._lock:
+            self._connection.execute("INSERT OR IGNORE INTO rate_limits (name) VALUES (?)", (name,))
+            self._connection.execute(
+                "UPDATE rate_limits SET paused_until = MAX(paused_until, ?) WHERE name = ?",
+                (time.time() + seconds, name),
+            )
+
+    def close(self) -> None:
+        with self._lock:
+            self._connection.close()
+
+    @staticmethod
+    def _job(row: tuple) -> Job:
+        job_id, kind, plate, sequence_id, task, payload, priority, attempts, depends_on, owner = row
+
+        return Job(
+            id=job_id,
+            kind=kind,
+            plate=plate,
+            sequence_id=sequence_id,
+            task=task,
+            payload=json.loads(payload),
+            priority=priority,
+            attempts=attempts,
+            depends_on=depends_on,
+            lease_owner=owner,
+        )
+
+    def _requeue_expired(self, now: float) -> int:
+        """
+        Requeue (or fail, after "max_attempts") the jobs whose lease expired. Must be called
+        inside a transaction.
+        """
+        cursor = self._connection.execute(
+            """
+            UPDATE jobs
+            SET status = CASE WHEN attempts < ? THEN 'pending' ELSE 'failed' END,
+                error = 'Lease of ' || lease_owner || ' expired', lease_owner = NULL,
+                lease_expires = NULL, updated_at = ?
+            WHERE status = 'leased' AND lease_expires < ?
+            """,
+            (self.max_attempts, now, now),
+        )
+        if cursor.rowcount:
+            logger.warning(f"{cursor.rowcount} jobs with expired leases requeued")
+            self._fail_dependents(now)
+
+        return cursor.rowcount
+
+    def _request_wait_time(self, name: str, now: float) -> float:
+        """
+        Seconds until the next request slot of the rate limit "name" is free. Must be called
+        inside a transaction.
+        """
+        self._connection.execute("INSERT OR IGNORE INTO rate_limits (name) VALUES (?)", (name,))
+        next_request, paused_until = self._connection.execute(
+            "SELECT next_request, paused_until FROM rate_limits WHERE name = ?", (name,)
+        ).fetchone()
+
+        return max(0.0, next_request - now, paused_until - now)
+
+    def _fail_dependents(self, now: float) -> None:
+        """
+        Fail the pending jobs whose dependency failed, they would never be leased. Must be called
+        inside a transaction.
+        """
+        while True:
+            cursor = self._connection.execute(
+                """
+                UPDATE jobs
+                SET status = 'failed', error = 'Dependency failed', updated_at = ?
+                WHERE status = 'pending'
+                    AND depends_on IN (SELECT id FROM jobs WHERE status = 'failed')
+                """,
+                (now,),
+            )
+            if cursor.rowcount == 0:
+                return
+
+
+@dataclass
+class QueueRateLimiter:
+    """
+    Rate limit of "rate" requests per second shared by every worker of a "JobQueue", on one or
+    more machines, through its database. It can replace a "TokenBucket", whose limit only holds
+    within one process. The clocks of the machines must be synchronized.
+    """
+
+    queue: JobQueue
+    name: str
+    rate: float
+
+    def wait_time(self) -> float:
+        """
+        Seconds until a request can be sent.
+        """
+        return self.queue.request_wait_time(self.name)
+
+    def try_acquire(self) -> bool:
+        return self.queue.reserve_request(self.name, 1 / self.rate) == 0
+
+    def acquire(self) -> None:
+        """
+        Take a request slot, waiting until one is available.
+        """
+        while True:
+            wait_time = self.queue.reserve_request(self.name, 1 / self.rate)
+            if wait_time == 0:
+                return
+
+            time.sleep(wait_time)
+
+    def pause(self, seconds: float) -> None:
+        self.queue.pause_requests(self.name, seconds)
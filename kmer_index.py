@@ -0,0 +1,467 @@
+from dataclasses import dataclass, field
+import json
+import sqlite3
+import threading
+import time
+from typing import List, Optional, Union
+from pathlib import Path
+
+from loguru import logger
+import numpy as np
+
+from alignment import DOT, GAP, SPACE, AlignmentMatrix
+from blast_ncbi import BlastNCBIResults, QueryResults
+from crop_derivation import GAP_COST, MATCH_REWARD, MISMATCH_PENALTY, bit_score
+from result_cache import normalize_sequence
+from sequence_reader import read_fasta
+
+# Candidates whose identity, estimated from their shared k-mers, is this far below the identity
+# threshold are not aligned. The estimate is only approximate
+ESTIMATE_MARGIN = 1.5
+
+# Moves of the alignment traceback
+DIAGONAL = 0
+UP = 1
+LEFT = 2
+
+# 2-bit code of every base, 4 for any other character (k-mers containing it are skipped)
+BASE_CODES = np.full(256, 4, dtype=np.uint64)
+for code, base in enumerate("ACGT"):
+    BASE_CODES[ord(base)] = code
+
+
+def kmer_values(sequence: str, k: int) -> np.ndarray:
+    """
+    Hashed value of every valid k-mer (only A, C, G and T) of the sequence, in order. Values are
+    an invertible mix of the 2-bit encoding, so minimizers are not biased to poly-A k-mers.
+    """
+    codes = BASE_CODES[np.frombuffer(sequence.encode("ascii"), dtype=np.uint8)]
+    if len(codes) < k:
+        return np.zeros(0, dtype=np.uint64)
+
+    windows = np.lib.stride_tricks.sliding_window_view(codes, k)
+    valid = (windows < 4).all(axis=1)
+    shifts = np.arange(2 * (k - 1), -1, -2, dtype=np.uint64)
+    values = (windows[valid] << shifts).sum(axis=1, dtype=np.uint64)
+
+    mask = np.uint64((1 << (2 * k)) - 1)
+    values = (values * np.uint64(0x9E3779B97F4A7C15)) & mask
+    return values ^ (values >> np.uint64(k))
+
+
+def minimizers(sequence: str, k: int, window: int) -> np.ndarray:
+    """
+    Unique minimizers of the sequence: the smallest k-mer value of every "window" consecutive
+    k-mers.
+    """
+    values = kmer_values(sequence, k)
+    if len(values) < window:
+        return np.unique(values)
+
+    return np.unique(np.lib.stride_tricks.sliding_window_view(values, window).min(axis=1))
+
+
+@dataclass
+class LocalHit:
+    accession: str
+    description: str
+    scientific_name: str
+    source: str
+    length: int
+    identity: float
+    query_cover: float
+    matches: int
+    mismatches: int
+    gaps: int
+    bit_score: float
+    alignment: np.ndarray
+
+
+@dataclass
+class KmerIndex:
+    """
+    Persistent SQLite index of the reference sequences retrieved in previous runs (RDP downloads
+    and MEGABLAST hits), addressed by their minimizers (k-mers of size "k", one per "window").
+
+    New sequences are pre-classified locally: the identity of the "num_candidates" references
+    sharing the most minimizers is estimated from their shared k-mers, and only the
+    "num_aligned" closest ones are aligned to the query, when the closest one may reach
+    "identity_threshold". When the best hit (by bit score, as in MEGABLAST) reaches it over at
+    least "min_query_cover" of the query (both percentages), the remote query can be skipped.
+    """
+
+    db_path: str
+    k: int = 15
+    window: int = 10
+    identity_threshold: float = 99.0
+    min_query_cover: float = 95.0
+    top_n: int = 5
+    num_candidates: int = 20
+    num_aligned: int = 6
+    _connection: sqlite3.Connection = field(init=False, repr=False)
+    _lock: threading.Lock = field(init=False, repr=False, default_factory=threading.Lock)
+
+    def __post_init__(self) -> None:
+        self._connection = sqlite3.connect(self.db_path, check_same_thread=False)
+        self._connection.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS settings (name TEXT PRIMARY KEY, value TEXT NOT NULL);
+            CREATE TABLE IF NOT EXISTS references_ (
+                id INTEGER PRIMARY KEY,
+                accession TEXT UNIQUE NOT NULL,
+                description TEXT NOT NULL,
+                scientific_name TEXT NOT NULL,
+                source TEXT NOT NULL,
+                sequence TEXT NOT NULL,
+                added_at REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS minimizers (
+                hash INTEGER NOT NULL,
+                reference_id INTEGER NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS minimizers_hash ON minimizers (hash);
+            """
+        )
+
+        # Minimizers of an existing index are only valid for the same k-mer and window sizes
+        settings = {"k": str(self.k), "window": str(self.window)}
+        for name, value in settings.items():
+            self._connection.execute(
+                "INSERT OR IGNORE INTO settings (name, value) VALUES (?, ?)", (name, value)
+            )
+        stored = dict(self._connection.execute("SELECT name, value FROM settings"))
+        if any(stored[name] != value for name, value in settings.items()):
+            raise ValueError(
+                f"Index {self.db_path} was built with k={stored['k']} and "
+                f"window={stored['window']}, not k={self.k} and window={self.window}"
+            )
+        self._connection.commit()
+
+    @property
+    def num_references(self) -> int:
+        with self._lock:
+            return self._connection.execute("SELECT COUNT(*) FROM references_").fetchone()[0]
+
+    def total_length(self) -> int:
+        """
+        Number of bases of all references, the database size used to compute e-values.
+        """
+        with self._lock:
+            total = self._connection.execute(
+                "SELECT SUM(LENGTH(sequence)) FROM references_"
+            ).fetchone()[0]
+
+        return total or 0
+
+    def add_reference(
+        self,
+        accession: str,
+        sequence: str,
+        description: str = "",
+        scientific_name: str = "",
+        source: str = "",
+    ) -> bool:
+        """
+        Add a reference sequence to the index. Returns False if the accession was already indexed
+        or the sequence is too short to have minimizers.
+        """
+        sequence = normalize_sequence(sequence)
+        reference_minimizers = minimizers(sequence, self.k, self.window)
+        if len(reference_minimizers) == 0:
+            return False
+
+        with self._lock:
+            cursor = self._connection.execute(
+                """
+                INSERT OR IGNORE INTO references_
+                    (accession, description, scientific_name, source, sequence, added_at)
+                VALUES (?, ?, ?, ?, ?, ?)
+                """,
+                (accession, description, scientific_name, source, sequence, time.time()),
+            )
+            if cursor.rowcount == 0:
+                return False
+
+            self._connection.executemany(
+                "INSERT INTO minimizers (hash, reference_id) VALUES (?, ?)",
+                ((int(value), cursor.lastrowid) for value in reference_minimizers),
+            )
+            self._connection.commit()
+
+        return True
+
+    def add_fasta(self, path: Union[str, Path], source: str = "rdp") -> int:
+        """
+        Add every record of a (multi-)FASTA file, like the RDP downloads, whose headers are
+        "accession scientific name; other fields". Returns the number of references added.
+        """
+        num_added = 0
+        for record in read_fasta(path, remove_gaps=True):
+            accession, _, description = record.header.partition(" ")
+            scientific_name = description.split(";")[0].replace("(T)", "").strip()
+
+            num_added += self.add_reference(
+                accession, record.sequence, description, scientific_name, source
+            )
+
+        logger.info(f"{num_added} references of {path} added to the k-mer index")
+        return num_added
+
+    def add_blast_results(
+        self, species_results: List[BlastNCBIResults], alignments: AlignmentMatrix
+    ) -> int:
+        """
+        Add the aligned part of every MEGABLAST hit (rebuilt from the alignments). Returns the
+        number of references added.
+        """
+        # Alignment rows are matched to the hits by accession, hits without a row are skipped
+        hit_sequences = dict(zip(alignments.labels[1:], alignments.hit_sequences()))
+
+        num_added = 0
+        for specie in species_results:
+            hit_sequence = hit_sequences.get(specie.accession)
+            if hit_sequence is None:
+                logger.debug(f"No alignment of {specie.accession}, not added to the k-mer index")
+                continue
+
+            num_added += self.add_reference(
+                specie.accession,
+                hit_sequence,
+                specie.description,
+                specie.scientific_name,
+                source="megablast",
+            )
+
+        return num_added
+
+    def search(self, sequence: str) -> List[LocalHit]:
+        """
+        Align the query to the references closest to it and return the "top_n" best hits, sorted
+        by bit score.
+        """
+        query = normalize_sequence(sequence)
+        return self._align_candidates(query, self._candidates(query))
+
+    def query_local(self, sequence: str) -> Optional[QueryResults]:
+        """
+        Pre-classify a sequence with the local index. Returns the (species, alignments, error)
+        results of the local hits, with the same format as MEGABLAST, if the best hit reaches
+        the identity threshold over enough of the query and there are "top_n" local hits, or
+        None if it must be queried remotely. Local results are never reported as an error.
+        """
+        query = normalize_sequence(sequence)
+        candidates = self._candidates(query)
+        if not candidates:
+            return None
+
+        # Sequences without a close reference are not aligned at all
+        estimated_identity, accession = candidates[0][:2]
+        if estimated_identity < self.identity_threshold - ESTIMATE_MARGIN:
+            logger.debug(
+                f"Closest local reference {accession} has about {estimated_identity:.1f}% "
+                "identity, querying remotely"
+            )
+            return None
+
+        hits = self._align_candidates(query, candidates)
+        best = hits[0]
+        if best.identity < self.identity_threshold or best.query_cover < self.min_query_cover:
+            logger.debug(
+                f"Best local hit {best.accession} has {best.identity:.2f}% identity over "
+                f"{best.query_cover:.0f}% of the query, querying remotely"
+            )
+            return None
+
+        # A local answer must be as complete as the remote one: with fewer than "top_n" hits it
+        # would be reported as a failed query, and its crops skipped
+        if len(hits) < self.top_n:
+            logger.debug(
+                f"Only {len(hits)} local hits close to {best.accession}, querying remotely"
+            )
+            return None
+
+        logger.info(
+            f"Local hit {best.accession} has {best.identity:.2f}% identity, not querying remotely"
+        )
+
+        database_length = self.total_length()
+        species_results: List[BlastNCBIResults] = list()
+        for hit in hits:
+            e_value = float(len(query) * database_length * 2.0 ** -hit.bit_score)
+            url = (
+                f"https://www.ncbi.nlm.nih.gov/nucleotide/{hit.accession}"
+                if hit.source == "megablast"
+                else ""
+            )
+
+            species_results.append(
+                BlastNCBIResults(
+                    description=f"{hit.description} (local {hit.source} reference)",
+                    description_url="",
+                    scientific_name=hit.scientific_name,
+                    scientific_name_url="",
+                    max_score=round(hit.bit_score),
+                    total_score=round(hit.bit_score),
+                    query_cover=float(hit.query_cover),
+                    e_value=e_value,
+                    per_indentity=hit.identity,
+                    accession_len=hit.length,
+                    accession=hit.accession,
+                    accession_url=url,
+                )
+            )
+
+        query_row = np.frombuffer(query.encode("ascii"), dtype=np.uint8)
+        alignments = AlignmentMatrix(
+            labels=["Query"] + [hit.accession for hit in hits],
+            matrix=np.vstack([query_row] + [hit.alignment for hit in hits]),
+            query_start=1,
+            query_end=len(query),
+        )
+
+        return species_results, alignments, False
+
+    def close(self) -> None:
+        with self._lock:
+            self._connection.close()
+
+    def _candidates(self, query: str) -> List[tuple]:
+        """
+        References sharing the most minimizers with the query, as (estimated identity,
+        accession, description, scientific name, source, sequence) tuples from the closest. The
+        identity "p" is estimated from the fraction of query k-mers found in the reference,
+        which is about p ** k.
+        """
+        query_minimizers = minimizers(query, self.k, self.window)
+        if len(query_minimizers) == 0:
+            return []
+
+        with self._lock:
+            rows = self._connection.execute(
+                """
+                SELECT accession, description, scientific_name, source, sequence
+                FROM (
+                    SELECT reference_id, COUNT(*) AS shared
+                    FROM minimizers
+                    WHERE hash IN (SELECT value FROM json_each(?))
+                    GROUP BY reference_id
+                    ORDER BY shared DESC
+                    LIMIT ?
+                ) JOIN references_ ON references_.id = reference_id
+                ORDER BY shared DESC
+                """,
+                (json.dumps([int(value) for value in query_minimizers]), self.num_candidates),
+            ).fetchall()
+
+        query_kmers = np.unique(kmer_values(query, self.k))
+        candidates = list()
+        for row in rows:
+            shared = np.isin(query_kmers, kmer_values(row[4], self.k)).mean()
+            candidates.append((float(shared ** (1 / self.k) * 100), *row))
+        candidates.sort(key=lambda candidate: candidate[0], reverse=True)
+
+        return candidates
+
+    def _align_candidates(self, query: str, candidates: List[tuple]) -> List[LocalHit]:
+        """
+        Align the query to the "num_aligned" closest candidates and return the "top_n" best
+        hits, by bit score.
+        """
+        hits = [self._align(query, *candidate[1:]) for candidate in candidates[: self.num_aligned]]
+        hits.sort(key=lambda hit: (hit.bit_score, hit.identity), reverse=True)
+
+        return hits[: self.top_n]
+
+    @staticmethod
+    def _align(
+        query: str,
+        accession: str,
+        description: str,
+        scientific_name: str,
+        source: str,
+        reference: str,
+    ) -> LocalHit:
+        """
+        Align the query to a reference with the MEGABLAST scores (linear gap costs), without
+        penalizing the unaligned ends of either sequence, and build its row of the flat
+        query-anchored view: dots for identities, the reference base for mismatches, "-" for
+        query bases missing in the reference and spaces outside the aligned region. Insertions
+        in the reference are only counted as gaps.
+        """
+        query_codes = np.frombuffer(query.encode("ascii"), dtype=np.uint8)
+        reference_codes = np.frombuffer(reference.encode("ascii"), dtype=np.uint8)
+        num_columns = len(reference_codes)
+
+        # Score of every query base against the whole reference
+        base_scores = {
+            base: np.where(reference_codes == base, MATCH_REWARD, MISMATCH_PENALTY).astype(float)
+            for base in np.unique(query_codes)
+        }
+        gap_offsets = GAP_COST * np.arange(num_columns + 1)
+
+        # Row by row dynamic programming. Insertions in the reference (moves along the row) are a
+        # running maximum, as gap costs are linear
+        previous = np.zeros(num_columns + 1)
+        current = np.zeros(num_columns + 1)
+        last_column = np.zeros(len(query_codes) + 1)
+        moves = np.empty((len(query_codes), num_columns), dtype=np.uint8)
+        for query_position, base in enumerate(query_codes):
+            diagonal = previous[:-1] + base_scores[base]
+            up = previous[1:] - GAP_COST
+            current[1:] = np.maximum(diagonal, up)
+            scores = np.maximum.accumulate(current + gap_offsets) - gap_offsets
+            moves[query_position] = np.where(
+                scores[1:] > current[1:], LEFT, np.where(diagonal >= up, DIAGONAL, UP)
+            )
+            last_column[query_position + 1] = scores[-1]
+            previous = scores
+
+        # The alignment ends at the end of the query or of the reference, whichever scores best
+        end_column = int(np.argmax(previous))
+        end_row = int(np.argmax(last_column))
+        if previous[end_column] >= last_column[end_row]:
+            query_position, reference_position = len(query_codes), end_column
+        else:
+            query_position, reference_position = end_row, num_columns
+
+        row = np.full(len(query_codes), SPACE, dtype=np.uint8)
+        inserted = 0
+        while query_position > 0 and reference_position > 0:
+            move = moves[query_position - 1, reference_position - 1]
+            if move == DIAGONAL:
+                reference_base = reference_codes[reference_position - 1]
+                row[query_position - 1] = (
+                    DOT if reference_base == query_codes[query_position - 1] else reference_base
+                )
+                query_position -= 1
+                reference_position -= 1
+            elif move == UP:
+                row[query_position - 1] = GAP
+                query_position -= 1
+            else:
+                inserted += 1
+                reference_position -= 1
+
+        aligned = row != SPACE
+        matches = int(np.count_nonzero(row == DOT))
+        deletions = int(np.count_nonzero(row == GAP))
+        mismatches = int(np.count_nonzero(aligned)) - matches - deletions
+        gaps = deletions + inserted
+        alignment_length = int(np.count_nonzero(aligned)) + inserted
+
+        return LocalHit(
+            accession=accession,
+            description=description,
+            scientific_name=scientific_name,
+            source=source,
+            length=len(reference),
+            identity=matches * 100 / alignment_length if alignment_length else 0.0,
+            query_cover=np.count_nonzero(aligned) * 100 / len(query),
+            matches=matches,
+            mismatches=mismatches,
+            gaps=gaps,
+            bit_score=float(
+                bit_score(matches * MATCH_REWARD + mismatches * MISMATCH_PENALTY - gaps * GAP_COST)
+            ),
+            alignment=row,
+        )
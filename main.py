@@ -1,92 +1,551 @@
+from dataclasses import asdict
 from datetime import datetime
-from typing import List
+from functools import partial
+from typing import Dict, List, Optional, Tuple
 from pathlib import Path
 
 from loguru import logger
 
-from blast_ncbi import BlastNCBI
-from data_saver import save_alignments_to_notes, save_results_in_word
+from background_writer import BackgroundWriter
+from blast_ncbi import BlastNCBI, QueryResults, parse_species
+from blast_ncbi_api import BlastNCBIApi
+from crop_derivation import derive_crop_results
+from metrics import METRICS
+from ncbi_scheduler import NCBI_REQUEST_INTERVAL, BlastScheduler, ScheduledBlastSession
+from data_saver import PlateReport, save_alignments_to_notes, save_results_in_word
+from kmer_index import KmerIndex
+from progress_journal import ProgressJournal
+from query_tasks import CROP_WINDOWS, FULL_TASK, crop_task
+from result_cache import ResultCache
+from results_store import PlateResults, ResultsStore
+from sequence_dedup import group_duplicates
+from sequence_reader import iter_plate_files, read_plate_file
+from session_pool import SessionPool
+from token_bucket import TokenBucket
 
 
-def main(dir_files: str):
+def save_query_results(
+    file_name: str, species_results, alignments, report: Optional[PlateReport] = None
+) -> List[str]:
+    """
+    Save the species table and the alignments of a query in their respective directories. With a
+    plate "report", the species table is added to it as a section instead of a .docx of its own.
+    Returns the paths of the files written.
+    """
+    save_alignments_to_notes(
+        path=f"{dir_alignments}",
+        file_name=file_name,
+        alignments=alignments,
+    )
 
-    # Save log fil e
-    logger.add(
-        f"{dir_placa}\log\{datetime.today().strftime('%Y-%m-%d_%H-%M-%S')}.log",
-        level="DEBUG",
+    if report is not None:
+        report.add_results(file_name, species_results)
+        return [f"{dir_alignments}/{file_name}.txt"]
+
+    save_results_in_word(
+        path=f"{dir_description}",
+        file_name=file_name,
+        species=species_results,
     )
 
-    ncbi = BlastNCBI()
-    ncbi.configure_browser(download_path=dir_files, driver_path=PATH_CHROME_DRIVER)
+    return [f"{dir_description}/{file_name}.docx", f"{dir_alignments}/{file_name}.txt"]
+
+
+def completed_task_details(species_results, error: bool) -> dict:
+    """
+    Journal details of a completed query: whether it had an error and its species, so the
+    section can be added again to the plate report when the query is skipped in a later run.
+    """
+    return {"error": error, "species": [asdict(specie) for specie in species_results]}
+
+
+def completed_group_details(
+    journal: Optional[ProgressJournal], sequence_ids: List[str], task: str
+) -> Optional[List[dict]]:
+    """
+    Journal details of a task completed for every sequence of a group of duplicates, or None if
+    the task must be done (again) for any of them.
+    """
+    if journal is None:
+        return None
+
+    group_details = [journal.completed_details(sequence_id, task) for sequence_id in sequence_ids]
+    if any(details is None for details in group_details):
+        return None
+
+    return group_details
+
+
+def add_skipped_results(
+    report: Optional[PlateReport],
+    sequence_id: str,
+    task: str,
+    details: dict,
+    store: Optional[PlateResults] = None,
+) -> None:
+    """
+    Add the species of a query completed in a previous run to the plate report, and to the
+    results "store" if they are not there yet.
+    """
+    if report is None and store is None:
+        return
+
+    if "species" not in details:
+        logger.warning(f"No species recorded for {sequence_id} {task}, not added to the report")
+        return
+
+    species = parse_species(details["species"])
+    if report is not None:
+        report.add_results(f"{sequence_id}_{task}", species)
+    if store is not None:
+        store.add_missing_results(sequence_id, task, species, details["error"])
+
+
+def query_plate_file(
+    ncbi: BlastNCBI,
+    file: Path,
+    journal: Optional[ProgressJournal] = None,
+    crop_windows: List[Tuple[int, int]] = CROP_WINDOWS,
+    derive_crops: bool = True,
+    report: Optional[PlateReport] = None,
+    writer: Optional[BackgroundWriter] = None,
+    duplicates: Optional[Dict[str, List[str]]] = None,
+    index: Optional[KmerIndex] = None,
+    store: Optional[PlateResults] = None,
+) -> str:
+    """
+    Query the full sequence and the crop windows of a plate file and save their results.
+    Returns the sequence ID.
+    """
+    return query_plate_batch(
+        ncbi=ncbi,
+        files=[file],
+        journal=journal,
+        crop_windows=crop_windows,
+        derive_crops=derive_crops,
+        report=report,
+        writer=writer,
+        duplicates=duplicates,
+        index=index,
+        store=store,
+    )[0]
 
-    # Get path from every file
-    downloaded_files: List[Path] = list()
-    for path in Path(dir_files).glob("*.txt"):
-        # Only copy files and not directories
-        if path.is_file():
-            downloaded_files.append(path)
 
-    for file_num, file in enumerate(downloaded_files):
+def query_plate_batch(
+    ncbi: BlastNCBI,
+    files: List[Path],
+    journal: Optional[ProgressJournal] = None,
+    crop_windows: List[Tuple[int, int]] = CROP_WINDOWS,
+    derive_crops: bool = True,
+    report: Optional[PlateReport] = None,
+    writer: Optional[BackgroundWriter] = None,
+    duplicates: Optional[Dict[str, List[str]]] = None,
+    index: Optional[KmerIndex] = None,
+    store: Optional[PlateResults] = None,
+) -> List[str]:
+    """
+    Query the full sequences of all plate files in one MEGABLAST job and save their results.
+    Then, for every crop window, the crops of the sequences that did not fail are derived from
+    the full alignment ("derive_crops") or, when that can't be trusted, queried in one job.
 
-        # if file_num != 97:
-        #     continue
+    With a "journal", queries completed in a previous run are skipped and every finished query
+    is recorded. With a plate "report", the species tables are added to it (skipped queries
+    included). With a "writer", results are saved in the background while the next query runs.
+    "duplicates" maps sequence IDs to the IDs of their exact duplicates, that are not queried
+    but get a copy of the results. With a k-mer "index", sequences (and crops) with a close
+    enough local reference are not queried unless their results are in the result cache, and the
+    hits of every remote query are added to it. Crops are only pre-classified when their full
+    sequence was not queried in this run, otherwise the index holds the same hits that could not
+    be used to derive them.
+    With a results "store", the hits of every query are also appended to it.
+    Returns the sequence IDs.
+    """
+    batch = [read_plate_file(file) for file in files]
+    logger.info(f"Working with {[sequence_id for sequence_id, _ in batch]}")
 
-        sequence_id = file.name.split("_")[1]
-        logger.info(f"Working with {sequence_id = }")
+    # Every sequence and its duplicates, which share its results
+    groups = {
+        sequence_id: [sequence_id] + (duplicates or {}).get(sequence_id, [])
+        for sequence_id, _ in batch
+    }
 
-        # Read lines from file
-        with open(file.absolute()) as f:
-            lines = f.readlines()
+    # Whether the full query of each sequence had an error, taken from the journal if completed
+    full_errors: Dict[str, bool] = dict()
+    for sequence_id, _ in batch:
+        group_details = completed_group_details(journal, groups[sequence_id], FULL_TASK)
+        if group_details is not None:
+            logger.info(f"Full sequence of {sequence_id} already queried, skipping it")
+            full_errors[sequence_id] = group_details[0]["error"]
+            for group_id, details in zip(groups[sequence_id], group_details):
+                add_skipped_results(report, group_id, FULL_TASK, details, store)
 
-            header, num_nucleots = lines[0].split("\t")
-            num_nucleots = num_nucleots.removesuffix("\n")
-            # logger.debug(f"{header = }")
-            # logger.debug(f"{num_nucleots = }")
+    full_batch = [
+        (sequence_id, sequence) for sequence_id, sequence in batch if sequence_id not in full_errors
+    ]
 
-            sequence = "".join(lines[1:]).replace("\n", "")
-            logger.debug(f"{sequence = }")
-            logger.debug(f"{sequence[10:1100] = }")
+    # Full results of this run, used to derive the crops locally
+    full_results_by_id: Dict[str, QueryResults] = dict()
 
-        # Query the full sequence without cropping
-        logger.info("Quering full sequence to MEGABLAST!")
-        species_results, alignments, error = ncbi.query_sequence(sequence=sequence)
+    # Sequences pre-classified with the local index are not queried to MEGABLAST. Exact results
+    # in the result cache are preferred to local ones
+    if index is not None:
+        remote_batch: List[Tuple[str, str]] = list()
+        for sequence_id, sequence in full_batch:
+            results = None if ncbi.is_cached(sequence) else index.query_local(sequence)
+            if results is None:
+                remote_batch.append((sequence_id, sequence))
+                continue
+
+            logger.info(f"Saving local full sequence results of {sequence_id}...")
+            full_errors[sequence_id] = results[2]
+            full_results_by_id[sequence_id] = results
+            write_task_results(
+                groups[sequence_id], FULL_TASK, results, journal, report, writer, store
+            )
+        full_batch = remote_batch
+
+    if full_batch:
+        # Query the full sequences without cropping
+        logger.info(f"Quering {len(full_batch)} full sequences to MEGABLAST!")
+        if journal is not None:
+            for sequence_id, _ in full_batch:
+                for group_id in groups[sequence_id]:
+                    journal.record_started(group_id, FULL_TASK)
+
+        full_results = ncbi.query_batch(sequences=[sequence for _, sequence in full_batch])
 
         logger.info("Saving full sequence results...")
-        save_results_in_word(
-            path=f"{dir_description}",
-            file_name=f"{sequence_id}_full",
-            species=species_results,
+        for (sequence_id, _), results in zip(full_batch, full_results):
+            full_errors[sequence_id] = results[2]
+            full_results_by_id[sequence_id] = results
+            write_task_results(
+                groups[sequence_id], FULL_TASK, results, journal, report, writer, store
+            )
+            if index is not None and not results[2]:
+                index.add_blast_results(results[0], results[1])
+
+    for window in crop_windows:
+        task = crop_task(window)
+
+        # If there has been an error finding similar species to a sequence, it is not cropped
+        crop_batch: List[Tuple[str, str]] = list()
+        for sequence_id, sequence in batch:
+            if full_errors[sequence_id]:
+                continue
+            group_details = completed_group_details(journal, groups[sequence_id], task)
+            if group_details is not None:
+                logger.info(f"Crop {task} of {sequence_id} already queried, skipping it")
+                for group_id, details in zip(groups[sequence_id], group_details):
+                    add_skipped_results(report, group_id, task, details, store)
+                continue
+
+            # Recompute the crop from the full alignment when it can be trusted
+            crop_results = None
+            if derive_crops and sequence_id in full_results_by_id:
+                crop_results = derive_crop_results(
+                    full_results_by_id[sequence_id], window=window, query_length=len(sequence)
+                )
+            # The index holds the hits of the full query of this run, it can't answer a crop
+            # that could not be derived from them either
+            if (
+                crop_results is None
+                and index is not None
+                and sequence_id not in full_results_by_id
+                and not ncbi.is_cached(sequence, crop=window)
+            ):
+                crop_results = index.query_local(sequence[window[0] : window[1]])
+
+            if crop_results is None:
+                crop_batch.append((sequence_id, sequence))
+                continue
+
+            logger.info(f"Saving locally derived {task} results of {sequence_id}...")
+            write_task_results(
+                groups[sequence_id], task, crop_results, journal, report, writer, store
+            )
+
+        if not crop_batch:
+            continue
+
+        # Query the sequences with defined cropped
+        logger.info(f"Quering {len(crop_batch)} cropped sequences {task} to MEGABLAST!")
+        if journal is not None:
+            for sequence_id, _ in crop_batch:
+                for group_id in groups[sequence_id]:
+                    journal.record_started(group_id, task)
+
+        crop_results_batch = ncbi.query_batch(
+            sequences=[sequence for _, sequence in crop_batch], crop=window
         )
-        save_alignments_to_notes(
-            path=f"{dir_alignments}",
-            file_name=f"{sequence_id}_full",
-            alignments=alignments,
+
+        logger.info("Saving cropped sequence results...")
+        for (sequence_id, _), crop_results in zip(crop_batch, crop_results_batch):
+            write_task_results(
+                groups[sequence_id], task, crop_results, journal, report, writer, store
+            )
+            if index is not None and not crop_results[2]:
+                index.add_blast_results(crop_results[0], crop_results[1])
+
+    return [sequence_id for sequence_id, _ in batch]
+
+
+def save_task_results(
+    sequence_id: str,
+    task: str,
+    results: QueryResults,
+    journal: Optional[ProgressJournal],
+    report: Optional[PlateReport] = None,
+    store: Optional[PlateResults] = None,
+) -> None:
+    """
+    Save the results of a task (the full sequence or a crop window), append them to the results
+    "store" and record them in the journal.
+    """
+    species_results, alignments, error = results
+    outputs = save_query_results(f"{sequence_id}_{task}", species_results, alignments, report)
+    if store is not None:
+        store.add_results(sequence_id, task, species_results, error)
+
+    if journal is not None:
+        journal.record_completed(
+            sequence_id, task, outputs, completed_task_details(species_results, error)
         )
 
-        # If there has been an error finding similar species to current sequence,
-        # then continue with next sequence without cropping the current one
-        if error:
+
+def write_task_results(
+    sequence_ids: List[str],
+    task: str,
+    results: QueryResults,
+    journal: Optional[ProgressJournal],
+    report: Optional[PlateReport] = None,
+    writer: Optional[BackgroundWriter] = None,
+    store: Optional[PlateResults] = None,
+) -> None:
+    """
+    Save the results of a task for every sequence of "sequence_ids" (a sequence and its
+    duplicates), in the background with "writer" or right away without one.
+    """
+    for sequence_id in sequence_ids:
+        if writer is None:
+            save_task_results(sequence_id, task, results, journal, report, store)
             continue
 
-        # Query the sequence with defined cropped
-        logger.info("Quering cropped sequence to MEGABLAST!")
-        species_results_crop, alignments_crop, error = ncbi.query_sequence(
-            sequence=sequence[10:1100]
+        writer.submit(
+            f"{sequence_id}_{task}",
+            save_task_results,
+            sequence_id,
+            task,
+            results,
+            journal,
+            report,
+            store,
         )
 
-        logger.info("Saving cropped sequence results...")
-        save_results_in_word(
+
+def create_blast_session(
+    download_path: str,
+    backend: str = "selenium",
+    cache: Optional[ResultCache] = None,
+    scheduler: Optional[BlastScheduler] = None,
+    submit_limiter: Optional[TokenBucket] = None,
+) -> BlastNCBI:
+    """
+    Open and configure a new MEGABLAST session. The "selenium" backend drives a browser and the
+    "api" backend uses the BLAST URL API over HTTP. Both look up results in "cache" first.
+    With a "scheduler", "api" sessions send their queries through it, and "selenium" sessions
+    wait for "submit_limiter" before every submission.
+    """
+    if backend == "api":
+        if scheduler is not None:
+            return ScheduledBlastSession(scheduler=scheduler)
+        return BlastNCBIApi(cache=cache)
+
+    ncbi = BlastNCBI(cache=cache, submit_limiter=submit_limiter)
+    ncbi.configure_browser(download_path=download_path, driver_path=PATH_CHROME_DRIVER)
+
+    return ncbi
+
+
+def main(
+    dir_files: str,
+    batch_size: int = 1,
+    num_workers: int = 1,
+    backend: str = "selenium",
+    cache_path: Optional[str] = None,
+    resume: bool = True,
+    crop_windows: List[Tuple[int, int]] = CROP_WINDOWS,
+    derive_crops: bool = True,
+    plate_report: bool = True,
+    report_html: bool = False,
+    report_csv: bool = False,
+    background_writes: bool = True,
+    deduplicate: bool = True,
+    metrics_path: Optional[str] = None,
+    index_path: Optional[str] = None,
+    local_identity_threshold: float = 99.0,
+    rate_limit: bool = True,
+    results_store_path: Optional[str] = None,
+):
+    """
+    Query every plate .txt file in "dir_files" to MEGABLAST, both the full sequence and the
+    "crop_windows". With "derive_crops", crops are computed from the full alignment when that
+    can be trusted instead of being queried again.
+
+    With "batch_size" greater than 1, that many sequences are submitted together in a single
+    MEGABLAST job (batch mode). With "num_workers" greater than 1, that many sessions query
+    sequences (or batches) at the same time. "backend" is either "selenium" or "api".
+    With "cache_path", results are stored in (and reused from) a persistent result cache.
+    With "resume", the progress is recorded in a journal of the plate and queries completed in a
+    previous run are skipped.
+    With "plate_report", the species tables of all queries are saved in a single report of the
+    plate (also as HTML and CSV with "report_html" and "report_csv") instead of a .docx per query.
+    With "background_writes", results are saved in a background thread while the next query runs.
+    With "deduplicate", only one of the files with exactly the same sequence is queried and its
+    results are saved for all of them.
+    The run ends logging the percentiles of the duration of every stage. With "metrics_path",
+    they are also exported to "{metrics_path}.jsonl" (every span) and "{metrics_path}.prom" (a
+    Prometheus textfile).
+    With "index_path", the hits of every query are kept in a persistent k-mer index and sequences
+    whose best local reference reaches "local_identity_threshold" (percentage of identity)
+    are classified locally instead of querying MEGABLAST.
+    With "rate_limit", requests to NCBI follow its usage limits across all the workers: "api"
+    queries go through a shared scheduler that interleaves the polling of their RIDs (full
+    sequences before crops), and "selenium" sessions share a limit on job submissions.
+    With "results_store_path", the hits of every query are also appended to a results store
+    shared by all plates, indexed by sequence ID, accession and scientific name.
+    """
+
+    # Save log fil e
+    logger.add(
+        f"{dir_placa}\log\{datetime.today().strftime('%Y-%m-%d_%H-%M-%S')}.log",
+        level="DEBUG",
+    )
+
+    # Get path from every file
+    downloaded_files: List[Path] = list(iter_plate_files(dir_files))
+
+    result_cache = ResultCache(db_path=cache_path) if cache_path else None
+    journal = ProgressJournal(f"{dir_files}/progress_journal.jsonl") if resume else None
+    report = (
+        PlateReport(
             path=f"{dir_description}",
-            file_name=f"{sequence_id}_10-1100_crop",
-            species=species_results_crop,
+            file_name=f"{Path(dir_files).name}_report",
+            html=report_html,
+            csv=report_csv,
         )
-        save_alignments_to_notes(
-            path=f"{dir_alignments}",
-            file_name=f"{sequence_id}_10-1100_crop",
-            alignments=alignments_crop,
+        if plate_report
+        else None
+    )
+    writer = BackgroundWriter() if background_writes else None
+    index = (
+        KmerIndex(db_path=index_path, identity_threshold=local_identity_threshold)
+        if index_path
+        else None
+    )
+    results_store = ResultsStore(db_path=results_store_path) if results_store_path else None
+    store = PlateResults(results_store, Path(dir_files).name) if results_store else None
+
+    # Only the first file of every group of duplicates is queried
+    duplicates: Dict[str, List[str]] = dict()
+    if deduplicate:
+        plate = [(file, *read_plate_file(file)) for file in downloaded_files]
+        groups = group_duplicates(plate, lambda plate_file: plate_file[2])
+        downloaded_files = [group[0][0] for group in groups]
+        for group in groups:
+            group_ids = [sequence_id for _, sequence_id, _ in group]
+            if len(group_ids) > 1:
+                logger.info(f"{group_ids[1:]} are duplicates of {group_ids[0]}")
+                duplicates[group_ids[0]] = group_ids[1:]
+
+    # Every job is either a single file or a batch of files
+    if batch_size > 1:
+        jobs = [
+            downloaded_files[batch_start : batch_start + batch_size]
+            for batch_start in range(0, len(downloaded_files), batch_size)
+        ]
+        job_function = partial(
+            query_plate_batch,
+            journal=journal,
+            crop_windows=crop_windows,
+            derive_crops=derive_crops,
+            report=report,
+            writer=writer,
+            duplicates=duplicates,
+            index=index,
+            store=store,
+        )
+    else:
+        jobs = downloaded_files
+        job_function = partial(
+            query_plate_file,
+            journal=journal,
+            crop_windows=crop_windows,
+            derive_crops=derive_crops,
+            report=report,
+            writer=writer,
+            duplicates=duplicates,
+            index=index,
+            store=store,
         )
 
-    ncbi.quit()
+    # Requests of every worker share the same NCBI limits
+    scheduler: Optional[BlastScheduler] = None
+    submit_limiter: Optional[TokenBucket] = None
+    if rate_limit and backend == "api":
+        scheduler = BlastScheduler(api=BlastNCBIApi(cache=result_cache))
+    elif rate_limit:
+        submit_limiter = TokenBucket(rate=1 / NCBI_REQUEST_INTERVAL)
+    session_factory = partial(
+        create_blast_session,
+        backend=backend,
+        cache=result_cache,
+        scheduler=scheduler,
+        submit_limiter=submit_limiter,
+    )
+
+    try:
+        if num_workers > 1:
+            pool = SessionPool(
+                session_factory=session_factory,
+                download_root=f"{dir_files}/workers",
+                max_workers=num_workers,
+            )
+            pool.map(job_function, jobs)
+        else:
+            ncbi = session_factory(download_path=dir_files)
+
+            for job in jobs:
+                job_function(ncbi, job)
+
+                # Stop querying as soon as some results could not be saved
+                if writer is not None:
+                    writer.check()
+
+            ncbi.quit()
+    finally:
+        if scheduler is not None:
+            scheduler.close()
+
+        # Save the pending results even if a query failed, so they are not lost
+        if writer is not None:
+            writer.close(raise_errors=False)
+
+    if writer is not None:
+        writer.check()
+
+    if report is not None:
+        report.save()
+
+    if result_cache is not None:
+        result_cache.close()
+
+    if index is not None:
+        index.close()
+
+    if results_store is not None:
+        results_store.close()
+
+    METRICS.flush(metrics_path)
 
 
 if __name__ == "__main__":
@@ -95,4 +554,24 @@ if __name__ == "__main__":
 
     dir_description = rf"{dir_placa}Descriptions/"
     dir_alignments = rf"{dir_placa}Alignments/"
-    main(dir_files=dir_placa)
+    main(
+        dir_files=dir_placa,
+        batch_size=1,
+        num_workers=1,
+        backend="selenium",
+        cache_path=f"{dir_placa}result_cache.sqlite",
+        resume=True,
+        crop_windows=[(10, 1100)],
+        derive_crops=True,
+        plate_report=True,
+        report_html=True,
+        report_csv=True,
+        background_writes=True,
+        deduplicate=True,
+        metrics_path=f"{dir_placa}metrics",
+        index_path=f"{dir_placa}kmer_index.sqlite",
+        local_identity_threshold=99.0,
+        rate_limit=True,
+        # Shared by all the plates of the data directory
+        results_store_path=f"{dir_placa}../results_store.sqlite",
+    )
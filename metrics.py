@@ -0,0 +1,189 @@
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from functools import wraps
+import json
+import os
+import threading
+import time
+from typing import Any, Callable, Dict, Iterator, List, Optional
+
+from loguru import logger
+import numpy as np
+
+# Percentiles of the summary table and of the Prometheus summaries
+PERCENTILES = [50, 90, 99]
+
+PROMETHEUS_METRIC = "sequence_analyzer_stage_duration_seconds"
+
+
+@dataclass
+class Span:
+    stage: str
+    start: float
+    duration: float
+
+
+@dataclass
+class MetricsRegistry:
+    """
+    Durations of the stages of the query flows (page load, submit, queue wait, extraction,
+    saving...), recorded as spans from any thread. A run ends with a summary of the percentiles of
+    every stage, that can also be exported as JSON lines and as a Prometheus textfile.
+    """
+
+    spans: List[Span] = field(default_factory=list)
+    _lock: threading.Lock = field(init=False, default_factory=threading.Lock)
+
+    @contextmanager
+    def span(self, stage: str) -> Iterator[None]:
+        """
+        Record the duration of the "with" block as a span of "stage", even if it raises.
+        """
+        start = time.time()
+        start_monotonic = time.monotonic()
+        try:
+            yield
+        finally:
+            self.record(stage, time.monotonic() - start_monotonic, start=start)
+
+    def record(self, stage: str, duration: float, start: float = 0.0) -> None:
+        with self._lock:
+            self.spans.append(Span(stage=stage, start=start or time.time(), duration=duration))
+
+    def reset(self) -> None:
+        with self._lock:
+            self.spans = list()
+
+    def drain(self) -> "MetricsRegistry":
+        """
+        Take the spans recorded so far, leaving this registry empty. Returns them in a registry of
+        their own, to summarize and export them while new spans keep being recorded.
+        """
+        with self._lock:
+            spans, self.spans = self.spans, list()
+
+        return MetricsRegistry(spans=spans)
+
+    def flush(self, metrics_path: Optional[str] = None) -> None:
+        """
+        Log the summary of the spans recorded so far and, with "metrics_path", export them to
+        "{metrics_path}.jsonl" and "{metrics_path}.prom". The spans are cleared, so long runs
+        don't keep them forever and the next flush doesn't export them again.
+        """
+        drained = self.drain()
+        drained.log_summary()
+        if metrics_path is not None and drained.spans:
+            drained.export_jsonl(f"{metrics_path}.jsonl")
+            drained.export_prometheus(f"{metrics_path}.prom")
+
+    def durations(self) -> Dict[str, np.ndarray]:
+        """
+        Durations of every stage, in the order stages were first recorded.
+        """
+        with self._lock:
+            stage_durations: Dict[str, List[float]] = dict()
+            for span in self.spans:
+                stage_durations.setdefault(span.stage, []).append(span.duration)
+
+        return {stage: np.array(durations) for stage, durations in stage_durations.items()}
+
+    def summary(self) -> Dict[str, Dict[str, float]]:
+        """
+        Number of spans, total, mean, percentiles and maximum duration (in seconds) of every stage.
+        """
+        summary: Dict[str, Dict[str, float]] = dict()
+        for stage, durations in self.durations().items():
+            summary[stage] = {
+                "count": len(durations),
+                "total": float(durations.sum()),
+                "mean": float(durations.mean()),
+                **{
+                    f"p{percentile}": float(value)
+                    for percentile, value in zip(PERCENTILES, np.percentile(durations, PERCENTILES))
+                },
+                "max": float(durations.max()),
+            }
+
+        return summary
+
+    def summary_table(self) -> str:
+        percentile_names = [f"p{percentile}" for percentile in PERCENTILES]
+        lines = [
+            f"{'Stage':<40}{'Count':>7}{'Total (s)':>11}{'Mean (s)':>10}"
+            + "".join(f"{name + ' (s)':>10}" for name in percentile_names)
+            + f"{'Max (s)':>10}"
+        ]
+        for stage, summary in self.summary().items():
+            lines.append(
+                f"{stage:<40}{summary['count']:>7}{summary['total']:>11.2f}{summary['mean']:>10.3f}"
+                + "".join(f"{summary[name]:>10.3f}" for name in percentile_names)
+                + f"{summary['max']:>10.3f}"
+            )
+
+        return "\n".join(lines)
+
+    def log_summary(self) -> None:
+        if self.spans:
+            logger.info(f"Stage timings:\n{self.summary_table()}")
+
+    def export_jsonl(self, path: str) -> None:
+        """
+        Append every span to a JSON-lines file.
+        """
+        with self._lock:
+            spans = list(self.spans)
+
+        with open(path, "a") as file:
+            for span in spans:
+                record = {"stage": span.stage, "start": span.start, "duration": span.duration}
+                file.write(json.dumps(record) + "\n")
+
+    def export_prometheus(self, path: str) -> None:
+        """
+        Write the summary of every stage to a Prometheus textfile (for the node exporter textfile
+        collector). The file is replaced atomically, so it is never read half-written.
+        """
+        lines = [
+            f"# HELP {PROMETHEUS_METRIC} Duration of the stages of the sequence query flows.",
+            f"# TYPE {PROMETHEUS_METRIC} summary",
+        ]
+        for stage, summary in self.summary().items():
+            for percentile in PERCENTILES:
+                lines.append(
+                    f'{PROMETHEUS_METRIC}{{stage="{stage}",quantile="{percentile / 100}"}} '
+                    f"{summary[f'p{percentile}']}"
+                )
+            lines.append(f'{PROMETHEUS_METRIC}_sum{{stage="{stage}"}} {summary["total"]}')
+            lines.append(f'{PROMETHEUS_METRIC}_count{{stage="{stage}"}} {summary["count"]}')
+
+        temporary_path = f"{path}.{os.getpid()}.tmp"
+        with open(temporary_path, "w") as file:
+            file.write("\n".join(lines) + "\n")
+        os.replace(temporary_path, path)
+
+
+# Registry used by every module of the package
+METRICS = MetricsRegistry()
+
+
+def span(stage: str):
+    """
+    Record the duration of a "with" block as a span of "stage" in the package registry.
+    """
+    return METRICS.span(stage)
+
+
+def timed(stage: str) -> Callable[[Callable[..., Any]], Callable[..., Any]]:
+    """
+    Decorator recording the duration of every call to the function as a span of "stage".
+    """
+
+    def decorator(function: Callable[..., Any]) -> Callable[..., Any]:
+        @wraps(function)
+        def timed_function(*args, **kwargs):
+            with METRICS.span(stage):
+                return function(*args, **kwargs)
+
+        return timed_function
+
+    return decorator
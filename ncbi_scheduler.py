@@ -0,0 +1,392 @@
+from concurrent.futures import Future
+from dataclasses import dataclass, field
+import heapq
+import itertools
+import threading
+import time
+from typing import List, Optional, Tuple, Union
+from urllib.error import HTTPError, URLError
+
+from loguru import logger
+
+from blast_ncbi import QueryResults, is_cached, query_with_cache
+from blast_ncbi_api import BlastNCBIApi, BlastNCBIApiError
+from job_queue import QueueRateLimiter
+from metrics import METRICS
+from token_bucket import TokenBucket
+
+# NCBI usage limits of the BLAST URL API: at most one request every 10 seconds and one status
+# request per minute for every RID
+NCBI_REQUEST_INTERVAL = 10
+NCBI_POLL_INTERVAL = 60
+
+# Lower values are submitted first: full sequences before their crops
+FULL_PRIORITY = 0
+CROP_PRIORITY = 1
+
+
+@dataclass(order=True)
+class ScheduledJob:
+    """
+    MEGABLAST job of the scheduler: waiting to be submitted while it has no "rid", then polled
+    at "next_poll" until its results are ready.
+    """
+
+    priority: int
+    order: int
+    sequences: List[str] = field(compare=False)
+    future: "Future[List[QueryResults]]" = field(compare=False, default_factory=Future)
+    rid: str = field(compare=False, default="")
+    queued_at: float = field(compare=False, default_factory=time.monotonic)
+    submitted_at: float = field(compare=False, default=0.0)
+    next_poll: float = field(compare=False, default=0.0)
+    poll_interval: float = field(compare=False, default=NCBI_POLL_INTERVAL)
+    num_polls: int = field(compare=False, default=0)
+
+
+def is_transient_error(error: BaseException) -> bool:
+    """
+    Whether a request error means NCBI is throttling or temporarily unavailable (the request can
+    be repeated later) rather than a problem of the job itself.
+    """
+    if isinstance(error, HTTPError):
+        return error.code == 429 or error.code >= 500
+
+    return isinstance(error, (URLError, ConnectionError, TimeoutError))
+
+
+@dataclass
+class BlastScheduler:
+    """
+    Single gateway of all the requests sent to the BLAST URL API by "api", shared by every worker
+    of a run. Requests of any kind (submit, status, results) go through a token bucket with one
+    request every "request_interval" seconds, and every RID is polled at most once every
+    "min_poll_interval" seconds, following the NCBI usage guidelines.
+
+    Jobs wait in a priority queue (full sequences before crops) and up to "max_outstanding" RIDs
+    are polled interleaved, so the time NCBI spends on one job is used to submit and poll the
+    rest. The poll interval of a job grows by "poll_backoff" (up to "max_poll_interval") every
+    time it is still waiting, and throttling or server errors pause every request for a delay
+    that doubles (up to "max_error_backoff") until a request succeeds again.
+
+    The schedulers of several processes (e.g. queue workers on many machines) stay within the
+    limits together when they share a "limiter" such as a "QueueRateLimiter".
+    """
+
+    api: BlastNCBIApi
+    request_interval: float = NCBI_REQUEST_INTERVAL
+    min_poll_interval: float = NCBI_POLL_INTERVAL
+    max_poll_interval: float = 600
+    poll_backoff: float = 1.5
+    max_outstanding: int = 20
+    max_error_backoff: float = 900
+    limiter: Optional[Union[TokenBucket, QueueRateLimiter]] = None
+    _bucket: Union[TokenBucket, QueueRateLimiter] = field(init=False)
+    _pending: List[ScheduledJob] = field(init=False, default_factory=list)
+    _outstanding: List[ScheduledJob] = field(init=False, default_factory=list)
+    _order: "itertools.count[int]" = field(init=False, default_factory=itertools.count)
+    _condition: threading.Condition = field(init=False, default_factory=threading.Condition)
+    _thread: Optional[threading.Thread] = field(init=False, default=None)
+    _error_backoff: float = field(init=False, default=0.0)
+    _closed: bool = field(init=False, default=False)
+
+    def __post_init__(self) -> None:
+        self._bucket = self.limiter or TokenBucket(rate=1 / self.request_interval)
+
+    def __enter__(self) -> "BlastScheduler":
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        self.close()
+
+    @property
+    def num_pending(self) -> int:
+        with self._condition:
+            return len(self._pending)
+
+    @property
+    def num_outstanding(self) -> int:
+        with self._condition:
+            return len(self._outstanding)
+
+    def start(self) -> None:
+        if self._thread is not None:
+            return
+
+        self._thread = threading.Thread(target=self._run, name="blast_scheduler", daemon=True)
+        self._thread.start()
+
+    def close(self) -> None:
+        """
+        Stop the scheduler. Jobs not finished yet fail with a BlastNCBIApiError.
+        """
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+
+        if self._thread is not None:
+            self._thread.join()
+
+        for job in self._pending + self._outstanding:
+            job.future.set_exception(BlastNCBIApiError("BLAST scheduler closed"))
+        self._pending, self._outstanding = list(), list()
+
+    def submit(
+        self, sequences: List[str], priority: int = FULL_PRIORITY
+    ) -> "Future[List[QueryResults]]":
+        """
+        Queue the sequences to be queried in one MEGABLAST job. Returns a future with one
+        (species, alignments, error) tuple per sequence.
+        """
+        with self._condition:
+            if self._closed:
+                raise BlastNCBIApiError("BLAST scheduler closed, can't submit more jobs")
+
+            job = ScheduledJob(priority=priority, order=next(self._order), sequences=sequences)
+            heapq.heappush(self._pending, job)
+            self._condition.notify_all()
+
+        self.start()
+        return job.future
+
+    def query_batch(
+        self,
+        sequences: List[str],
+        crop: Optional[Tuple[int, int]] = None,
+        priority: Optional[int] = None,
+    ) -> List[QueryResults]:
+        """
+        Query several sequences, or their "crop" window, in one job and wait for their results,
+        like "BlastNCBIApi.query_batch". Crops have a lower priority than full sequences unless
+        "priority" is given.
+        """
+        if priority is None:
+            priority = FULL_PRIORITY if crop is None else CROP_PRIORITY
+
+        return query_with_cache(
+            cache=self.api.cache,
+            cache_parameters=self.api.cache_parameters,
+            sequences=sequences,
+            crop=crop,
+            query_function=lambda batch: self.submit(batch, priority=priority).result(),
+        )
+
+    def _run(self) -> None:
+        """
+        Scheduler loop: wait for the next due action (a poll whose time has come, or a
+        submission while there is room for more RIDs), then take a token and run it.
+        """
+        while True:
+            with self._condition:
+                job = self._next_job()
+                while job is None and not self._closed:
+                    self._condition.wait(timeout=self._time_to_next_poll())
+                    job = self._next_job()
+
+                if self._closed:
+                    return
+
+            self._bucket.acquire()
+
+            if job.rid:
+                self._poll(job)
+            else:
+                self._submit(job)
+
+    def _next_job(self) -> Optional[ScheduledJob]:
+        """
+        Job of the next action: the outstanding job that has been due the longest, or else the
+        pending job with the highest priority if fewer than "max_outstanding" RIDs are running.
+        """
+        now = time.monotonic()
+        due_jobs = [job for job in self._outstanding if job.next_poll <= now]
+        if due_jobs:
+            return min(due_jobs, key=lambda job: (job.next_poll, job.priority))
+
+        if self._pending and len(self._outstanding) < self.max_outstanding:
+            job = heapq.heappop(self._pending)
+            self._outstanding.append(job)
+            return job
+
+        return None
+
+    def _time_to_next_poll(self) -> Optional[float]:
+        next_polls = [job.next_poll for job in self._outstanding if job.rid]
+        if not next_polls:
+            return None
+
+        return max(0.0, min(next_polls) - time.monotonic())
+
+    def _submit(self, job: ScheduledJob) -> None:
+        fasta_query = "\n".join(
+            f">query_{num}\n{sequence}" for num, sequence in enumerate(job.sequences, start=1)
+        )
+
+        try:
+            rid, rtoe = self.api.submit(query=fasta_query)
+        except Exception as error:
+            if self._retry_later(job, error):
+                # Not submitted yet, back to the queue with its original priority and order
+                with self._condition:
+                    self._outstanding.remove(job)
+                    heapq.heappush(self._pending, job)
+            return
+
+        self._request_succeeded()
+        METRICS.record("megablast_scheduler.submit_wait", time.monotonic() - job.queued_at)
+
+        now = time.monotonic()
+        with self._condition:
+            job.rid = rid
+            job.submitted_at = now
+            # NCBI does not have the results before the estimated time, no need to ask sooner
+            job.poll_interval = self.min_poll_interval
+            job.next_poll = now + max(rtoe, self.min_poll_interval)
+
+    def _poll(self, job: ScheduledJob) -> None:
+        try:
+            status = self.api.get_status(rid=job.rid)
+        except Exception as error:
+            self._retry_later(job, error)
+            return
+
+        self._request_succeeded()
+        job.num_polls += 1
+
+        if status == "WAITING":
+            if time.monotonic() - job.submitted_at > self.api.max_wait:
+                self._finish(
+                    job,
+                    error=BlastNCBIApiError(
+                        f"BLAST job {job.rid} not ready after {self.api.max_wait} seconds"
+                    ),
+                )
+                return
+
+            with self._condition:
+                job.poll_interval = min(
+                    job.poll_interval * self.poll_backoff, self.max_poll_interval
+                )
+                job.next_poll = time.monotonic() + job.poll_interval
+            logger.debug(f"BLAST job {job.rid} waiting, next poll in {job.poll_interval:.0f} s")
+            return
+
+        if status != "READY":
+            self._finish(
+                job, error=BlastNCBIApiError(f"BLAST job {job.rid} finished with status {status}")
+            )
+            return
+
+        # Downloading the results is one more request
+        self._bucket.acquire()
+        try:
+            reports = self.api.fetch_reports(rid=job.rid)
+        except Exception as error:
+            if self._retry_later(job, error):
+                with self._condition:
+                    job.next_poll = time.monotonic()
+            return
+
+        self._request_succeeded()
+        METRICS.record("megablast_scheduler.queue_wait", time.monotonic() - job.submitted_at)
+
+        if len(reports) != len(job.sequences):
+            self._finish(
+                job,
+                error=BlastNCBIApiError(
+                    f"Expected {len(job.sequences)} query reports for RID {job.rid} and got "
+                    f"{len(reports)}"
+                ),
+            )
+            return
+
+        try:
+            results = [
+                self.api.parse_report(report=report, query=sequence, rid=job.rid)
+                for report, sequence in zip(reports, job.sequences)
+            ]
+        except Exception as error:
+            self._finish(job, error=error)
+            return
+
+        logger.info(f"BLAST job {job.rid} ready after {job.num_polls} status requests")
+        self._finish(job, results=results)
+
+    def _finish(
+        self,
+        job: ScheduledJob,
+        results: Optional[List[QueryResults]] = None,
+        error: Optional[BaseException] = None,
+    ) -> None:
+        with self._condition:
+            self._outstanding.remove(job)
+            self._condition.notify_all()
+
+        if error is not None:
+            job.future.set_exception(error)
+        else:
+            job.future.set_result(results)
+
+    def _retry_later(self, job: ScheduledJob, error: BaseException) -> bool:
+        """
+        Handle the error of a request of "job". Throttling and server errors pause every request
+        (adaptive backoff) and return True, so the request is repeated later. Any other error
+        fails the job.
+        """
+        if not is_transient_error(error):
+            logger.error(f"Request of BLAST job {job.rid or job.order} failed: {error}")
+            self._finish(job, error=error)
+            return False
+
+        self._error_backoff = min(
+            max(self._error_backoff * 2, self.request_interval), self.max_error_backoff
+        )
+        logger.warning(
+            f"NCBI request failed ({error}), pausing all requests for {self._error_backoff:.0f} s"
+        )
+        self._bucket.pause(self._error_backoff)
+
+        return True
+
+    def _request_succeeded(self) -> None:
+        if self._error_backoff:
+            logger.info("NCBI requests succeeding again, backoff reset")
+        self._error_backoff = 0.0
+
+
+@dataclass
+class ScheduledBlastSession:
+    """
+    MEGABLAST session of a worker that sends its queries through a shared "BlastScheduler".
+    It can replace "BlastNCBI" or "BlastNCBIApi" in the query functions and session pools.
+    """
+
+    scheduler: BlastScheduler
+
+    def configure_browser(self, download_path: str, driver_path: str = "") -> None:
+        """
+        Nothing to configure, kept so the session can replace "BlastNCBI" directly.
+        """
+
+    def quit(self) -> None:
+        """
+        Nothing to close, the scheduler is shared by every session and closed by its owner.
+        """
+
+    def is_cached(self, sequence: str, crop: Optional[Tuple[int, int]] = None) -> bool:
+        """
+        Whether the results of a sequence, or of its "crop" window, are in the result cache.
+        """
+        api = self.scheduler.api
+        return is_cached(api.cache, api.cache_parameters, sequence, crop)
+
+    def query_sequence(
+        self, sequence: str, crop: Optional[Tuple[int, int]] = None
+    ) -> QueryResults:
+        return self.query_batch(sequences=[sequence], crop=crop)[0]
+
+    def query_batch(
+        self, sequences: List[str], crop: Optional[Tuple[int, int]] = None
+    ) -> List[QueryResults]:
+        return self.scheduler.query_batch(sequences=sequences, crop=crop)
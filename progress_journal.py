@@ -0,0 +1,119 @@
+from dataclasses import dataclass, field
+import json
+import os
+import threading
+import time
+from typing import Dict, List, Optional
+
+from loguru import logger
+
+
+@dataclass
+class ProgressJournal:
+    """
+    Append-only journal (one JSON object per line) with the progress of a plate. For every
+    sequence and task (e.g. "full" or "10-1100_crop") it records when the work started, which
+    output files were written and when it was completed.
+
+    When a run is restarted, tasks completed with all their outputs still on disk are skipped,
+    while tasks that were started but not completed (half-written outputs) are done again.
+    """
+
+    journal_path: str
+    _completed: Dict[str, dict] = field(init=False, default_factory=dict)
+    _lock: threading.Lock = field(init=False, default_factory=threading.Lock)
+
+    def __post_init__(self) -> None:
+        os.makedirs(os.path.dirname(os.path.abspath(self.journal_path)), exist_ok=True)
+
+        if not os.path.exists(self.journal_path):
+            return
+
+        # Replay the journal, the last event of every task wins
+        line = ""
+        with open(self.journal_path) as file:
+            for line in file:
+                try:
+                    event = json.loads(line)
+                except json.JSONDecodeError:
+                    # Last line may be cut if the previous run crashed while writing it
+                    continue
+
+                key = self._task_key(event["sequence_id"], event["task"])
+                if event["event"] == "completed":
+                    self._completed[key] = event
+                else:
+                    self._completed.pop(key, None)
+
+            # Start a new line after a cut line, so the next event is not appended to it
+            if line and not line.endswith("\n"):
+                with open(self.journal_path, "a") as journal_file:
+                    journal_file.write("\n")
+
+        logger.info(f"Progress journal loaded with {len(self._completed)} completed tasks")
+
+    def is_completed(self, sequence_id: str, task: str) -> bool:
+        """
+        Whether a task was completed in a previous run and all its outputs still exist.
+        """
+        return self.completed_details(sequence_id, task) is not None
+
+    def completed_details(self, sequence_id: str, task: str) -> Optional[dict]:
+        """
+        Return the details recorded when a task was completed, or None if it must be done
+        (again) because it was never completed or any of its outputs is missing.
+        """
+        with self._lock:
+            event = self._completed.get(self._task_key(sequence_id, task))
+
+        if event is None:
+            return None
+
+        missing_outputs = [path for path in event["outputs"] if not os.path.exists(path)]
+        if missing_outputs:
+            logger.warning(f"{sequence_id} {task} is missing {missing_outputs}, redoing it")
+            return None
+
+        return event["details"]
+
+    def record_started(self, sequence_id: str, task: str) -> None:
+        """
+        Record that a task started, so it is done again if it is not completed.
+        """
+        self._append({"event": "started", "sequence_id": sequence_id, "task": task})
+
+    def record_completed(
+        self, sequence_id: str, task: str, outputs: List[str], details: Optional[dict] = None
+    ) -> None:
+        """
+        Record that a task finished and wrote "outputs". "details" stores any information needed
+        by later tasks (e.g. whether the full query had an error).
+        """
+        self._append(
+            {
+                "event": "completed",
+                "sequence_id": sequence_id,
+                "task": task,
+                "outputs": outputs,
+                "details": details or {},
+            }
+        )
+
+    def _append(self, event: dict) -> None:
+        event["time"] = time.time()
+
+        with self._lock:
+            with open(self.journal_path, "a") as file:
+                file.write(json.dumps(event) + "\n")
+                file.flush()
+                os.fsync(file.fileno())
+
+            key = self._task_key(event["sequence_id"], event["task"])
+            if event["event"] == "completed":
+                self._completed[key] = event
+            else:
+                self._completed.pop(key, None)
+
+    @staticmethod
+    def _task_key(sequence_id: str, task: str) -> str:
+        return f"{sequence_id}/{task}"
@@ -0,0 +1,9 @@
+from typing import Tuple
+
+# Windows of the sequence ("sequence[start:end]") queried besides the full sequence
+CROP_WINDOWS = [(10, 1100)]
+FULL_TASK = "full"
+
+
+def crop_task(window: Tuple[int, int]) -> str:
+    return f"{window[0]}-{window[1]}_crop"
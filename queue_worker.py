@@ -0,0 +1,409 @@
+from dataclasses import dataclass, field
+import os
+import socket
+import threading
+import time
+from typing import Any, List, Optional, Tuple
+
+from loguru import logger
+
+from blast_ncbi import BlastNCBI, QueryResults, decode_query_results, encode_query_results
+from blast_ncbi_api import BlastNCBIApi
+from crop_derivation import derive_crop_results
+from data_saver import PlateReport, save_alignments_to_notes, save_results_in_word
+from job_queue import (
+    BLAST_CROP,
+    BLAST_FULL,
+    JOB_KINDS,
+    LEASED,
+    PENDING,
+    SEQMATCH,
+    Job,
+    JobQueue,
+    QueueRateLimiter,
+)
+from metrics import METRICS
+from ncbi_scheduler import NCBI_REQUEST_INTERVAL, BlastScheduler, ScheduledBlastSession
+from query_tasks import CROP_WINDOWS, FULL_TASK, crop_task
+from result_cache import ResultCache
+from results_store import ResultsStore
+from sequence_matcher import SequenceMatcher, create_matcher_session, match_sequence
+from sequence_reader import (
+    CorrectedSequence,
+    iter_plate_files,
+    read_corrected_sequences,
+    read_plate_file,
+)
+
+# Name of the rate limit of the requests to NCBI in the queue database
+NCBI_RATE_LIMIT = "ncbi"
+
+
+def enqueue_plate(
+    queue: JobQueue,
+    dir_files: str,
+    crop_windows: List[Tuple[int, int]] = CROP_WINDOWS,
+    description_dir: Optional[str] = None,
+    alignments_dir: Optional[str] = None,
+    priority: int = 0,
+) -> int:
+    """
+    Enqueue the MEGABLAST queries of every plate .txt file in "dir_files": the full sequence and,
+    once it is done, its "crop_windows". Results are written to "description_dir" and
+    "alignments_dir" ("Descriptions" and "Alignments" in the plate directory by default).
+    Returns the number of sequences enqueued.
+    """
+    plate = os.path.basename(os.path.normpath(dir_files))
+    output_dirs = {
+        "description_dir": description_dir or os.path.join(dir_files, "Descriptions"),
+        "alignments_dir": alignments_dir or os.path.join(dir_files, "Alignments"),
+    }
+
+    num_sequences = 0
+    for file in iter_plate_files(dir_files):
+        sequence_id, sequence = read_plate_file(file)
+
+        full_job = queue.enqueue(
+            BLAST_FULL,
+            plate,
+            sequence_id,
+            FULL_TASK,
+            payload={"sequence": sequence, **output_dirs},
+            priority=priority,
+        )
+        for window in crop_windows:
+            queue.enqueue(
+                BLAST_CROP,
+                plate,
+                sequence_id,
+                crop_task(window),
+                payload={"sequence": sequence, "window": list(window), **output_dirs},
+                priority=priority,
+                depends_on=full_job,
+            )
+        num_sequences += 1
+
+    logger.info(f"{num_sequences} sequences of plate {plate} enqueued")
+    return num_sequences
+
+
+def enqueue_corrected_sequences(
+    queue: JobQueue, path: str, plate: str, output_dir: str, priority: int = 0
+) -> int:
+    """
+    Enqueue the SeqMatch query of every sequence of a corrected sequences file, whose output
+    files are written to "output_dir". Returns the number of sequences enqueued.
+    """
+    num_sequences = 0
+    for sequence in read_corrected_sequences(path):
+        queue.enqueue(
+            SEQMATCH,
+            plate,
+            sequence.id,
+            SEQMATCH,
+            payload={
+                "sequence": sequence.sequence,
+                "specie_name": sequence.specie_name,
+                "num_seq": sequence.num_seq,
+                "output_dir": output_dir,
+            },
+            priority=priority,
+        )
+        num_sequences += 1
+
+    logger.info(f"{num_sequences} corrected sequences of {plate} enqueued")
+    return num_sequences
+
+
+def save_job_results(job: Job, results: QueryResults) -> List[str]:
+    """
+    Save the species table and the alignments of a MEGABLAST job in the directories of its
+    payload. Returns the paths of the files written.
+    """
+    species_results, alignments, _ = results
+    file_name = f"{job.sequence_id}_{job.task}"
+
+    save_alignments_to_notes(
+        path=job.payload["alignments_dir"], file_name=file_name, alignments=alignments
+    )
+    save_results_in_word(
+        path=job.payload["description_dir"], file_name=file_name, species=species_results
+    )
+
+    return [
+        f"{job.payload['description_dir']}/{file_name}.docx",
+        f"{job.payload['alignments_dir']}/{file_name}.txt",
+    ]
+
+
+def build_plate_report(
+    queue: JobQueue, plate: str, path: str, html: bool = False, csv: bool = False
+) -> List[str]:
+    """
+    Save the report of a plate with the species tables of all its MEGABLAST jobs done so far,
+    whichever worker ran them. Returns the paths of the files written.
+    """
+    report = PlateReport(path=path, file_name=f"{plate}_report", html=html, csv=csv)
+
+    for job in queue.done_jobs(plate, kinds=[BLAST_FULL, BLAST_CROP]):
+        result = queue.result(job.id)
+        if result is None or "results" not in result:
+            continue
+
+        species_results, _, _ = decode_query_results(result["results"])
+        report.add_results(f"{job.sequence_id}_{job.task}", species_results)
+
+    return report.save()
+
+
+@dataclass
+class QueueWorker:
+    """
+    Worker process of a "JobQueue": leases jobs of "kinds" one at a time, runs them and records
+    their results, heartbeating while a job runs so its lease does not expire. Every machine can
+    run as many workers as it can afford, sharing the same queue database.
+
+    MEGABLAST jobs use the "backend" ("api" or "selenium") and SeqMatch jobs a headless browser
+    with the ChromeDriver at "driver_path". Sessions are opened on the first job that needs them
+    and downloads go to "{work_dir}/{worker_id}". Requests to NCBI are rate limited through the
+    queue database, so all the workers together stay within the NCBI limits however many run.
+    With a results "store", the hits of every MEGABLAST job are also appended to it.
+
+    Stage timings are logged (and exported to "metrics_path" when given) every
+    "metrics_interval" jobs and when the worker stops, and then cleared.
+    """
+
+    queue: JobQueue
+    kinds: List[str] = field(default_factory=lambda: list(JOB_KINDS))
+    worker_id: str = field(default_factory=lambda: f"{socket.gethostname()}-{os.getpid()}")
+    backend: str = "api"
+    driver_path: str = ""
+    work_dir: str = "queue_workers"
+    cache: Optional[ResultCache] = None
+    derive_crops: bool = True
+    poll_interval: float = 30
+    store: Optional[ResultsStore] = None
+    metrics_path: Optional[str] = None
+    metrics_interval: int = 25
+    _blast_session: Optional[Any] = field(init=False, default=None)
+    _scheduler: Optional[BlastScheduler] = field(init=False, default=None)
+    _matcher: Optional[SequenceMatcher] = field(init=False, default=None)
+
+    @property
+    def download_path(self) -> str:
+        download_path = os.path.join(self.work_dir, self.worker_id)
+        os.makedirs(download_path, exist_ok=True)
+
+        return download_path
+
+    def run(self, stop_when_empty: bool = True, max_jobs: int = 0) -> int:
+        """
+        Process jobs until the queue has no pending or leased jobs of "kinds" left
+        ("stop_when_empty") or "max_jobs" jobs have been processed (0 for no limit). Otherwise,
+        it waits "poll_interval" seconds for new jobs. Returns the number of jobs processed.
+        """
+        logger.info(f"Worker {self.worker_id} processing {self.kinds} jobs")
+        num_jobs = 0
+
+        try:
+            while not max_jobs or num_jobs < max_jobs:
+                jobs = self.queue.lease(self.worker_id, kinds=self.kinds)
+                if not jobs:
+                    counts = self.queue.counts(kinds=self.kinds)
+                    if stop_when_empty and counts[PENDING] == counts[LEASED] == 0:
+                        break
+
+                    # Jobs may be leased by other workers, or wait for jobs they depend on
+                    time.sleep(self.poll_interval)
+                    continue
+
+                self.process(jobs[0])
+                num_jobs += 1
+                if num_jobs % self.metrics_interval == 0:
+                    METRICS.flush(self.metrics_path)
+        finally:
+            self.close()
+            METRICS.flush(self.metrics_path)
+
+        logger.info(f"Worker {self.worker_id} finished after {num_jobs} jobs")
+        return num_jobs
+
+    def process(self, job: Job) -> bool:
+        """
+        Run a leased job and record its result or error. Returns whether it was completed.
+        """
+        logger.info(
+            f"Processing {job.kind} {job.sequence_id} {job.task} of plate {job.plate} "
+            f"(attempt {job.attempts})"
+        )
+
+        finished = threading.Event()
+        heartbeat = threading.Thread(
+            target=self._heartbeat, args=(job, finished), name=f"heartbeat_{job.id}", daemon=True
+        )
+        heartbeat.start()
+
+        try:
+            if job.kind == BLAST_FULL:
+                result = self._run_blast_full(job)
+            elif job.kind == BLAST_CROP:
+                result = self._run_blast_crop(job)
+            else:
+                result = self._run_seqmatch(job)
+        except Exception as error:
+            logger.exception(f"Job {job.id} ({job.sequence_id} {job.task}) failed")
+            self.queue.fail(job.id, self.worker_id, repr(error))
+            return False
+        finally:
+            finished.set()
+            heartbeat.join()
+
+        if not self.queue.complete(job.id, self.worker_id, result):
+            logger.warning(f"Lease of job {job.id} was lost, its result is discarded")
+            return False
+
+        return True
+
+    def close(self) -> None:
+        if self._blast_session is not None:
+            self._blast_session.quit()
+            self._blast_session = None
+        if self._scheduler is not None:
+            self._scheduler.close()
+            self._scheduler = None
+        if self._matcher is not None:
+            self._matcher.quit()
+            self._matcher = None
+
+    def _heartbeat(self, job: Job, finished: threading.Event) -> None:
+        """
+        Extend the lease of a job three times per lease timeout until it finishes.
+        """
+        while not finished.wait(self.queue.lease_timeout / 3):
+            if not self.queue.heartbeat(job.id, self.worker_id):
+                logger.warning(f"Lease of job {job.id} lost, another worker may redo it")
+                return
+
+    def _blast(self) -> Any:
+        if self._blast_session is not None:
+            return self._blast_session
+
+        # Shared by the workers of every machine, the NCBI limits are per user and not per process
+        limiter = QueueRateLimiter(
+            queue=self.queue, name=NCBI_RATE_LIMIT, rate=1 / NCBI_REQUEST_INTERVAL
+        )
+        if self.backend == "api":
+            self._scheduler = BlastScheduler(api=BlastNCBIApi(cache=self.cache), limiter=limiter)
+            self._blast_session = ScheduledBlastSession(scheduler=self._scheduler)
+        else:
+            self._blast_session = BlastNCBI(cache=self.cache, submit_limiter=limiter)
+            self._blast_session.configure_browser(
+                download_path=self.download_path, driver_path=self.driver_path
+            )
+
+        return self._blast_session
+
+    def _run_blast_full(self, job: Job) -> dict:
+        results = self._blast().query_sequence(job.payload["sequence"])
+
+        if self.store is not None:
+            self.store.add_results(job.plate, job.sequence_id, job.task, results[0], results[2])
+
+        return {
+            "outputs": save_job_results(job, results),
+            "error": results[2],
+            "results": encode_query_results(results),
+        }
+
+    def _run_blast_crop(self, job: Job) -> dict:
+        sequence = job.payload["sequence"]
+        window = (job.payload["window"][0], job.payload["window"][1])
+
+        # If there has been an error finding similar species to a sequence, it is not cropped
+        full_result = self.queue.result(job.depends_on) if job.depends_on is not None else None
+        if full_result is not None and full_result["error"]:
+            logger.info(f"Full sequence of {job.sequence_id} had an error, not cropping it")
+            return {"outputs": [], "error": True, "skipped": True}
+
+        # Recompute the crop from the full alignment when it can be trusted
+        results = None
+        if self.derive_crops and full_result is not None:
+            results = derive_crop_results(
+                decode_query_results(full_result["results"]),
+                window=window,
+                query_length=len(sequence),
+            )
+        if results is None:
+            results = self._blast().query_sequence(sequence, crop=window)
+
+        if self.store is not None:
+            self.store.add_results(job.plate, job.sequence_id, job.task, results[0], results[2])
+
+        return {
+            "outputs": save_job_results(job, results),
+            "error": results[2],
+            "results": encode_query_results(results),
+        }
+
+    def _run_seqmatch(self, job: Job) -> dict:
+        if self._matcher is None:
+            self._matcher = create_matcher_session(
+                self.download_path,
+                self.driver_path,
+                cache=self.cache,
+                headless=True,
+                block_resources=True,
+                max_queries=25,
+            )
+
+        sequence = CorrectedSequence(
+            id=job.sequence_id,
+            specie_name=job.payload["specie_name"],
+            sequence=job.payload["sequence"],
+            num_seq=job.payload["num_seq"],
+        )
+        output_dir = job.payload["output_dir"]
+        os.makedirs(output_dir, exist_ok=True)
+
+        return {"outputs": match_sequence(self._matcher, [sequence], output_dir=output_dir)}
+
+
+if __name__ == "__main__":
+    PATH_CHROME_DRIVER = "C:/Program Files (x86)/chromedriver.exe"
+    dir_data = "C:/Users/alber/Desktop/Sequence_automations/data"
+    plates = ["Placa_1", "Placa_2", "Placa_3"]
+
+    # Every machine runs this script against the same queue on the shared drive. Plates already
+    # enqueued are not enqueued again.
+    queue = JobQueue(db_path=f"{dir_data}/job_queue.sqlite", wal=False)
+    for priority, plate in enumerate(plates):
+        enqueue_plate(queue, f"{dir_data}/{plate}/", priority=priority)
+        enqueue_corrected_sequences(
+            queue,
+            f"{dir_data}/{plate}/Sequence_match/Secuencias_corregidas.txt",
+            plate=plate,
+            output_dir=f"{dir_data}/{plate}/Sequence_match",
+            priority=priority,
+        )
+
+    result_cache = ResultCache(db_path=f"{dir_data}/result_cache.sqlite")
+    results_store = ResultsStore(db_path=f"{dir_data}/results_store.sqlite", wal=False)
+    worker = QueueWorker(
+        queue=queue,
+        backend="api",
+        driver_path=PATH_CHROME_DRIVER,
+        work_dir=f"{dir_data}/queue_workers",
+        cache=result_cache,
+        store=results_store,
+    )
+    worker.run(stop_when_empty=True)
+
+    for plate in plates:
+        counts = queue.counts(plate)
+        logger.info(f"Plate {plate}: {counts}")
+        if counts[PENDING] == counts[LEASED] == 0:
+            build_plate_report(queue, plate, path=f"{dir_data}/{plate}/Descriptions", html=True)
+
+    result_cache.close()
+    results_store.close()
+    queue.close()
@@ -0,0 +1,161 @@
+from dataclasses import dataclass, field
+import hashlib
+import json
+import re
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, Optional
+
+from loguru import logger
+
+
+def normalize_sequence(sequence: str) -> str:
+    """
+    Normalize a nucleotide sequence so that equivalent reads compare equal: upper case, without
+    whitespace and without gap characters ("-" and ".").
+    """
+    return re.sub(r"[\s\-.]", "", sequence).upper()
+
+
+@dataclass
+class ResultCache:
+    """
+    Persistent SQLite cache of query results. Entries are addressed by a hash of the normalized
+    sequence plus the query parameters, so the same sequence queried with the same settings is
+    only sent to the remote service once.
+
+    Entries older than "ttl" seconds are discarded and, when there are more than "max_entries",
+    the least recently used ones are evicted. "None" disables either limit.
+    """
+
+    db_path: str
+    ttl: Optional[float] = 30 * 24 * 3600
+    max_entries: Optional[int] = 100_000
+    hits: int = field(init=False, default=0)
+    misses: int = field(init=False, default=0)
+    _connection: sqlite3.Connection = field(init=False, repr=False)
+    _lock: threading.Lock = field(init=False, repr=False, default_factory=threading.Lock)
+
+    def __post_init__(self) -> None:
+        self._connection = sqlite3.connect(self.db_path, check_same_thread=False)
+        self._connection.execute(
+            """
+            CREATE TABLE IF NOT EXISTS results (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                accessed_at REAL NOT NULL
+            )
+            """
+        )
+        self._connection.execute(
+            "CREATE INDEX IF NOT EXISTS results_accessed_at ON results (accessed_at)"
+        )
+        self._connection.commit()
+
+    @staticmethod
+    def make_key(sequence: str, **parameters: Any) -> str:
+        """
+        Build the cache key of a query from the sequence submitted (the crop itself for a crop
+        window) and the query parameters (database, flags, top-N...).
+        """
+        key_data = json.dumps(
+            {"sequence": normalize_sequence(sequence), "parameters": parameters},
+            sort_keys=True,
+        )
+
+        return hashlib.sha256(key_data.encode()).hexdigest()
+
+    def get(self, key: str) -> Optional[Any]:
+        """
+        Return the value stored for "key", or None if it is missing or has expired.
+        """
+        now = time.time()
+
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT value, created_at FROM results WHERE key = ?", (key,)
+            ).fetchone()
+
+            if row is None or (self.ttl is not None and now - row[1] > self.ttl):
+                self.misses += 1
+                return None
+
+            self._connection.execute(
+                "UPDATE results SET accessed_at = ? WHERE key = ?", (now, key)
+            )
+            self._connection.commit()
+            self.hits += 1
+
+        return json.loads(row[0])
+
+    def contains(self, key: str) -> bool:
+        """
+        Whether a value that has not expired is stored for "key", without counting it as a
+        lookup.
+        """
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT created_at FROM results WHERE key = ?", (key,)
+            ).fetchone()
+
+        return row is not None and (self.ttl is None or time.time() - row[0] <= self.ttl)
+
+    def put(self, key: str, value: Any) -> None:
+        """
+        Store a JSON-serializable value for "key" and evict old entries if needed.
+        """
+        now = time.time()
+
+        with self._lock:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO results (key, value, created_at, accessed_at) "
+                "VALUES (?, ?, ?, ?)",
+                (key, json.dumps(value), now, now),
+            )
+            self._evict(now)
+            self._connection.commit()
+
+    def stats(self) -> Dict[str, float]:
+        """
+        Return the hit and miss counters of this cache instance and the number of entries.
+        """
+        with self._lock:
+            num_entries = self._connection.execute("SELECT COUNT(*) FROM results").fetchone()[0]
+
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "entries": num_entries,
+        }
+
+    def close(self) -> None:
+        with self._lock:
+            self._connection.close()
+
+        logger.info(f"Result cache stats: {self.stats_summary()}")
+
+    def stats_summary(self) -> str:
+        lookups = self.hits + self.misses
+        hit_rate = self.hits / lookups * 100 if lookups else 0.0
+        return f"{self.hits} hits, {self.misses} misses ({hit_rate:.1f}% hit rate)"
+
+    def _evict(self, now: float) -> None:
+        """
+        Remove expired entries and, above "max_entries", the least recently used ones.
+        """
+        if self.ttl is not None:
+            self._connection.execute("DELETE FROM results WHERE created_at < ?", (now - self.ttl,))
+
+        if self.max_entries is not None:
+            self._connection.execute(
+                """
+                DELETE FROM results WHERE key IN (
+                    SELECT key FROM results ORDER BY accessed_at DESC LIMIT -1 OFFSET ?
+                )
+                """,
+                (self.max_entries,),
+            )
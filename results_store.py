@@ -0,0 +1,300 @@
+from dataclasses import dataclass, field
+import sqlite3
+import threading
+import time
+from typing import List, Optional
+
+from loguru import logger
+
+from blast_ncbi import BlastNCBIResults
+
+# Columns of the hits table, in the order of the fields of "BlastNCBIResults"
+HIT_COLUMNS = (
+    "description, description_url, scientific_name, scientific_name_url, max_score, "
+    "total_score, query_cover, e_value, per_indentity, accession_len, accession, accession_url"
+)
+
+# Columns read into a "StoredHit", in order
+STORED_HIT_COLUMNS = (
+    "queries.plate, queries.sequence_id, queries.task, queries.recorded_at, hits.rank, "
+    + ", ".join(f"hits.{column}" for column in HIT_COLUMNS.split(", "))
+)
+
+# Only the last results recorded for every query count, those of earlier runs are kept as history
+LATEST_QUERY = """
+    queries.id = (
+        SELECT MAX(previous.id) FROM queries AS previous
+        WHERE previous.plate = queries.plate
+            AND previous.sequence_id = queries.sequence_id
+            AND previous.task = queries.task
+    )
+"""
+
+
+@dataclass
+class StoredHit:
+    plate: str
+    sequence_id: str
+    task: str
+    recorded_at: float
+    rank: int
+    result: BlastNCBIResults
+
+    @property
+    def section(self) -> str:
+        return f"{self.sequence_id}_{self.task}"
+
+
+@dataclass
+class ResultsStore:
+    """
+    Append-only SQLite store of the MEGABLAST hits of every query of every plate, across runs.
+    Hits are indexed by sequence ID, accession and scientific name (case insensitive), so
+    questions such as "which samples hit MK312485.1" or "which samples have a top identity below
+    97%" are answered without opening the report files.
+
+    Results recorded again for a query (e.g. it was redone) don't replace the previous ones, but
+    the queries only return the latest results of every (plate, sequence, task).
+    """
+
+    db_path: str
+    wal: bool = True
+    _connection: sqlite3.Connection = field(init=False, repr=False)
+    _lock: threading.Lock = field(init=False, repr=False, default_factory=threading.Lock)
+
+    def __post_init__(self) -> None:
+        self._connection = sqlite3.connect(self.db_path, timeout=60, check_same_thread=False)
+        if self.wal:
+            self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS queries (
+                id INTEGER PRIMARY KEY,
+                plate TEXT NOT NULL,
+                sequence_id TEXT NOT NULL,
+                task TEXT NOT NULL,
+                error INTEGER NOT NULL,
+                num_hits INTEGER NOT NULL,
+                recorded_at REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS hits (
+                query_id INTEGER NOT NULL REFERENCES queries (id),
+                rank INTEGER NOT NULL,
+                description TEXT NOT NULL,
+                description_url TEXT NOT NULL,
+                scientific_name TEXT NOT NULL COLLATE NOCASE,
+                scientific_name_url TEXT NOT NULL,
+                max_score INTEGER NOT NULL,
+                total_score INTEGER NOT NULL,
+                query_cover REAL NOT NULL,
+                e_value REAL NOT NULL,
+                per_indentity REAL NOT NULL,
+                accession_len INTEGER NOT NULL,
+                accession TEXT NOT NULL,
+                accession_url TEXT NOT NULL,
+                PRIMARY KEY (query_id, rank)
+            );
+            CREATE INDEX IF NOT EXISTS queries_query ON queries (plate, sequence_id, task, id);
+            CREATE INDEX IF NOT EXISTS queries_sequence_id ON queries (sequence_id);
+            CREATE INDEX IF NOT EXISTS hits_accession ON hits (accession);
+            CREATE INDEX IF NOT EXISTS hits_scientific_name ON hits (scientific_name);
+            CREATE INDEX IF NOT EXISTS hits_rank_identity ON hits (rank, per_indentity);
+            """
+        )
+        self._connection.commit()
+
+    def add_results(
+        self,
+        plate: str,
+        sequence_id: str,
+        task: str,
+        species_results: List[BlastNCBIResults],
+        error: bool,
+    ) -> int:
+        """
+        Append the hits of a query (the full sequence or a crop of a plate sequence), ranked in
+        the order they were found. Returns the ID of the query.
+        """
+        with self._lock:
+            cursor = self._connection.execute(
+                """
+                INSERT INTO queries (plate, sequence_id, task, error, num_hits, recorded_at)
+                VALUES (?, ?, ?, ?, ?, ?)
+                """,
+                (plate, sequence_id, task, error, len(species_results), time.time()),
+            )
+            query_id = cursor.lastrowid
+            self._connection.executemany(
+                f"""
+                INSERT INTO hits (query_id, rank, {HIT_COLUMNS})
+                VALUES (?, ?, {", ".join("?" for _ in HIT_COLUMNS.split(", "))})
+                """,
+                [
+                    (
+                        query_id,
+                        rank,
+                        specie.description,
+                        specie.description_url,
+                        specie.scientific_name,
+                        specie.scientific_name_url,
+                        specie.max_score,
+                        specie.total_score,
+                        specie.query_cover,
+                        specie.e_value,
+                        specie.per_indentity,
+                        specie.accession_len,
+                        specie.accession,
+                        specie.accession_url,
+                    )
+                    for rank, specie in enumerate(species_results, start=1)
+                ],
+            )
+            self._connection.commit()
+
+        logger.debug(f"{len(species_results)} hits of {sequence_id} {task} stored")
+        return query_id
+
+    def has_results(self, plate: str, sequence_id: str, task: str) -> bool:
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT 1 FROM queries WHERE plate = ? AND sequence_id = ? AND task = ? LIMIT 1",
+                (plate, sequence_id, task),
+            ).fetchone()
+
+        return row is not None
+
+    def hits_of_sequence(
+        self, sequence_id: str, task: Optional[str] = None, plate: Optional[str] = None
+    ) -> List[StoredHit]:
+        """
+        Hits of a sequence, of every task (or only "task") and plate (or only "plate").
+        """
+        conditions = ["queries.sequence_id = ?"]
+        parameters: list = [sequence_id]
+        if task is not None:
+            conditions.append("queries.task = ?")
+            parameters.append(task)
+        if plate is not None:
+            conditions.append("queries.plate = ?")
+            parameters.append(plate)
+
+        return self._select(conditions, parameters)
+
+    def hits_of_accession(self, accession: str, max_rank: Optional[int] = None) -> List[StoredHit]:
+        """
+        Hits of every sample with the "accession" (e.g. MK312485.1) among its hits, or among its
+        top "max_rank" hits.
+        """
+        conditions = ["hits.accession = ?"]
+        parameters: list = [accession]
+        if max_rank is not None:
+            conditions.append("hits.rank <= ?")
+            parameters.append(max_rank)
+
+        return self._select(conditions, parameters)
+
+    def hits_of_species(
+        self, scientific_name: str, max_rank: Optional[int] = None
+    ) -> List[StoredHit]:
+        """
+        Hits of every sample with the species "scientific_name" (case insensitive) among its hits,
+        or among its top "max_rank" hits.
+        """
+        conditions = ["hits.scientific_name = ?"]
+        parameters: list = [scientific_name]
+        if max_rank is not None:
+            conditions.append("hits.rank <= ?")
+            parameters.append(max_rank)
+
+        return self._select(conditions, parameters)
+
+    def top_hits(
+        self,
+        min_identity: Optional[float] = None,
+        max_identity: Optional[float] = None,
+        task: Optional[str] = None,
+        plate: Optional[str] = None,
+    ) -> List[StoredHit]:
+        """
+        Best hit of every query whose identity (percentage) is at least "min_identity" and below
+        "max_identity", e.g. "top_hits(max_identity=97)" for the samples that may be new species.
+        """
+        conditions = ["hits.rank = 1"]
+        parameters: list = list()
+        if min_identity is not None:
+            conditions.append("hits.per_indentity >= ?")
+            parameters.append(min_identity)
+        if max_identity is not None:
+            conditions.append("hits.per_indentity < ?")
+            parameters.append(max_identity)
+        if task is not None:
+            conditions.append("queries.task = ?")
+            parameters.append(task)
+        if plate is not None:
+            conditions.append("queries.plate = ?")
+            parameters.append(plate)
+
+        return self._select(conditions, parameters)
+
+    def plates(self) -> List[str]:
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT DISTINCT plate FROM queries ORDER BY plate"
+            ).fetchall()
+
+        return [row[0] for row in rows]
+
+    def close(self) -> None:
+        with self._lock:
+            self._connection.close()
+
+    def _select(self, conditions: List[str], parameters: list) -> List[StoredHit]:
+        """
+        Hits of the latest results of every query that meet all the "conditions".
+        """
+        with self._lock:
+            rows = self._connection.execute(
+                f"""
+                SELECT {STORED_HIT_COLUMNS}
+                FROM hits JOIN queries ON queries.id = hits.query_id
+                WHERE {" AND ".join(conditions)} AND {LATEST_QUERY}
+                ORDER BY queries.plate, queries.sequence_id, queries.task, hits.rank
+                """,
+                parameters,
+            ).fetchall()
+
+        return [
+            StoredHit(
+                plate=plate,
+                sequence_id=sequence_id,
+                task=task,
+                recorded_at=recorded_at,
+                rank=rank,
+                result=BlastNCBIResults(*values),
+            )
+            for plate, sequence_id, task, recorded_at, rank, *values in rows
+        ]
+
+
+@dataclass
+class PlateResults:
+    """
+    Writer of the results of one plate into a "ResultsStore".
+    """
+
+    store: ResultsStore
+    plate: str
+
+    def add_results(
+        self, sequence_id: str, task: str, species_results: List[BlastNCBIResults], error: bool
+    ) -> None:
+        self.store.add_results(self.plate, sequence_id, task, species_results, error)
+
+    def add_missing_results(
+        self, sequence_id: str, task: str, species_results: List[BlastNCBIResults], error: bool
+    ) -> None:
+        """
+        Add the results of a query completed in a previous run, unless they are already stored.
+        """
+        if not self.store.has_results(self.plate, sequence_id, task):
+            self.add_results(sequence_id, task, species_results, error)
@@ -0,0 +1,34 @@
+import hashlib
+from typing import Callable, Dict, Iterable, List, TypeVar
+
+from loguru import logger
+
+T = TypeVar("T")
+
+
+def sequence_hash(sequence: str) -> str:
+    """
+    Hash of the sequence exactly as read. Reads that differ in case or gaps are not merged: crops
+    are sliced from the representative, so every read of a group must have the same positions.
+    """
+    return hashlib.sha256(sequence.encode()).hexdigest()
+
+
+def group_duplicates(items: Iterable[T], get_sequence: Callable[[T], str]) -> List[List[T]]:
+    """
+    Group the items (files, records...) whose sequences are exact duplicates. Groups keep the
+    order of their first item, which is the representative queried for the whole group, and items
+    keep their order within every group.
+    """
+    groups: Dict[str, List[T]] = dict()
+    for item in items:
+        groups.setdefault(sequence_hash(get_sequence(item)), []).append(item)
+
+    num_items = sum(len(group) for group in groups.values())
+    if num_items > len(groups):
+        logger.info(
+            f"{num_items} sequences grouped into {len(groups)} unique sequences, "
+            f"{num_items - len(groups)} duplicates will not be queried"
+        )
+
+    return list(groups.values())
@@ -1,72 +1,113 @@
 from dataclasses import dataclass, field
+from functools import partial
 import time
-import subprocess
-from typing import Dict, List, Tuple
+from typing import Dict, List, Optional, Tuple, Union
 import re
 from loguru import logger
 
 import os
 
 from selenium.webdriver.chrome.webdriver import WebDriver
+from selenium.webdriver.remote.webelement import WebElement
 from selenium.webdriver.common.by import By
-from selenium.webdriver.support.ui import WebDriverWait
 from selenium.webdriver.support import expected_conditions as EC
 from selenium import webdriver
 from selenium.common.exceptions import NoSuchElementException
 
-TIMING_FACTOR = 1
-
-
-@dataclass
-class RDPSequenceData:
-    id: str
-    # name: str
-    # strain: str
-    # other_id: str
-    sequence: str
-
-
-@dataclass
-class CorrectedSequence:
-    id: str
-    specie_name: str
-    sequence: str
-    num_seq: int
+from browser_processes import BrowserProcessTree, close_browser, track_browser
+from browser_waits import StepTimer, document_ready
+from download_watcher import DownloadWatcher
+from kmer_index import KmerIndex
+from metrics import METRICS, span, timed
+from progress_journal import ProgressJournal
+from result_cache import ResultCache
+from sequence_dedup import group_duplicates
+from sequence_reader import CorrectedSequence, iter_lines, read_corrected_sequences
+from session_pool import SessionPool
+
+
+# URL patterns not loaded with "block_resources": images, fonts and style sheets
+BLOCKED_URL_PATTERNS = [
+    "*.png",
+    "*.jpg",
+    "*.jpeg",
+    "*.gif",
+    "*.svg",
+    "*.ico",
+    "*.woff",
+    "*.woff2",
+    "*.ttf",
+    "*.otf",
+    "*.eot",
+    "*.css",
+]
 
 
 @dataclass
 class SequenceMatcher:
+    """
+    RDP SeqMatch session. The same browser is reused for every query: it is restarted (recycled)
+    after "max_queries" queries (0 never) and whenever a query fails, and the failed query is
+    retried on the new browser up to "max_retries" times.
+    """
+
     web_page: str = field(default="http://rdp.cme.msu.edu/seqmatch/")
+    cache: Optional[ResultCache] = None
+    step_timer: StepTimer = field(default_factory=StepTimer)
+    headless: bool = False
+    block_resources: bool = False
+    max_queries: int = 0
+    max_retries: int = 1
+    download_timeout: float = 120
     web_driver: WebDriver = field(init=False)
     download_path: str = field(init=False)
+    driver_path: str = field(init=False)
+    processes: BrowserProcessTree = field(init=False)
+    num_queries: int = field(init=False, default=0)
+
+    # Query options selected in the SeqMatch form, used in the result cache key
+    cache_parameters = {
+        "backend": "seqmatch",
+        "database": "RDPX-Bacteria-2",
+        "strain": "type",
+        "source": "isolates",
+        "size": "both",
+        "crop": None,
+    }
+
+    def __post_init__(self) -> None:
+        if self.max_retries < 0:
+            raise ValueError(f"max_retries must be 0 or greater, not {self.max_retries}")
 
     def quit(self) -> None:
         """
-        Removes webdriver and kills all Google Chrome and ChromeDriver processes.
+        Removes webdriver and terminates the Google Chrome and ChromeDriver processes of this
+        session, leaving other browsers of the machine running.
         """
-        self.web_driver.quit()
-        time.sleep(1 * TIMING_FACTOR)
-        subprocess.call("TASKKILL /f  /IM  CHROME.EXE")
-        subprocess.call("TASKKILL /f  /IM  CHROMEDRIVER.EXE")
-        time.sleep(1 * TIMING_FACTOR)
+        self.step_timer.log_report()
+        close_browser(self.web_driver, self.processes)
 
     def configure_browser(self, download_path: str, driver_path: str) -> WebDriver:
         """
         Configure Selenium browser and then returns the WebDriver object.
         """
         self.download_path = download_path
+        self.driver_path = driver_path
+        self.num_queries = 0
+
+        prefs = {
+            "download.default_directory": download_path,  # Change default directory for downloads
+            "download.prompt_for_download": False,  # To auto download the file
+            "download.directory_upgrade": True,
+            "plugins.always_open_pdf_externally": True,  # It will not show PDF directly in chrome
+        }
+        if self.block_resources:
+            # Don't load images (fonts and style sheets are blocked once the browser is started)
+            prefs["profile.managed_default_content_settings.images"] = 2
 
         options = webdriver.ChromeOptions()
         options.add_argument("no-sandbox")
-        options.add_experimental_option(
-            "prefs",
-            {
-                "download.default_directory": download_path,  # Change default directory for downloads
-                "download.prompt_for_download": False,  # To auto download the file
-                "download.directory_upgrade": True,
-                "plugins.always_open_pdf_externally": True,  # It will not show PDF directly in chrome
-            },
-        )
+        options.add_experimental_option("prefs", prefs)
 
         # Hide warning messages (like USB warning messages)
         options.add_experimental_option("excludeSwitches", ["enable-logging"])
@@ -74,90 +115,202 @@ class SequenceMatcher:
         # Mute the audio
         options.add_argument("--mute-audio")
 
+        if self.headless:
+            options.add_argument("--headless=new")
+            options.add_argument("--window-size=1920,1080")
+
         self.web_driver = webdriver.Chrome(executable_path=driver_path, options=options)
-        self.web_driver.maximize_window()
+        self.processes = track_browser(self.web_driver)
 
-    def wait_for_downloads(self) -> None:
-        """Wait for downloads to finish with a specified timeout."""
-        waiting = True
+        if self.headless:
+            # Headless browsers must be explicitly allowed to download files
+            self.web_driver.execute_cdp_cmd(
+                "Page.setDownloadBehavior", {"behavior": "allow", "downloadPath": download_path}
+            )
+        else:
+            self.web_driver.maximize_window()
 
-        while waiting:
-            time.sleep(1)
+        if self.block_resources:
+            self.web_driver.execute_cdp_cmd("Network.enable", {})
+            self.web_driver.execute_cdp_cmd(
+                "Network.setBlockedURLs", {"urls": BLOCKED_URL_PATTERNS}
+            )
 
-            files: List[str] = os.listdir(self.download_path)
+    def recycle_browser(self, reason: str) -> None:
+        """
+        Close the browser of the session and start a new one with the same configuration.
+        """
+        logger.info(f"Recycling the browser after {self.num_queries} queries ({reason})")
 
-            still_downloading = [True if file.endswith(".crdownload") else False for file in files]
+        try:
+            close_browser(self.web_driver, self.processes)
+        except Exception:
+            logger.exception("The browser could not be closed cleanly")
 
-            if any(still_downloading):
-                waiting = True
-            else:
-                waiting = False
+        self.configure_browser(download_path=self.download_path, driver_path=self.driver_path)
 
+    @timed("seqmatch.query_sequence")
     def query_sequence(self, sequence: str) -> str:
         """
         Query a sequence to find selectable matches. Returns the name of the file downloaded.
+        If the sequence is found in the result cache, the stored file is written to the download
+        directory instead of querying RDP.
+        """
+        if self.cache is None:
+            return self._query_reusing_browser(sequence)
+
+        cache_key = self.cache.make_key(sequence, **self.cache_parameters)
+        cached = self.cache.get(cache_key)
+
+        if cached is not None:
+            logger.info("Sequence found in result cache, not quering RDP!")
+            with open(os.path.join(self.download_path, cached["file_name"]), "w") as file:
+                file.write(cached["content"])
+
+            return cached["file_name"]
+
+        file_name = self._query_reusing_browser(sequence)
+        with open(os.path.join(self.download_path, file_name)) as file:
+            self.cache.put(cache_key, {"file_name": file_name, "content": file.read()})
+
+        return file_name
+
+    def _query_reusing_browser(self, sequence: str) -> str:
+        """
+        Query a sequence with the browser of the session, recycling it when it has made
+        "max_queries" queries or when the query fails (the query is then retried).
+        """
+        if self.max_queries and self.num_queries >= self.max_queries:
+            self.recycle_browser(reason="query limit reached")
+
+        for attempt in range(self.max_retries + 1):
+            try:
+                file_name = self._query_remote(sequence)
+            except Exception:
+                if attempt == self.max_retries:
+                    raise
+
+                logger.exception(f"Query failed (attempt {attempt + 1}), retrying it")
+                self.recycle_browser(reason="query failed")
+                continue
+
+            self.num_queries += 1
+            return file_name
+
+    def _query_remote(self, sequence: str) -> str:
+        """
+        Query a sequence to RDP SeqMatch and download all selectable matches.
+        Returns the name of the file downloaded.
         """
         # Open URL
         logger.info("Accessing URL, please wait...")
-        self.web_driver.get(self.web_page)
+        with span("seqmatch.page_load"):
+            self.web_driver.get(self.web_page)
         logger.info("URL loaded!")
 
+        with span("seqmatch.submit"):
+            self._submit_sequence(sequence)
+
+        # Click on the "view selectable matches" as soon as the matches have been computed
+        with span("seqmatch.queue_wait"):
+            selectable_matches_link = self.step_timer.wait(
+                self.web_driver,
+                "view selectable matches link",
+                EC.element_to_be_clickable(
+                    (By.XPATH, "//a[contains(text(), '[view selectable matches]')]")
+                ),
+                timeout=120,
+                replaced_sleep=5,
+            )
+        selectable_matches_link.click()
+
+        with span("seqmatch.select_matches"):
+            self._select_all_matches(selectable_matches_link)
+
+        with span("seqmatch.download"):
+            return self._download_selection()
+
+    def _submit_sequence(self, sequence: str) -> None:
+        """
+        Fill the SeqMatch form with the sequence and options and submit it.
+        """
+        textarea_locator = (By.XPATH, "//textarea[@name='sequence']")
         try:
             # Copy the sequence to the text area
-            textarea = self.web_driver.find_element(By.XPATH, "//textarea[@name='sequence']")
+            textarea = self.web_driver.find_element(*textarea_locator)
         except NoSuchElementException:
             # If a previous query has been made, must click on "new match" button
-            WebDriverWait(self.web_driver, 20).until(
-                EC.element_to_be_clickable((By.XPATH, "/html/body/div[2]/div[2]/div[2]/a[1]"))
+            self.step_timer.wait(
+                self.web_driver,
+                "new match button",
+                EC.element_to_be_clickable((By.XPATH, "/html/body/div[2]/div[2]/div[2]/a[1]")),
             ).click()
 
-            textarea = self.web_driver.find_element(By.XPATH, "//textarea[@name='sequence']")
+            textarea = self.step_timer.wait(
+                self.web_driver, "sequence text area", EC.element_to_be_clickable(textarea_locator)
+            )
 
         textarea.click()
         textarea.clear()
         textarea.send_keys(sequence)
 
+        # Wait until the whole sequence has been typed
+        self.step_timer.wait(
+            self.web_driver,
+            "sequence typed",
+            lambda _: len(textarea.get_attribute("value")) >= len(sequence),
+        )
+
         # Check the "Strain" radio button to "Type"
-        WebDriverWait(self.web_driver, 20).until(
+        self.step_timer.wait(
+            self.web_driver,
+            "strain type radio button",
             EC.element_to_be_clickable(
                 (By.XPATH, "//input[contains(@name, 'strain') and contains(@value, 'type')]")
-            )
+            ),
         ).click()
 
         # Check the "Source" radio button to "Isolates"
-        WebDriverWait(self.web_driver, 20).until(
+        self.step_timer.wait(
+            self.web_driver,
+            "source isolates radio button",
             EC.element_to_be_clickable(
                 (By.XPATH, "//input[contains(@name, 'source') and contains(@value, 'isolates')]")
-            )
+            ),
         ).click()
 
         # Check the "Size" radio button to "Both"
-        WebDriverWait(self.web_driver, 20).until(
+        self.step_timer.wait(
+            self.web_driver,
+            "size both radio button",
             EC.element_to_be_clickable(
                 (By.XPATH, "//input[contains(@name, 'size') and contains(@value, 'both')]")
-            )
+            ),
         ).click()
 
         # Click on the "Submit" button
-        WebDriverWait(self.web_driver, 20).until(
+        self.step_timer.wait(
+            self.web_driver,
+            "submit button",
             EC.element_to_be_clickable(
                 (By.XPATH, "//input[contains(@name, 'submit') and contains(@class, 'button')]")
-            )
-        ).click()
-
-        time.sleep(5 * TIMING_FACTOR)
-
-        # Click on the "view selectable matches"
-        WebDriverWait(self.web_driver, 20).until(
-            EC.element_to_be_clickable(
-                (By.XPATH, "//a[contains(text(), '[view selectable matches]')]")
-            )
+            ),
         ).click()
 
+    def _select_all_matches(self, selectable_matches_link: WebElement) -> None:
+        """
+        Select every match in the selectable matches page and save the selection.
+        """
         # Find all elements that can be selectable
-        checkboxes = self.web_driver.find_elements(
-            By.XPATH, "//input[contains(@name, 'visibleSeqs') and contains (@type, 'checkbox')]"
+        checkboxes_locator = (
+            By.XPATH,
+            "//input[contains(@name, 'visibleSeqs') and contains (@type, 'checkbox')]",
+        )
+        self.step_timer.wait(
+            self.web_driver, "selectable matches page", EC.staleness_of(selectable_matches_link)
         )
+        self.step_timer.wait(self.web_driver, "selectable matches page loaded", document_ready)
+        checkboxes = self.web_driver.find_elements(*checkboxes_locator)
         num_selectable_seqs = len(checkboxes)
 
         logger.debug(f"Number of checkboxes with selectable matches found: {num_selectable_seqs}")
@@ -166,80 +319,85 @@ class SequenceMatcher:
         for checkbox in checkboxes:
             checkbox.click()
 
+        self.step_timer.wait(
+            self.web_driver,
+            "selectable matches checked",
+            lambda _: all(checkbox.is_selected() for checkbox in checkboxes),
+        )
+
         # Click on "save selection and return to summary" button
-        WebDriverWait(self.web_driver, 20).until(
+        self.step_timer.wait(
+            self.web_driver,
+            "save selection button",
             EC.element_to_be_clickable(
                 (
                     By.XPATH,
                     "//input[contains(@class, 'button') and contains(@value, 'Save selection and return to summary')]",
                 )
-            )
+            ),
         ).click()
 
+    def _download_selection(self) -> str:
+        """
+        Download the selected matches from the SeqCart. Returns the name of the file downloaded.
+        """
         # Click on "SEQCART" menu button
-        WebDriverWait(self.web_driver, 20).until(
-            EC.element_to_be_clickable((By.XPATH, "//a[contains(text(), 'SeqCart')]"))
+        self.step_timer.wait(
+            self.web_driver,
+            "SeqCart menu button",
+            EC.element_to_be_clickable((By.XPATH, "//a[contains(text(), 'SeqCart')]")),
         ).click()
 
         # Click on "download" button
-        WebDriverWait(self.web_driver, 20).until(
-            EC.element_to_be_clickable((By.XPATH, "//a[contains(text(), 'download')]"))
+        self.step_timer.wait(
+            self.web_driver,
+            "download link",
+            EC.element_to_be_clickable((By.XPATH, "//a[contains(text(), 'download')]")),
         ).click()
 
         # Click on "Remove all gaps" radio button
-        WebDriverWait(self.web_driver, 20).until(
-            EC.element_to_be_clickable((By.XPATH, "//input[contains(@id, 'remall')]"))
+        self.step_timer.wait(
+            self.web_driver,
+            "remove all gaps radio button",
+            EC.element_to_be_clickable((By.XPATH, "//input[contains(@id, 'remall')]")),
         ).click()
 
-        # Click on download button containing "RDPX-Bacteria-2" text
-        WebDriverWait(self.web_driver, 20).until(
-            EC.element_to_be_clickable(
-                (
-                    By.XPATH,
-                    # f"//input[contains(@class, 'button') and contains(@value, 'Download {num_selectable_seqs} sequence(s) for alignment model: RDPX-Bacteria-2')]",
-                    "//input[contains(@class, 'button') and contains(@value, 'RDPX-Bacteria-2')]",
-                )
-            )
-        ).click()
-
-        # Wait for file to be downloaded
-        self.wait_for_downloads()
-
-        # Check the number of sequences that will be downloaded in the RDPX-Bacteria-2 file
-        button_rdpx_bacteria_2 = self.web_driver.find_element(
-            By.XPATH, "//input[contains(@class, 'button') and contains(@value, 'RDPX-Bacteria-2')]"
-        )
-        button_value_attr = button_rdpx_bacteria_2.get_attribute("value")
-        num_selectable_seqs = int(button_value_attr.split("Download ")[-1].split(" ")[0])
-
-        return f"rdp_download_{num_selectable_seqs}seqs.fa"
-
+        # Files already in the download directory are not taken as the download
+        with DownloadWatcher(self.download_path, timeout=self.download_timeout) as watcher:
+            # Click on download button containing "RDPX-Bacteria-2" text
+            self.step_timer.wait(
+                self.web_driver,
+                "RDPX-Bacteria-2 download button",
+                EC.element_to_be_clickable(
+                    (
+                        By.XPATH,
+                        # f"//input[contains(@class, 'button') and contains(@value, 'Download {num_selectable_seqs} sequence(s) for alignment model: RDPX-Bacteria-2')]",
+                        "//input[contains(@class, 'button') and contains(@value, 'RDPX-Bacteria-2')]",
+                    )
+                ),
+            ).click()
 
-def modify_rdp_file(file_path: str, output_file: str, main_sequence: CorrectedSequence) -> None:
+            # Wait for file to be downloaded
+            download = watcher.wait()
 
-    sequences: List[RDPSequenceData] = list()
+        return os.path.basename(download.path)
 
-    # Read the .fa file
-    with open(file_path) as file:
 
-        lines = file.readlines()
+@timed("seqmatch.modify_rdp_file")
+def modify_rdp_file(
+    file_path: Union[str, List[str]], output_file: str, main_sequence: CorrectedSequence
+) -> int:
+    """
+    Write "{output_file}.fa" with the original sequence first, followed by the sequences of one or
+    more RDP .fa downloads without gaps ("-") and with every sequence in a single line.
 
-        for line in lines:
-            if ">" in line:
+    Downloads are streamed line by line, so memory use does not depend on their size.
+    Returns the number of RDP records written.
+    """
+    file_paths = [file_path] if isinstance(file_path, str) else file_path
 
-                # Get the information of the RDP Sequence
-                rdp_seq = RDPSequenceData(
-                    id=line,
-                    sequence="",
-                )
-
-                sequences.append(rdp_seq)
-            else:
-                # Add the sequence to the RDP specie directly from the list of "sequences"
-                # Replace the "-" with "". Remove also \n
-                sequences[-1].sequence = sequences[-1].sequence + line.replace("-", "").replace(
-                    "\n", ""
-                )
+    start = time.monotonic()
+    num_records = 0
 
     # Save to new file
     with open(f"{output_file}.fa", "w") as file:
@@ -248,78 +406,183 @@ def modify_rdp_file(file_path: str, output_file: str, main_sequence: CorrectedSe
             f">(ORIGINAL SEQUENCE) {main_sequence.id} - {main_sequence.specie_name}\n{main_sequence.sequence}\n\n"
         )
 
-        # Write queried sequences
-        for sequence in sequences:
-            file.write(sequence.id)
-            file.write(sequence.sequence)
-            file.write("\n\n")
+        # Write queried sequences as they are read, removing "-" and line breaks
+        for path in file_paths:
+            in_record = False
+            for line in iter_lines(path):
+                if line.startswith(">"):
+                    if in_record:
+                        file.write("\n\n")
+                    file.write(f"{line}\n")
+                    in_record = True
+                    num_records += 1
+                elif in_record:
+                    file.write(line.replace("-", "").strip())
+
+            if in_record:
+                file.write("\n\n")
+
+    elapsed = time.monotonic() - start
+    logger.info(
+        f"Wrote {num_records} RDP records from {len(file_paths)} files in {elapsed:.2f} s "
+        f"({num_records / elapsed if elapsed > 0 else 0:.0f} records/s)"
+    )
+
+    return num_records
+
+
+def create_matcher_session(
+    download_path: str, driver_path: str, cache: Optional[ResultCache] = None, **options
+) -> SequenceMatcher:
+    """
+    Open and configure a new SeqMatch session downloading to "download_path". "options" are
+    passed to "SequenceMatcher" (e.g. "headless" or "max_queries").
+    """
+    sequence_matcher = SequenceMatcher(cache=cache, **options)
+    sequence_matcher.configure_browser(download_path=download_path, driver_path=driver_path)
+
+    return sequence_matcher
+
+
+def match_sequence(
+    sequence_matcher: SequenceMatcher,
+    sequences: List[CorrectedSequence],
+    output_dir: str,
+    journal: Optional[ProgressJournal] = None,
+    index: Optional[KmerIndex] = None,
+) -> List[str]:
+    """
+    Query a corrected sequence to SeqMatch and write "{id} - {specie name}.fa" in "output_dir"
+    with the sequence followed by its matches. "sequences" is the sequence queried followed by
+    its exact duplicates, which are not queried but get their own output file with the same
+    matches. The download is read from the session's own directory, so it always belongs to
+    this sequence. With a k-mer "index", the matches downloaded are added to it as references.
+    Returns the output files written.
+    """
+    sequence = sequences[0]
+    logger.info(f"Analyzing sequence {sequence.id} - Number {sequence.num_seq}")
+
+    # If a sequence is empty, it means it should not be analyzed!
+    if sequence.sequence == "":
+        for empty_sequence in sequences:
+            logger.warning(
+                f"{empty_sequence.id} {empty_sequence.specie_name} has no sequence. "
+                "Not quering to database!"
+            )
+        return []
+
+    # Skip sequences already matched in a previous run
+    if journal is not None and all(
+        journal.is_completed(duplicate.id, "seqmatch") for duplicate in sequences
+    ):
+        logger.info(f"{sequence.id} already matched in a previous run, skipping it")
+        return []
+
+    if journal is not None:
+        for duplicate in sequences:
+            journal.record_started(duplicate.id, "seqmatch")
+
+    file_name = sequence_matcher.query_sequence(sequence.sequence)
+    download_file = os.path.join(sequence_matcher.download_path, file_name)
+
+    output_files: List[str] = list()
+    for duplicate in sequences:
+        output_file = os.path.join(
+            output_dir, f"{duplicate.id} - {duplicate.specie_name.replace('/', '-')}"
+        )
+        modify_rdp_file(file_path=download_file, output_file=output_file, main_sequence=duplicate)
+        output_files.append(f"{output_file}.fa")
+
+    if index is not None:
+        index.add_fasta(download_file, source="rdp")
+
+    # Remove downloaded file
+    os.remove(download_file)
+
+    if journal is not None:
+        for duplicate, output_file in zip(sequences, output_files):
+            journal.record_completed(duplicate.id, "seqmatch", outputs=[output_file])
+
+    return output_files
+
+
+def match_sequences(
+    sequences: List[CorrectedSequence],
+    output_dir: str,
+    driver_path: str,
+    cache: Optional[ResultCache] = None,
+    journal: Optional[ProgressJournal] = None,
+    num_workers: int = 1,
+    deduplicate: bool = True,
+    index: Optional[KmerIndex] = None,
+    **options,
+) -> List[str]:
+    """
+    Match every corrected sequence with SeqMatch. With "num_workers" greater than 1, that many
+    browser sessions query sequences at the same time, each of them downloading to its private
+    directory "{output_dir}/workers/worker_{n}". With "deduplicate", only one of the sequences
+    that are exactly the same is queried. With a k-mer "index", every download is added to it.
+    "options" are passed to "SequenceMatcher". Returns the output files written.
+    """
+    job_function = partial(match_sequence, output_dir=output_dir, journal=journal, index=index)
+
+    if deduplicate:
+        jobs = group_duplicates(sequences, lambda sequence: sequence.sequence)
+    else:
+        jobs = [[sequence] for sequence in sequences]
+
+    if num_workers > 1:
+        pool = SessionPool(
+            session_factory=partial(
+                create_matcher_session, driver_path=driver_path, cache=cache, **options
+            ),
+            download_root=os.path.join(output_dir, "workers"),
+            max_workers=num_workers,
+        )
+        job_output_files = pool.map(job_function, jobs)
+    else:
+        # Download to a directory of its own, so no other file is taken for the download
+        download_path = os.path.join(output_dir, "downloads")
+        os.makedirs(download_path, exist_ok=True)
+        sequence_matcher = create_matcher_session(download_path, driver_path, cache, **options)
+
+        job_output_files = [job_function(sequence_matcher, job) for job in jobs]
+
+        sequence_matcher.quit()
+
+    return [output_file for output_files in job_output_files for output_file in output_files]
 
 
 if __name__ == "__main__":
     PATH_CHROME_DRIVER = "C:/Program Files (x86)/chromedriver.exe"
     dir_sequences = "C:/Users/alber/Desktop/Sequence_automations/Placa_2/Sequence_match"
     corrected_seqs_file = "C:/Users/alber/Desktop/Sequence_automations/Placa_2/Sequence_match/Secuencias_corregidas.txt"
+    cache_file = "C:/Users/alber/Desktop/Sequence_automations/result_cache.sqlite"
+    index_file = "C:/Users/alber/Desktop/Sequence_automations/kmer_index.sqlite"
 
-    corrected_sequences: List[CorrectedSequence] = list()
+    result_cache = ResultCache(db_path=cache_file)
+    kmer_index = KmerIndex(db_path=index_file)
+    journal = ProgressJournal(f"{dir_sequences}/progress_journal.jsonl")
 
-    seq_line_num = 0
-    num_seq = 1
     # Read file with corrected sequences
-    with open(corrected_seqs_file, "r") as file:
-        lines = file.readlines()
-
-        for line in lines:
-            if ">" in line:
-                seq_line_num += 1
-
-                # Get the information of the Sequence
-                corr_seq = CorrectedSequence(
-                    id=line.replace(">", "").replace("\n", ""),
-                    specie_name="",
-                    sequence="",
-                    num_seq=num_seq,
-                )
-                num_seq += 1
-
-                corrected_sequences.append(corr_seq)
-            elif "%" in line or seq_line_num == 2:
-                seq_line_num = 0
-                corrected_sequences[-1].specie_name = line.replace("\n", "")
-            elif line.startswith(("T", "A", "G", "C")):
-                seq_line_num += 1
-                # Add the sequence to the RDP specie directly from the list of "sequences"
-                # Replace the "-" with "". Remove also \n
-                corrected_sequences[-1].sequence = line.replace("\n", "")
-
-    for sequence in corrected_sequences:
-
-        # if sequence.num_seq <= 96:
-        #     continue
-
-        logger.info(f"Analyzing sequence {sequence.id} - Number {sequence.num_seq}")
-
-        # If a sequence is empty, it means it should not be analyzed!
-        if sequence.sequence == "":
-            logger.warning(
-                f"{sequence.id} {sequence.specie_name} has no sequence. Not quering to database!"
-            )
-            continue
-
-        # Open and configure Chrome using Selenium
-        sequence_matcher = SequenceMatcher()
-        sequence_matcher.configure_browser(
-            download_path=dir_sequences, driver_path=PATH_CHROME_DRIVER
-        )
-
-        file_name = sequence_matcher.query_sequence(sequence.sequence)
-
-        modify_rdp_file(
-            file_path=f"{dir_sequences}\\{file_name}",
-            output_file=f"{dir_sequences}\\{sequence.id} - {sequence.specie_name.replace('/', '-')}",
-            main_sequence=sequence,
-        )
-
-        # Remove downloaded file
-        os.remove(f"{dir_sequences}\\{file_name}")
-
-        sequence_matcher.quit()
+    corrected_sequences = list(read_corrected_sequences(corrected_seqs_file))
+
+    # Every browser session is used for all its sequences
+    match_sequences(
+        corrected_sequences,
+        output_dir=dir_sequences,
+        driver_path=PATH_CHROME_DRIVER,
+        cache=result_cache,
+        journal=journal,
+        num_workers=3,
+        headless=True,
+        block_resources=True,
+        max_queries=25,
+        deduplicate=True,
+        index=kmer_index,
+    )
+
+    METRICS.flush(f"{dir_sequences}/metrics")
+
+    result_cache.close()
+    kmer_index.close()
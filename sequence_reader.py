@@ -0,0 +1,162 @@
+from contextlib import contextmanager
+from dataclasses import dataclass
+import gzip
+import mmap
+import os
+from pathlib import Path
+from typing import IO, Iterator, List, Tuple, Union
+
+# Uncompressed files bigger than this are read through a memory map
+MMAP_THRESHOLD = 64 * 1024 * 1024
+
+GZIP_MAGIC = b"\x1f\x8b"
+
+
+@dataclass
+class FastaRecord:
+    header: str
+    sequence: str
+
+
+@dataclass
+class CorrectedSequence:
+    id: str
+    specie_name: str
+    sequence: str
+    num_seq: int
+
+
+@contextmanager
+def open_text(path: Union[str, Path]) -> Iterator[IO[str]]:
+    """
+    Open a text file for reading, decompressing it on the fly if it is gzipped.
+    """
+    with open(path, "rb") as file:
+        is_gzip = file.read(2) == GZIP_MAGIC
+
+    if is_gzip:
+        with gzip.open(path, "rt") as file:
+            yield file
+    else:
+        with open(path) as file:
+            yield file
+
+
+def iter_lines(path: Union[str, Path]) -> Iterator[str]:
+    """
+    Stream the lines of a plain or gzipped text file, without their line breaks. Big plain files
+    are read through a memory map, so only the pages being read are kept in memory.
+    """
+    if os.path.getsize(path) >= MMAP_THRESHOLD:
+        with open(path, "rb") as file:
+            if file.read(2) != GZIP_MAGIC:
+                with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as memory_map:
+                    for line in iter(memory_map.readline, b""):
+                        yield line.decode().rstrip("\r\n")
+                return
+
+    with open_text(path) as file:
+        for line in file:
+            yield line.rstrip("\r\n")
+
+
+def read_fasta(path: Union[str, Path], remove_gaps: bool = False) -> Iterator[FastaRecord]:
+    """
+    Stream the records of a (multi-)FASTA file, plain or gzipped. The lines of every sequence are
+    joined once the record is complete. With "remove_gaps", "-" characters are removed.
+    """
+    header = None
+    sequence_lines: List[str] = list()
+
+    for line in iter_lines(path):
+        if line.startswith(">"):
+            if header is not None:
+                yield FastaRecord(header=header, sequence="".join(sequence_lines))
+
+            header = line[1:].strip()
+            sequence_lines = list()
+        elif header is not None:
+            line = line.strip()
+            sequence_lines.append(line.replace("-", "") if remove_gaps else line)
+
+    if header is not None:
+        yield FastaRecord(header=header, sequence="".join(sequence_lines))
+
+
+def read_plate_file(path: Union[str, Path]) -> Tuple[str, str]:
+    """
+    Read a plate .txt file (header + number of nucleotides, then the sequence) and return the
+    sequence ID, taken from the file name, and the sequence.
+    """
+    sequence_id = Path(path).name.split("_")[1]
+
+    lines = iter_lines(path)
+    header, num_nucleots = next(lines).split("\t")
+
+    sequence = "".join(line.strip() for line in lines)
+
+    return sequence_id, sequence
+
+
+def iter_plate_files(dir_files: Union[str, Path]) -> Iterator[Path]:
+    """
+    Paths of the plate .txt files (optionally gzipped) of a directory.
+    """
+    for pattern in ("*.txt", "*.txt.gz"):
+        for path in Path(dir_files).glob(pattern):
+            # Only copy files and not directories
+            if path.is_file():
+                yield path
+
+
+def read_corrected_sequences(path: Union[str, Path]) -> Iterator[CorrectedSequence]:
+    """
+    Stream the records of a corrected sequences file, where every ">id" line is followed by the
+    sequence and then by the specie name (the specie name line may also contain a "%").
+    """
+    corrected_sequence = None
+    seq_line_num = 0
+    num_seq = 1
+
+    for line in iter_lines(path):
+        if ">" in line:
+            if corrected_sequence is not None:
+                yield corrected_sequence
+
+            seq_line_num += 1
+            corrected_sequence = CorrectedSequence(
+                id=line.replace(">", ""),
+                specie_name="",
+                sequence="",
+                num_seq=num_seq,
+            )
+            num_seq += 1
+        elif corrected_sequence is None:
+            continue
+        elif "%" in line or seq_line_num == 2:
+            seq_line_num = 0
+            corrected_sequence.specie_name = line
+        elif line.startswith(("T", "A", "G", "C")):
+            seq_line_num += 1
+            corrected_sequence.sequence = line
+
+    if corrected_sequence is not None:
+        yield corrected_sequence
+
+
+def read_sequences(path: Union[str, Path]) -> Iterator[FastaRecord]:
+    """
+    Stream the records of any supported sequence file: (multi-)FASTA, plate .txt files or a plain
+    sequence, each of them optionally gzipped.
+    """
+    first_line = next(iter_lines(path), "")
+
+    if first_line.startswith(">"):
+        yield from read_fasta(path)
+    elif "\t" in first_line:
+        sequence_id, sequence = read_plate_file(path)
+        yield FastaRecord(header=sequence_id, sequence=sequence)
+    else:
+        yield FastaRecord(
+            header=Path(path).stem, sequence="".join(line.strip() for line in iter_lines(path))
+        )
@@ -0,0 +1,97 @@
+from dataclasses import dataclass, field
+import os
+import queue
+import threading
+from typing import Any, Callable, List, Optional, Tuple
+
+from loguru import logger
+
+
+@dataclass
+class SessionPool:
+    """
+    Pool of browser sessions working through a shared queue of jobs.
+
+    Every worker owns one session, created with "session_factory(download_path)" inside a private
+    download directory "{download_root}/worker_{n}". At most "max_workers" sessions (browsers) are
+    alive at the same time.
+    """
+
+    session_factory: Callable[[str], Any]
+    download_root: str
+    max_workers: int = 2
+    _jobs: "queue.Queue[Tuple[int, Any]]" = field(init=False, default_factory=queue.Queue)
+    _results: List[Any] = field(init=False, default_factory=list)
+    _errors: List[Tuple[int, BaseException]] = field(init=False, default_factory=list)
+    _lock: threading.Lock = field(init=False, default_factory=threading.Lock)
+
+    def map(self, job_function: Callable[[Any, Any], Any], jobs: List[Any]) -> List[Any]:
+        """
+        Run "job_function(session, job)" for every job and return the results in the same order
+        as "jobs", no matter which worker processed each one. If any job failed, the first error
+        is raised once every other job has finished.
+        """
+        self._results = [None] * len(jobs)
+        self._errors = list()
+        for job_num, job in enumerate(jobs):
+            self._jobs.put((job_num, job))
+
+        num_workers = max(1, min(self.max_workers, len(jobs)))
+        logger.info(f"Processing {len(jobs)} jobs with {num_workers} browser sessions")
+
+        workers = [
+            threading.Thread(
+                target=self._worker,
+                args=(worker_num, job_function),
+                name=f"session_worker_{worker_num}",
+                daemon=True,
+            )
+            for worker_num in range(num_workers)
+        ]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+        if self._errors:
+            job_num, error = sorted(self._errors, key=lambda job_error: job_error[0])[0]
+            logger.error(f"{len(self._errors)} jobs failed, first failure in job {job_num}")
+            raise error
+
+        return self._results
+
+    def _worker(self, worker_num: int, job_function: Callable[[Any, Any], Any]) -> None:
+        """
+        Create the session of a worker and process jobs until the queue is empty.
+        """
+        download_path = os.path.join(self.download_root, f"worker_{worker_num}")
+        os.makedirs(download_path, exist_ok=True)
+
+        session: Optional[Any] = None
+        try:
+            session = self.session_factory(download_path)
+
+            while True:
+                try:
+                    job_num, job = self._jobs.get_nowait()
+                except queue.Empty:
+                    break
+
+                try:
+                    result = job_function(session, job)
+                except Exception as error:
+                    logger.exception(f"Worker {worker_num} failed processing job {job_num}")
+                    with self._lock:
+                        self._errors.append((job_num, error))
+                    continue
+
+                with self._lock:
+                    self._results[job_num] = result
+        except Exception as error:
+            logger.exception(f"Worker {worker_num} could not start its session")
+            with self._lock:
+                self._errors.append((-1, error))
+        finally:
+            # Every session only closes its own browser, other workers may still be running
+            if session is not None:
+                session.quit()
@@ -0,0 +1,566 @@
+from dataclasses import dataclass, field
+from html import escape
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import hashlib
+import itertools
+import json
+import math
+import random
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import parse_qs, urlencode, urlparse
+
+from loguru import logger
+
+BASES = "ACGT"
+
+# Width of every query range of the flat query-anchored alignments
+ALIGNMENT_WIDTH = 60
+
+
+@dataclass
+class Hit:
+    accession: str
+    title: str
+    sciname: str
+    taxid: int
+    length: int
+    query_from: int
+    query_to: int
+    qseq: str
+    hseq: str
+    identity: int
+    bit_score: float
+    evalue: float
+
+
+@dataclass
+class Job:
+    queries: List[Tuple[str, str]]
+    ready_at: float
+
+
+def make_hits(sequence: str, num_hits: int) -> List[Hit]:
+    """
+    Synthetic hits of a query, always the same for the same sequence: every hit is the aligned
+    part of the query with some mismatches. Hits are sorted by bit score like those of MEGABLAST,
+    and numbered (accession, strain...) by rank.
+    """
+    sequence = sequence.upper()
+    rng = random.Random(hashlib.sha256(sequence.encode()).hexdigest())
+
+    alignments: List[Tuple[float, int, int, int, str, str, int]] = list()
+    for hit_num in range(1, num_hits + 1):
+        query_from = 1 + rng.randint(0, min(20, len(sequence) // 10))
+        query_to = len(sequence) - rng.randint(0, min(20, len(sequence) // 10))
+        qseq = sequence[query_from - 1 : query_to]
+
+        # Every hit has a few more mismatches than the previous one
+        num_mismatches = min(len(qseq), hit_num * 2 + rng.randint(0, 2))
+        hseq = list(qseq)
+        for position in rng.sample(range(len(qseq)), num_mismatches):
+            hseq[position] = rng.choice([base for base in BASES if base != qseq[position]])
+
+        identity = len(qseq) - num_mismatches
+        raw_score = identity - 2 * num_mismatches
+        bit_score = (1.28 * raw_score - math.log(0.46)) / math.log(2)
+        length = len(sequence) + rng.randint(50, 400)
+        alignments.append((bit_score, query_from, query_to, identity, qseq, "".join(hseq), length))
+
+    # Aligned lengths differ, so fewer mismatches don't always mean a higher score
+    alignments.sort(key=lambda alignment: alignment[0], reverse=True)
+
+    hits: List[Hit] = list()
+    for hit_num, alignment in enumerate(alignments, start=1):
+        bit_score, query_from, query_to, identity, qseq, hseq, length = alignment
+        hits.append(
+            Hit(
+                accession=f"SI{hit_num:06d}",
+                title=f"Stand-in bacterium strain {hit_num} 16S ribosomal RNA gene",
+                sciname=f"Stand-in bacterium {hit_num}",
+                taxid=100000 + hit_num,
+                length=length,
+                query_from=query_from,
+                query_to=query_to,
+                qseq=qseq,
+                hseq=hseq,
+                identity=identity,
+                bit_score=bit_score,
+                evalue=min(1.0, 2 ** -bit_score * len(sequence) * 1e9),
+            )
+        )
+
+    return hits
+
+
+def random_sequence(rng: random.Random, length: int) -> str:
+    return "".join(rng.choice(BASES) for _ in range(length))
+
+
+@dataclass
+class StandInServer:
+    """
+    Local HTTP server standing in for NCBI MEGABLAST and RDP SeqMatch, to measure the query
+    flows without network access. It serves:
+
+    - "/Blast.cgi": the BLAST URL API (Put, SearchInfo status, JSON2_S results) and the web
+      pages driven by "BlastNCBI" (form, waiting page, results with hits and alignments).
+    - "/seqmatch/": the SeqMatch pages driven by "SequenceMatcher", down to the FASTA download.
+
+    Jobs are ready "queue_delay" seconds after being submitted. Every query gets "num_hits"
+    synthetic hits (derived from its sequence, so results are reproducible), and SeqMatch
+    downloads have "num_matches" sequences of "match_length" bases.
+    """
+
+    queue_delay: float = 5.0
+    num_hits: int = 100
+    num_alignments: int = 5
+    num_matches: int = 20
+    match_length: int = 1400
+    host: str = "127.0.0.1"
+    port: int = 0
+    _server: Optional[ThreadingHTTPServer] = field(init=False, default=None)
+    _thread: Optional[threading.Thread] = field(init=False, default=None)
+    _jobs: Dict[str, Job] = field(init=False, default_factory=dict)
+    _job_ids: "itertools.count[int]" = field(init=False, default_factory=itertools.count)
+    _lock: threading.Lock = field(init=False, default_factory=threading.Lock)
+
+    def __enter__(self) -> "StandInServer":
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        self.stop()
+
+    @property
+    def base_url(self) -> str:
+        return f"http://{self.host}:{self._server.server_address[1]}"
+
+    @property
+    def blast_url(self) -> str:
+        return f"{self.base_url}/Blast.cgi"
+
+    @property
+    def megablast_page(self) -> str:
+        return f"{self.blast_url}?DATABASE=nr&PAGE=MegaBlast"
+
+    @property
+    def seqmatch_page(self) -> str:
+        return f"{self.base_url}/seqmatch/"
+
+    def start(self) -> None:
+        stand_in = self
+
+        class Handler(StandInHandler):
+            server_state = stand_in
+
+        self._server = ThreadingHTTPServer((self.host, self.port), Handler)
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(
+            target=self._server.serve_forever, name="stand_in_server", daemon=True
+        )
+        self._thread.start()
+        logger.info(f"Stand-in server listening on {self.base_url}")
+
+    def stop(self) -> None:
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._thread.join()
+            self._server = None
+
+    def submit(self, queries: List[Tuple[str, str]]) -> str:
+        """
+        Create a job for the (label, sequence) queries. Returns its ID.
+        """
+        with self._lock:
+            job_id = f"SI{next(self._job_ids):08d}"
+            self._jobs[job_id] = Job(queries=queries, ready_at=time.monotonic() + self.queue_delay)
+
+        return job_id
+
+    def job(self, job_id: str) -> Optional[Job]:
+        with self._lock:
+            return self._jobs.get(job_id)
+
+
+def parse_fasta_query(query: str) -> List[Tuple[str, str]]:
+    """
+    Split a single sequence or a multi-FASTA query into (label, sequence) queries.
+    """
+    if not query.lstrip().startswith(">"):
+        return [("Query_1", "".join(query.split()))]
+
+    queries: List[Tuple[str, str]] = list()
+    for record in query.split(">")[1:]:
+        header, _, sequence = record.partition("\n")
+        queries.append((header.strip() or f"Query_{len(queries) + 1}", "".join(sequence.split())))
+
+    return queries
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    server_state: StandInServer
+
+    def log_message(self, format: str, *args) -> None:
+        logger.debug(f"Stand-in server: {format % args}")
+
+    def do_GET(self) -> None:
+        url = urlparse(self.path)
+        self._route(url.path, {key: values[0] for key, values in parse_qs(url.query).items()})
+
+    def do_POST(self) -> None:
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0))).decode()
+        url = urlparse(self.path)
+
+        parameters = {key: values[0] for key, values in parse_qs(url.query).items()}
+        parameters.update({key: values[0] for key, values in parse_qs(body).items()})
+        self._route(url.path, parameters)
+
+    def _route(self, path: str, parameters: Dict[str, str]) -> None:
+        if path.startswith("/Blast.cgi"):
+            self._blast(parameters)
+        elif path.startswith("/seqmatch"):
+            self._seqmatch(path, parameters)
+        else:
+            self._send(404, "Not found")
+
+    def _send(
+        self,
+        status: int,
+        body: str,
+        content_type: str = "text/html; charset=utf-8",
+        headers: Optional[Dict[str, str]] = None,
+    ) -> None:
+        data = body.encode()
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _redirect(self, location: str) -> None:
+        self._send(303, "", headers={"Location": location})
+
+    # MEGABLAST
+
+    def _blast(self, parameters: Dict[str, str]) -> None:
+        state = self.server_state
+        command = parameters.get("CMD")
+
+        if command == "Put":
+            job_id = state.submit(parse_fasta_query(parameters.get("QUERY", "")))
+            if parameters.get("FORMAT_TYPE") == "HTML":
+                results_query = urlencode({"CMD": "Get", "RID": job_id, "FORMAT_TYPE": "HTML"})
+                self._redirect(f"/Blast.cgi?{results_query}")
+            else:
+                self._send(
+                    200,
+                    f"    RID = {job_id}\n    RTOE = {math.ceil(state.queue_delay)}\n",
+                    content_type="text/plain",
+                )
+            return
+
+        if command != "Get":
+            self._send(200, MEGABLAST_FORM_PAGE)
+            return
+
+        job = state.job(parameters.get("RID", ""))
+        if job is None:
+            self._send(200, "Status=UNKNOWN", content_type="text/plain")
+            return
+
+        remaining = job.ready_at - time.monotonic()
+        format_type = parameters.get("FORMAT_TYPE")
+
+        if parameters.get("FORMAT_OBJECT") == "SearchInfo":
+            self._send(
+                200, f"Status={'WAITING' if remaining > 0 else 'READY'}", content_type="text/plain"
+            )
+        elif remaining > 0 and format_type == "HTML":
+            self._send(200, blast_waiting_page(math.ceil(remaining)))
+        elif remaining > 0:
+            self._send(200, "Status=WAITING", content_type="text/plain")
+        elif format_type == "JSON2_S":
+            # Like NCBI, never more hits than found, whatever the number of descriptions asked
+            num_hits = min(int(parameters.get("DESCRIPTIONS", state.num_hits)), state.num_hits)
+            self._send(200, json2_report(job, num_hits), content_type="application/json")
+        else:
+            query_index = int(parameters.get("QUERY_INDEX", 0))
+            self._send(
+                200,
+                blast_results_page(
+                    parameters["RID"], job, query_index, state.num_hits, state.num_alignments
+                ),
+            )
+
+    # SeqMatch
+
+    def _seqmatch(self, path: str, parameters: Dict[str, str]) -> None:
+        state = self.server_state
+        page = path.rstrip("/").rsplit("/", 1)[-1]
+        job_id = parameters.get("job", "")
+
+        if page == "seqmatch":
+            self._send(200, SEQMATCH_FORM_PAGE)
+        elif page == "submit":
+            job_id = state.submit([("query", "".join(parameters.get("sequence", "").split()))])
+            self._redirect(f"/seqmatch/summary?job={job_id}")
+        elif state.job(job_id) is None:
+            self._send(404, "Unknown job")
+        elif page == "summary":
+            remaining = state.job(job_id).ready_at - time.monotonic()
+            self._send(200, seqmatch_summary_page(job_id, math.ceil(remaining)))
+        elif page == "selectable":
+            self._send(200, seqmatch_selectable_page(job_id, state.num_matches))
+        elif page == "save":
+            self._redirect(f"/seqmatch/summary?job={job_id}")
+        elif page == "seqcart":
+            self._send(200, SEQMATCH_SEQCART_PAGE.format(job=job_id))
+        elif page == "download_page":
+            self._send(200, SEQMATCH_DOWNLOAD_PAGE.format(job=job_id, num=state.num_matches))
+        elif page == "download":
+            self._send(
+                200,
+                seqmatch_download(state.job(job_id), state.num_matches, state.match_length),
+                content_type="application/octet-stream",
+                headers={
+                    "Content-Disposition": (
+                        f'attachment; filename="rdp_download_{state.num_matches}seqs.fa"'
+                    )
+                },
+            )
+        else:
+            self._send(404, "Not found")
+
+
+MEGABLAST_FORM_PAGE = """<!DOCTYPE html>
+<html><head><title>Nucleotide BLAST (stand-in)</title></head><body>
+<form method="post" action="/Blast.cgi">
+<input type="hidden" name="CMD" value="Put">
+<input type="hidden" name="FORMAT_TYPE" value="HTML">
+<textarea name="QUERY" rows="10" cols="80"></textarea>
+<input type="checkbox" id="exclSeqUncult" name="EXCLUDE_SEQ_UNCULT">
+<label for="exclSeqUncult">Uncultured/environmental sample sequences</label>
+<div id="blastButton1"><input type="submit" value="BLAST"></div>
+</form>
+</body></html>
+"""
+
+
+def blast_waiting_page(remaining: int) -> str:
+    refresh = min(remaining, 5)
+    return f"""<!DOCTYPE html>
+<html><head><meta http-equiv="refresh" content="{refresh}"></head><body>
+<p class="WAITING">This page will be automatically updated in {remaining} seconds</p>
+</body></html>
+"""
+
+
+def blast_results_page(
+    rid: str, job: Job, query_index: int, num_hits: int, num_alignments: int
+) -> str:
+    label, sequence = job.queries[query_index]
+    hits = make_hits(sequence, num_hits)
+
+    options = "".join(
+        f'<option value="{num}"{" selected" if num == query_index else ""}>'
+        f"{escape(query_label)}</option>"
+        for num, (query_label, _) in enumerate(job.queries)
+    )
+    rows = "".join(
+        f'<tr ind="{num}">'
+        f'<td class="c1"><input type="checkbox" id="chk_{num}" checked></td>'
+        f'<td class="c2"><a href="#alnHdr_{hit.accession}">{escape(hit.title)}</a></td>'
+        f'<td class="c3"><a href="https://www.ncbi.nlm.nih.gov/Taxonomy/Browser/wwwtax.cgi'
+        f'?id={hit.taxid}">{escape(hit.sciname)}</a></td>'
+        f'<td class="c6">{hit.bit_score:.0f}</td>'
+        f'<td class="c7">{hit.bit_score:.0f}</td>'
+        f'<td class="c8">{(hit.query_to - hit.query_from + 1) * 100 / len(sequence):.0f}%</td>'
+        f'<td class="c9">{hit.evalue:.0e}</td>'
+        f'<td class="c10">{hit.identity * 100 / len(hit.qseq):.2f}%</td>'
+        f'<td class="c11">{hit.length}</td>'
+        f'<td class="c12"><a href="https://www.ncbi.nlm.nih.gov/nucleotide/{hit.accession}.1'
+        f'?report=genbank&amp;blast_rank={num}&amp;RID={rid}">{hit.accession}.1</a></td>'
+        "</tr>"
+        for num, hit in enumerate(hits, start=1)
+    )
+    query_ranges = "".join(
+        f'<pre id="qarow_{num}">{escape(text)}</pre>'
+        for num, text in enumerate(query_anchored_ranges(sequence, hits[:num_alignments]), 1)
+    )
+
+    return f"""<!DOCTYPE html>
+<html><head><title>NCBI Blast (stand-in) {rid}</title></head><body>
+<div class="usa-alert-body">Search {rid} finished</div>
+<select id="queryList" onchange="location.href='/Blast.cgi?CMD=Get&RID={rid}&FORMAT_TYPE=HTML&QUERY_INDEX=' + this.value">{options}</select>
+<table><tbody>{rows}</tbody></table>
+<button class="alignments" type="button">Alignments</button>
+<select name="ALIGNMENT_VIEW" id="alignViewSelect">
+<option value="Pairwise">Pairwise</option>
+<option value="FlatQueryAnchored">Query-anchored with dots for identities</option>
+</select>
+{query_ranges}
+</body></html>
+"""
+
+
+def query_anchored_ranges(sequence: str, hits: List[Hit]) -> List[str]:
+    """
+    Text of the query ranges of the "flat query-anchored with dots for identities" view.
+    """
+    sequence = sequence.upper()
+    labels = ["Query_1"] + [f"{hit.accession}.1" for hit in hits]
+    label_width = max(len(label) for label in labels)
+
+    # Rows anchored to the query: dots for identities, spaces where the hit is not aligned
+    rows: List[str] = list()
+    for hit in hits:
+        aligned = "".join(
+            "." if hit_base == query_base else hit_base
+            for hit_base, query_base in zip(hit.hseq, hit.qseq)
+        )
+        rows.append(" " * (hit.query_from - 1) + aligned + " " * (len(sequence) - hit.query_to))
+
+    query_ranges: List[str] = list()
+    for start in range(0, len(sequence), ALIGNMENT_WIDTH):
+        end = min(start + ALIGNMENT_WIDTH, len(sequence))
+        lines = [f"{'Query_1':<{label_width}}  {start + 1:<6}{sequence[start:end]}  {end}"]
+        for label, row in zip(labels[1:], rows):
+            segment = row[start:end]
+            if segment.strip():
+                lines.append(f"{label:<{label_width}}  {start + 1:<6}{segment}  {end}")
+        query_ranges.append("\n".join(lines))
+
+    return query_ranges
+
+
+def json2_report(job: Job, num_hits: int) -> str:
+    reports = list()
+    for label, sequence in job.queries:
+        hits = [
+            {
+                "num": num,
+                "len": hit.length,
+                "description": [
+                    {
+                        "id": f"gi|{hit.taxid}|gb|{hit.accession}.1|",
+                        "accession": hit.accession,
+                        "title": hit.title,
+                        "sciname": hit.sciname,
+                        "taxid": hit.taxid,
+                    }
+                ],
+                "hsps": [
+                    {
+                        "num": 1,
+                        "bit_score": hit.bit_score,
+                        "evalue": hit.evalue,
+                        "identity": hit.identity,
+                        "align_len": len(hit.qseq),
+                        "query_from": hit.query_from,
+                        "query_to": hit.query_to,
+                        "qseq": hit.qseq,
+                        "hseq": hit.hseq,
+                    }
+                ],
+            }
+            for num, hit in enumerate(make_hits(sequence, num_hits), start=1)
+        ]
+        reports.append(
+            {
+                "report": {
+                    "results": {
+                        "search": {"query_id": label, "query_len": len(sequence), "hits": hits}
+                    }
+                }
+            }
+        )
+
+    return json.dumps({"BlastOutput2": reports})
+
+
+SEQMATCH_FORM_PAGE = """<!DOCTYPE html>
+<html><head><title>SeqMatch (stand-in)</title></head><body>
+<form method="post" action="/seqmatch/submit">
+<textarea name="sequence" rows="10" cols="80"></textarea>
+<input type="radio" name="strain" value="type">Type
+<input type="radio" name="strain" value="both">Both
+<input type="radio" name="source" value="isolates">Isolates
+<input type="radio" name="source" value="both">Both
+<input type="radio" name="size" value="both">Both
+<input type="radio" name="size" value="good">Good
+<input type="submit" name="submit" class="button" value="Submit">
+</form>
+</body></html>
+"""
+
+
+def seqmatch_summary_page(job_id: str, remaining: int) -> str:
+    if remaining > 0:
+        return f"""<!DOCTYPE html>
+<html><head><meta http-equiv="refresh" content="{min(remaining, 2)}"></head><body>
+<p>Computing matches, {remaining} seconds left</p>
+</body></html>
+"""
+
+    return f"""<!DOCTYPE html>
+<html><head><title>SeqMatch summary (stand-in)</title></head><body>
+<a href="/seqmatch/seqcart?job={job_id}">SeqCart</a>
+<a href="/seqmatch/selectable?job={job_id}">[view selectable matches]</a>
+</body></html>
+"""
+
+
+def seqmatch_selectable_page(job_id: str, num_matches: int) -> str:
+    checkboxes = "".join(
+        f'<input type="checkbox" name="visibleSeqs" value="S{num:09d}">'
+        for num in range(num_matches)
+    )
+    return f"""<!DOCTYPE html>
+<html><head><title>SeqMatch selectable matches (stand-in)</title></head><body>
+<form method="post" action="/seqmatch/save?job={job_id}">
+{checkboxes}
+<input type="submit" class="button" value="Save selection and return to summary">
+</form>
+</body></html>
+"""
+
+
+SEQMATCH_SEQCART_PAGE = """<!DOCTYPE html>
+<html><head><title>SeqCart (stand-in)</title></head><body>
+<a href="/seqmatch/download_page?job={job}">download</a>
+</body></html>
+"""
+
+SEQMATCH_DOWNLOAD_PAGE = """<!DOCTYPE html>
+<html><head><title>SeqCart download (stand-in)</title></head><body>
+<form method="get" action="/seqmatch/download">
+<input type="hidden" name="job" value="{job}">
+<input type="radio" id="remcom" name="gaps" value="remcom">
+<input type="radio" id="remall" name="gaps" value="remall">
+<input type="submit" class="button" value="Download {num} sequence(s) for alignment model: RDPX-Bacteria-2">
+</form>
+</body></html>
+"""
+
+
+def seqmatch_download(job: Job, num_matches: int, match_length: int) -> str:
+    """
+    FASTA download with the matches of a SeqMatch job, with gaps and 60 bases per line like the
+    RDP downloads.
+    """
+    _, sequence = job.queries[0]
+    rng = random.Random(hashlib.sha256(sequence.encode()).hexdigest())
+
+    records: List[str] = list()
+    for num in range(num_matches):
+        match = random_sequence(rng, match_length)
+        match = "".join(base if rng.random() > 0.01 else "-" for base in match)
+        lines = [match[start : start + 60] for start in range(0, len(match), 60)]
+        records.append(f">S{num:09d} Stand-in bacterium {num}; type strain\n" + "\n".join(lines))
+
+    return "\n".join(records) + "\n"
@@ -0,0 +1,143 @@
+import random
+
+import pytest
+
+from alignment import DOT, SPACE
+from blast_ncbi_api import BlastNCBIApi
+from result_cache import ResultCache
+from stand_in_server import StandInServer, make_hits, random_sequence
+
+TOP_N = 5
+
+
+@pytest.fixture
+def sequence() -> str:
+    return random_sequence(random.Random(0), 300)
+
+
+@pytest.fixture
+def server():
+    with StandInServer(queue_delay=0) as stand_in:
+        yield stand_in
+
+
+def make_api(server: StandInServer, **kwargs) -> BlastNCBIApi:
+    return BlastNCBIApi(base_url=server.blast_url, poll_interval=0.01, top_n=TOP_N, **kwargs)
+
+
+def count_submits(api: BlastNCBIApi, monkeypatch: pytest.MonkeyPatch) -> list:
+    """
+    Record the queries submitted by "api", which are still sent to the stand-in server.
+    """
+    submitted: list = list()
+    submit = api.submit
+
+    def recording_submit(query: str):
+        submitted.append(query)
+        return submit(query)
+
+    monkeypatch.setattr(api, "submit", recording_submit)
+    return submitted
+
+
+def test_species_fields(server, sequence):
+    species_results, _, error = make_api(server).query_sequence(sequence)
+
+    assert not error
+    assert len(species_results) == TOP_N
+    for rank, (specie, hit) in enumerate(zip(species_results, make_hits(sequence, TOP_N)), 1):
+        assert specie.accession == f"{hit.accession}.1"
+        assert specie.scientific_name == hit.sciname
+        assert specie.description == hit.title
+        assert specie.accession_len == hit.length
+        assert specie.max_score == round(hit.bit_score)
+        assert specie.total_score == round(hit.bit_score)
+        assert specie.e_value == pytest.approx(hit.evalue)
+        assert specie.per_indentity == pytest.approx(hit.identity / len(hit.qseq) * 100)
+        assert specie.query_cover == pytest.approx(
+            (hit.query_to - hit.query_from + 1) / len(sequence) * 100
+        )
+        assert f"blast_rank={rank}" in specie.accession_url
+        assert isinstance(specie.max_score, int)
+        assert isinstance(specie.per_indentity, float)
+
+
+def test_alignment_matrix_layout(server, sequence):
+    species_results, alignments, _ = make_api(server).query_sequence(sequence)
+    hits = make_hits(sequence, TOP_N)
+
+    assert alignments.labels == ["Query"] + [specie.accession for specie in species_results]
+    assert alignments.matrix.shape == (TOP_N + 1, len(sequence))
+    assert (alignments.query_start, alignments.query_end) == (1, len(sequence))
+    assert alignments.text_rows()[0] == sequence
+
+    for row, hit in zip(alignments.hits, hits):
+        start, end = hit.query_from - 1, hit.query_to
+        # Columns outside the hit alignment are spaces, identities are dots
+        assert (row[:start] == SPACE).all() and (row[end:] == SPACE).all()
+        assert int((row[start:end] == DOT).sum()) == hit.identity
+
+    assert alignments.identity() == pytest.approx(
+        [hit.identity / len(hit.qseq) * 100 for hit in hits]
+    )
+
+
+def test_error_flag_with_fewer_hits_than_top_n(sequence):
+    with StandInServer(queue_delay=0, num_hits=TOP_N - 2) as server:
+        species_results, alignments, error = make_api(server).query_sequence(sequence)
+
+    assert error
+    assert len(species_results) == TOP_N - 2
+    assert alignments.num_hits == TOP_N - 2
+
+
+def test_batch_results_in_query_order(server):
+    rng = random.Random(1)
+    sequences = [random_sequence(rng, length) for length in (250, 300, 350)]
+
+    batch_results = make_api(server).query_batch(sequences)
+
+    assert len(batch_results) == len(sequences)
+    for sequence, (species_results, alignments, error) in zip(sequences, batch_results):
+        assert not error
+        assert alignments.text_rows()[0] == sequence
+        assert species_results[0].accession_len == make_hits(sequence, TOP_N)[0].length
+
+
+def test_cache_hits_skip_submit(server, sequence, tmp_path, monkeypatch):
+    cache = ResultCache(db_path=str(tmp_path / "cache.db"))
+    api = make_api(server, cache=cache)
+    submitted = count_submits(api, monkeypatch)
+
+    first = api.query_sequence(sequence)
+    assert len(submitted) == 1
+    assert api.is_cached(sequence)
+
+    second = api.query_sequence(sequence)
+    assert len(submitted) == 1
+    assert second[0] == first[0]
+    assert second[1].text_rows() == first[1].text_rows()
+    assert second[2] == first[2]
+
+    # Only the sequences missing from the cache are submitted, in a single job
+    other_sequence = random_sequence(random.Random(2), 280)
+    api.query_batch([sequence, other_sequence])
+    assert len(submitted) == 2
+    assert submitted[-1].count(">") == 1
+    cache.close()
+
+
+def test_cached_crop_is_keyed_by_cropped_sequence(server, sequence, tmp_path, monkeypatch):
+    cache = ResultCache(db_path=str(tmp_path / "cache.db"))
+    api = make_api(server, cache=cache)
+    submitted = count_submits(api, monkeypatch)
+
+    window = (10, 210)
+    species_results, alignments, _ = api.query_sequence(sequence, crop=window)
+    assert alignments.text_rows()[0] == sequence[window[0] : window[1]]
+
+    # The same cropped sequence is answered from the cache, whatever read it comes from
+    assert api.is_cached(sequence[window[0] : window[1]])
+    assert api.query_sequence("AC" + sequence, crop=(12, 212))[0] == species_results
+    assert len(submitted) == 1
+    cache.close()
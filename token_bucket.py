@@ -0,0 +1,59 @@
+from dataclasses import dataclass, field
+import threading
+import time
+
+
+@dataclass
+class TokenBucket:
+    """
+    Thread-safe token bucket allowing "rate" requests per second on average, with bursts of at
+    most "capacity" requests. "pause" takes no token until the given time has passed, to back
+    off when the server starts refusing requests.
+    """
+
+    rate: float
+    capacity: float = 1
+    _tokens: float = field(init=False)
+    _updated: float = field(init=False)
+    _paused_until: float = field(init=False, default=0.0)
+    _lock: threading.Lock = field(init=False, default_factory=threading.Lock)
+
+    def __post_init__(self) -> None:
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+
+    def _refill(self, now: float) -> None:
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def wait_time(self) -> float:
+        """
+        Seconds until a token can be taken.
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            refill_time = max(0.0, (1 - self._tokens) / self.rate)
+
+            return max(refill_time, self._paused_until - now)
+
+    def try_acquire(self) -> bool:
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            if now < self._paused_until or self._tokens < 1:
+                return False
+
+            self._tokens -= 1
+            return True
+
+    def acquire(self) -> None:
+        """
+        Take a token, waiting until one is available.
+        """
+        while not self.try_acquire():
+            time.sleep(self.wait_time())
+
+    def pause(self, seconds: float) -> None:
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)